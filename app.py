@@ -2,50 +2,275 @@
 
 import logging
 import argparse
+import sys
 from src.TrueNAS import TrueNAS
-from src.Config import Config
-from time import sleep
+from src.Config import Config, CLIENT_FIELDS, RESTART_FIELDS, SCHEDULER_FIELDS
+from src.Metrics import Metrics
+from src.State import ErrState, load_state, save_state
+from dataclasses import replace
+from time import sleep, monotonic
 
+# Exit codes of --once, as terraform plan -detailed-exitcode: 0 and 2 are both successes
+EXIT_NO_CHANGES = 0
+EXIT_ERROR = 1
+EXIT_CHANGED = 2
+EXIT_PARTIAL_FAILURE = 3
 
-def main(config_file: str = None):
+
+def main(config_file: str = None, profile_file: str = None, once: bool = False) -> int | None:
+    """
+    Returns:
+        With once, the exit code of the cycle
+    """
     config = Config.new(config_file=config_file)
+    profile_file = profile_file or config.profile_file
     logger = logging.getLogger("TrueNAS")
     logging.basicConfig(
         level=config.log_level,
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S'
     )
-    truenas = TrueNAS(
-        host=config.host,
-        api_key=config.api_key,
-        verify_ssl=config.ssl_verify,
-        dry_run=config.dry_run,
-        logger=logger
-    )
+    metrics = Metrics()
+    if config.metrics_port and not once:
+        # Only the imports of the mode in use are paid for
+        from src.Metrics import MetricsServer
+        MetricsServer(metrics, port=config.metrics_port, addr=config.metrics_addr, logger=logger).start()
+    if config.fleet:
+        if profile_file:
+            logger.warning("Profiling is not supported in fleet mode, running without it.")
+        return run_fleet(config, logger, metrics, once=once)
+    truenas = TrueNAS.new_from_config(config, logger=logger, metrics=metrics)
+    parents = config.nfs_parents
+    if once:
+        return run_once(truenas, parents, config.state_file, logger, profile_file)
+    config_watcher = None
     try:
+        # The connection pool stays open across cycles so keep-alive sessions are reused.
+        truenas.connect()
+        if config.watch:
+            from src.Watcher import Watcher
+            watcher = Watcher(truenas, parents, full_resync_sec=config.full_resync_sec, logger=logger)
+            watcher.run()
+            return
+        scheduler = config.scheduler
+        if config_file and config.config_reload:
+            from src.ConfigWatcher import ConfigWatcher
+            config_watcher = ConfigWatcher(config_file, poll_sec=config.config_poll_sec, logger=logger).start()
+        if config.state_file and warm_start(truenas, parents, config.state_file, logger):
+            # The changes replayed were the first action, the full listing follows shortly
+            sleep(scheduler.min_sec)
+        targets = parents
         while True:
             try:
-                with truenas:
-                    truenas.update_nfs_share(
-                        parent_dataset_id=config.parent_dataset_id,
-                        parent_real_path=config.parent_real_path,
-                        common_config=config.nfs_common,
-                        filter_path_pattern=config.filter_path_pattern,
-                        filter_path_mode=config.filter_path_mode,
-                        filter_path_reversed=config.filter_path_reversed,
-                        remove=config.nfs_auto_remove
-                    )
-                    logger.info(f"NFS share updated successfully for {config.parent_dataset_id}.")
+                if profile_file:
+                    results = profiled(profile_file, logger, truenas.update_nfs_shares, targets)
+                    profile_file = None
+                else:
+                    results = truenas.update_nfs_shares(targets)
+                for parent_dataset_id, nfs_modify in results.items():
+                    if nfs_modify.failed:
+                        logger.warning(f"NFS share updated for {parent_dataset_id} with {len(nfs_modify.errors)} failures.")
+                    else:
+                        logger.info(f"NFS share updated successfully for {parent_dataset_id}.")
+                delay = scheduler.after_cycle(
+                    applied=sum(nfs_modify.applied for nfs_modify in results.values()),
+                    failed=sum(len(nfs_modify.errors) for nfs_modify in results.values())
+                )
             except Exception as e:
                 logger.error(f"Error updating NFS share: {e}")
-            logger.info(f"Sleeping for {config.check_period_sec} seconds...")
-            sleep(config.check_period_sec)
+                delay = scheduler.after_error()
+            if config.state_file and truenas.state_changed:
+                try:
+                    save_state(config.state_file, truenas.export_state())
+                except OSError as e:
+                    logger.error(f"Failed to save the state to {config.state_file}: {e}")
+            logger.debug(f"Connection stats: {truenas.connection_stats}, cache stats: {truenas.cache.stats}")
+            logger.info(f"Sleeping for {delay:.0f} seconds...")
+            targets = parents
+            if config_watcher is None:
+                sleep(delay)
+                continue
+            # A reload cuts the sleep short if it affects any parent
+            deadline = monotonic() + delay
+            while True:
+                new_config = config_watcher.wait(max(0.0, deadline - monotonic()))
+                if new_config is None:
+                    break
+                previous = config
+                config, truenas, targets = reload_config(config, new_config, truenas, metrics, logger)
+                parents = config.nfs_parents
+                if previous.changed_fields(config) & set(SCHEDULER_FIELDS):
+                    scheduler = config.scheduler
+                if targets:
+                    break
+                targets = parents
 
     except KeyboardInterrupt:
         logger.info("Process interrupted. Exiting...")
     except Exception as e:
         logger.error(f"Unexpected error occurred: {e}")
     finally:
+        if config_watcher is not None:
+            config_watcher.stop()
+        truenas.close()
+        logger.info("Exiting the script.")
+
+
+def reload_config(config: Config, new_config: Config, truenas: TrueNAS, metrics: Metrics,
+                  logger: logging.Logger) -> tuple[Config, TrueNAS, list]:
+    """
+    Swap in a new validated config between two cycles
+    Returns:
+        (the config now in use, the client to use, the parents to reconcile right away)
+    """
+    changed = config.changed_fields(new_config)
+    restart = changed & set(RESTART_FIELDS)
+    if restart:
+        logger.warning(f"Settings {sorted(restart)} only take effect after a restart, keeping their old values")
+        new_config = replace(new_config, **{name: getattr(config, name) for name in restart})
+        changed -= restart
+    if not changed:
+        return config, truenas, []
+    logger.info(f"Config reloaded, changed settings: {sorted(changed)}")
+    if "log_level" in changed:
+        logging.getLogger().setLevel(new_config.log_level)
+        logger.setLevel(new_config.log_level)
+    new_parents = new_config.nfs_parents
+    if changed & set(CLIENT_FIELDS):
+        # Another host, key or transport: a new client, and every parent is checked with it
+        new_truenas = None
+        try:
+            new_truenas = TrueNAS.new_from_config(new_config, logger=logger, metrics=metrics)
+            if new_config.host == config.host:
+                new_truenas.import_state(truenas.export_state())
+            new_truenas.connect()
+        except Exception as e:
+            logger.error(f"Failed to switch to the new client, keeping the old config: {e}")
+            if new_truenas is not None:
+                new_truenas.close()
+            return config, truenas, []
+        truenas.close()
+        return new_config, new_truenas, new_parents
+    # Only the parents whose settings changed: filter rules, common networks or hosts, paths...
+    old_keys = set(parent.cache_key for parent in config.nfs_parents)
+    targets = [parent for parent in new_parents if parent.cache_key not in old_keys]
+    logger.info(f"Reconciling {len(targets)} of {len(new_parents)} parents affected by the change")
+    return new_config, truenas, targets
+
+
+def exit_code(results: dict) -> int:
+    """
+    The --once exit code of the results of a cycle, dict of parent dataset id -> NfsModify
+    """
+    if any(nfs_modify.failed for nfs_modify in results.values()):
+        return EXIT_PARTIAL_FAILURE
+    if any(nfs_modify.applied > 0 for nfs_modify in results.values()):
+        return EXIT_CHANGED
+    return EXIT_NO_CHANGES
+
+
+def run_once(truenas: TrueNAS, parents: list, state_file: str, logger: logging.Logger, profile_file: str = None) -> int:
+    """
+    One full cycle, for cron and Kubernetes Jobs. The state file, if any, only brings the
+    reconcile cache: an unchanged pool ends after the listings. An unreadable state file is
+    ignored and replaced, so it doesn't fail every later run.
+    Returns:
+        The exit code
+    """
+    replace_state = False
+    if state_file:
+        try:
+            state = load_state(state_file)
+            if state is not None and not truenas.import_state(state):
+                logger.warning(f"State file {state_file} is for another host, ignoring it.")
+        except ErrState as e:
+            logger.warning(f"{e}, ignoring it.")
+            replace_state = True
+    try:
+        truenas.connect()
+        if profile_file:
+            results = profiled(profile_file, logger, truenas.update_nfs_shares, parents)
+        else:
+            results = truenas.update_nfs_shares(parents)
+    except Exception as e:
+        logger.error(f"Error updating NFS share: {e}")
+        return EXIT_ERROR
+    finally:
+        truenas.close()
+    if state_file and (truenas.state_changed or replace_state):
+        try:
+            save_state(state_file, truenas.export_state())
+        except OSError as e:
+            logger.error(f"Failed to save the state to {state_file}: {e}")
+    code = exit_code(results)
+    for parent_dataset_id, nfs_modify in results.items():
+        logger.info(f"{parent_dataset_id}: {nfs_modify.applied} changes applied, {len(nfs_modify.errors)} failures")
+    logger.info(f"Exiting with code {code}")
+    return code
+
+
+def profiled(file_path: str, logger: logging.Logger, func, *args):
+    """
+    Call func under cProfile and write the profile to file_path, for pstats or snakeviz.
+    Only the calling thread is profiled: the apply workers show as time waiting for them.
+    """
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        profiler.dump_stats(file_path)
+        logger.info(f"Profile of the cycle written to {file_path}, read it with: python -m pstats {file_path}")
+
+
+def warm_start(truenas: TrueNAS, parents: list, state_file: str, logger: logging.Logger) -> bool:
+    """
+    Load the state file and apply its pending changes. Those are only what the last run left
+    unapplied, e.g. failed adds or removes: datasets created or deleted while the process was
+    down are not in the saved state and wait for the first full listing.
+    Returns:
+        True if pending changes were applied
+    """
+    try:
+        state = load_state(state_file)
+        if state is None:
+            logger.info(f"No state file at {state_file}, starting cold.")
+            return False
+        if not truenas.import_state(state):
+            logger.warning(f"State file {state_file} is for another host, starting cold.")
+            return False
+        results = truenas.warm_start(parents)
+        return any(nfs_modify.applied > 0 for nfs_modify in results.values())
+    except Exception as e:
+        logger.error(f"Warm start failed, starting cold: {e}")
+        return False
+
+
+def run_fleet(config: Config, logger: logging.Logger, metrics: Metrics, once: bool = False) -> int | None:
+    import asyncio
+    from src.Fleet import Fleet
+    if config.watch and not once:
+        logger.warning("Watch mode is not supported in fleet mode, polling every host instead.")
+    fleet = Fleet(
+        config.fleet_configs,
+        concurrency=config.fleet_concurrency,
+        host_timeout_sec=config.host_timeout_sec,
+        metrics=metrics,
+        logger=logger
+    )
+    try:
+        if once:
+            hosts = asyncio.run(fleet.run_once())
+            if all(results is None for results in hosts.values()):
+                return EXIT_ERROR
+            if any(results is None for results in hosts.values()):
+                return EXIT_PARTIAL_FAILURE
+            return max(exit_code(results) for results in hosts.values())
+        asyncio.run(fleet.run())
+    except KeyboardInterrupt:
+        logger.info("Process interrupted. Exiting...")
+    finally:
+        fleet.close()
         logger.info("Exiting the script.")
 
 
@@ -55,9 +280,19 @@ def arg_parser():
         "-c", "--config-file",
         help="Path to the configuration file in JSON format."
     )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="Run the first cycle under cProfile and write the profile to FILE."
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="Run a single cycle and exit: 0 nothing to change, 2 changes applied, 3 some failed, 1 error."
+    )
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = arg_parser()
-    main(config_file=args.config_file)
+    sys.exit(main(config_file=args.config_file, profile_file=args.profile, once=args.once))
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the compiled FilterEngine against filter_str, for the default single rule
+and for an ordered list of include/exclude rules.
+
+    python benchmarks/bench_filter.py [-n 100000]
+"""
+from __future__ import annotations
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.Filter import FilterEngine, FilterRule  # noqa: E402
+from src.TrueNAS import filter_str  # noqa: E402
+
+
+RULE_SETS = {
+    "default (end_with '_', exclude)": [
+        FilterRule(pattern="_", mode="end_with", action="exclude"),
+    ],
+    "5 mixed rules": [
+        FilterRule(pattern="/mnt/data/home/svc-", mode="start_with", action="exclude"),
+        FilterRule(pattern="_", mode="end_with", action="exclude"),
+        FilterRule(pattern=".trash", mode="contains", action="exclude"),
+        FilterRule(pattern=r"/user\d+$", mode="regex", action="include"),
+        FilterRule(pattern="/mnt/data/home/", mode="start_with", action="include"),
+    ],
+}
+
+
+def filter_str_rules(rules: list[FilterRule], paths: list[str]) -> list[str]:
+    """
+    The same first-match semantics evaluated the old way: filter_str for every rule and path
+    """
+    default = not any(rule.action == "include" for rule in rules)
+    kept = []
+    for path in paths:
+        keep = default
+        for rule in rules:
+            if filter_str(path, rule.pattern, rule.mode):
+                keep = rule.action == "include"
+                break
+        if keep:
+            kept.append(path)
+    return kept
+
+
+def paths(n: int) -> list[str]:
+    random.seed(0)
+    suffixes = ["", "_", ".trash", "-old"]
+    prefixes = ["user", "svc-", "team"]
+    return [f"/mnt/data/home/{random.choice(prefixes)}{i}{random.choice(suffixes)}" for i in range(n)]
+
+
+def timed(func) -> tuple[float, list[str]]:
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Path filter benchmark")
+    parser.add_argument("-n", "--paths", type=int, default=100_000)
+    args = parser.parse_args()
+    data = paths(args.paths)
+    for name, rules in RULE_SETS.items():
+        engine = FilterEngine(rules)
+        old_sec, old = timed(lambda: filter_str_rules(rules, data))
+        new_sec, new = timed(lambda: engine.filter(data))
+        if old != new:
+            raise AssertionError(f"{name}: FilterEngine and filter_str disagree")
+        print(f"{name:<34} {args.paths} paths  filter_str {old_sec * 1000:8.1f} ms  "
+              f"FilterEngine {new_sec * 1000:8.1f} ms  ({old_sec / new_sec:.1f}x), kept {len(new)}")
+
+
+if __name__ == "__main__":
+    main()
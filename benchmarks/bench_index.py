@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the sorted-prefix PathIndex against the linear scans it replaces, for N shares
+spread over 100 parent datasets (every tenth one nested in another):
+
+    subtree      the shares of one parent: NfsShareDict.filter_by_path / subtree
+    owner        the innermost parent of every share
+    difference   the shares of one parent without a dataset
+
+    python benchmarks/bench_index.py [-n 100000]
+"""
+from __future__ import annotations
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.PathIndex import PathIndex  # noqa: E402
+from src.TrueNAS import NfsShareDict, filter_str  # noqa: E402
+
+
+PARENTS = 100
+
+
+def parent_prefixes() -> list[str]:
+    prefixes = []
+    for i in range(PARENTS):
+        if i % 10 == 9:
+            # Nested in the previous parent
+            prefixes.append(f"{prefixes[-1]}/nested{i}")
+        else:
+            prefixes.append(f"/mnt/data/group{i}")
+    return prefixes
+
+
+def shares(n: int, prefixes: list[str]) -> NfsShareDict:
+    return NfsShareDict.new_from_list(
+        {"id": i, "path": f"{prefixes[i % len(prefixes)]}/user{i}"} for i in range(n)
+    )
+
+
+def timed(func, repeat: int = 1) -> tuple[float, object]:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def scan_subtree(nfs_shares: NfsShareDict, prefix: str) -> list[str]:
+    return [nfs_share.path for nfs_share in nfs_shares if filter_str(nfs_share.path, f"{prefix}/", "start_with")]
+
+
+def scan_owner(paths: list[str], innermost_first: list[str]) -> list[str]:
+    return [next((prefix for prefix in innermost_first if path.startswith(f"{prefix}/")), None) for path in paths]
+
+
+def report(name: str, old_sec: float, new_sec: float, detail: str = ""):
+    print(f"{name:<26} scan {old_sec * 1000:9.2f} ms  index {new_sec * 1000:9.2f} ms  "
+          f"({old_sec / new_sec:7.1f}x) {detail}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Path index benchmark")
+    parser.add_argument("-n", "--shares", type=int, default=100_000)
+    args = parser.parse_args()
+    prefixes = parent_prefixes()
+    nfs_shares = shares(args.shares, prefixes)
+    paths = list(nfs_shares.keys())
+    target = prefixes[42]
+
+    build_sec, _ = timed(lambda: PathIndex(paths))
+    print(f"PathIndex of {args.shares} shares: build and sort {build_sec * 1000:.1f} ms")
+    nfs_shares.index.subtree(target)
+
+    old_sec, old = timed(lambda: scan_subtree(nfs_shares, target), repeat=5)
+    new_sec, new = timed(lambda: nfs_shares.index.subtree(target), repeat=5)
+    if sorted(old) != new:
+        raise AssertionError("subtree: index and scan disagree")
+    report("subtree paths", old_sec, new_sec, f"{len(new)} shares")
+
+    old_sec, old = timed(lambda: nfs_shares.filter_by_path(f"{target}/", mode="contains"), repeat=5)
+    new_sec, new = timed(lambda: nfs_shares.filter_by_path(f"{target}/"), repeat=5)
+    if old.keys() != new.keys():
+        raise AssertionError("filter_by_path: index and scan disagree")
+    report("filter_by_path", old_sec, new_sec, f"{len(new)} shares")
+
+    innermost_first = sorted(prefixes, key=len, reverse=True)
+    index = PathIndex(prefixes)
+    old_sec, old = timed(lambda: scan_owner(paths, innermost_first))
+    new_sec, new = timed(lambda: [index.innermost(path) for path in paths])
+    if old != new:
+        raise AssertionError("owner: index and scan disagree")
+    report("innermost parent, all", old_sec, new_sec, f"{PARENTS} parents")
+
+    datasets = set(paths[::3])
+    old_sec, old = timed(lambda: [path for path in scan_subtree(nfs_shares, target) if path not in datasets], repeat=5)
+    new_sec, new = timed(lambda: nfs_shares.missing_from(datasets, target), repeat=5)
+    if sorted(old) != new:
+        raise AssertionError("difference: index and scan disagree")
+    report("subtree difference", old_sec, new_sec, f"{len(new)} missing")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the model classes: memory per object and parse time for N records,
+slotted models against the dict-backed equivalents they replaced.
+
+    python benchmarks/bench_models.py [-n 100000]
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field, fields, make_dataclass
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.TrueNAS import DataSet, NfsShare, NfsShareDict  # noqa: E402
+
+
+def dict_backed(cls: type) -> type:
+    """
+    The same record type without __slots__, parsed the way the models used to be
+    (a loop over __dict__ for every field).
+    """
+    spec = [(f.name, f.type, field(default=f.default, default_factory=f.default_factory)) for f in fields(cls)]
+    legacy = make_dataclass(f"Legacy{cls.__name__}", spec)
+
+    def new_from_dict(dict_data: dict):
+        obj = legacy()
+        for key, value in obj.__dict__.items():
+            if key in dict_data:
+                obj.__dict__[key] = dict_data[key]
+        return obj
+
+    legacy.new_from_dict = staticmethod(new_from_dict)
+    return legacy
+
+
+@dataclass
+class Result:
+    name: str
+    records: int
+    parse_sec: float
+    bytes_per_object: float
+
+    def __str__(self) -> str:
+        return (f"{self.name:<22} {self.records:>8} records  "
+                f"parse {self.parse_sec * 1000:>9.1f} ms  "
+                f"{self.bytes_per_object:>8.1f} B/object")
+
+
+def measure(name: str, build, records: list[dict]) -> Result:
+    gc.collect()
+    start = time.perf_counter()
+    objects = [build(record) for record in records]
+    parse_sec = time.perf_counter() - start
+    del objects
+    gc.collect()
+    tracemalloc.start()
+    objects = [build(record) for record in records]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result = Result(name, len(records), parse_sec, size / len(records))
+    del objects
+    return result
+
+
+def share_records(n: int) -> list[dict]:
+    return [{
+        "id": i,
+        "path": f"/mnt/data/home/user{i}",
+        "aliases": [],
+        "comment": "",
+        "networks": ["10.0.0.0/8"],
+        "hosts": [],
+        "ro": False,
+        "maproot_user": None,
+        "maproot_group": None,
+        "mapall_user": None,
+        "mapall_group": None,
+        "security": [],
+        "enabled": True,
+        "locked": False,
+    } for i in range(n)]
+
+
+def dataset_records(n: int) -> list[dict]:
+    return [{
+        "id": f"data/home/user{i}",
+        "type": "FILESYSTEM",
+        "name": f"data/home/user{i}",
+        "pool": "data",
+        "encrypted": False,
+        "encryption_root": None,
+        "key_loaded": False,
+        "children": [],
+    } for i in range(n)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Model memory and parse-time benchmark")
+    parser.add_argument("-n", "--records", type=int, default=100_000)
+    args = parser.parse_args()
+
+    shares = share_records(args.records)
+    datasets = dataset_records(args.records)
+    results = [
+        measure("NfsShare (slots)", NfsShare.new_from_dict, shares),
+        measure("NfsShare (dict)", dict_backed(NfsShare).new_from_dict, shares),
+        measure("DataSet (slots)", DataSet.new_from_dict, datasets),
+        measure("DataSet (dict)", dict_backed(DataSet).new_from_dict, datasets),
+    ]
+    for result in results:
+        print(result)
+
+    body = json.dumps(shares)
+    start = time.perf_counter()
+    NfsShareDict.new_from_json(body)
+    print(f"NfsShareDict.new_from_json {args.records} records: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    depth = min(args.records, 50_000)
+    root: dict = {"id": "data", "children": []}
+    node = root
+    for i in range(depth):
+        child = {"id": f"data/d{i}", "children": []}
+        node["children"].append(child)
+        node = child
+    start = time.perf_counter()
+    DataSet.new_from_dict(root)
+    print(f"DataSet tree of depth {depth}: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
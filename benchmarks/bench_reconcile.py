@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of one reconcile cycle against the local mock TrueNAS API
+(see mock_truenas.py), for these scenarios at several pool sizes:
+
+    full-sync  N datasets, half of them shared, N/10 stale shares to remove
+    no-op      N datasets, all shared: fetch and diff only
+    bulk-add   N datasets, none shared
+    drift      N datasets, all shared, N/10 of them with other networks to update
+    once       the no-op state, through `app.py --once` in a new interpreter: cold start,
+               imports and config included, as a cron job or Kubernetes Job runs it
+
+Every cycle runs in a fresh process, so its peak RSS is its own. Results can be saved
+as JSON and compared with a previous run, e.g. the last release:
+
+    python benchmarks/bench_reconcile.py [--sizes 100,10000,100000] [--output results.json]
+    python benchmarks/bench_reconcile.py --compare results.json
+"""
+from __future__ import annotations
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+import http.client
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mock_truenas import MockTrueNAS, PARENT, NETWORKS  # noqa: E402
+
+
+SCENARIOS = {
+    "full-sync": lambda n: {"datasets": n, "shares": n // 2, "stale": n // 10},
+    "no-op": lambda n: {"datasets": n, "shares": n, "stale": 0},
+    "bulk-add": lambda n: {"datasets": n, "shares": 0, "stale": 0},
+    "drift": lambda n: {"datasets": n, "shares": n, "stale": 0, "drifted": n // 10},
+    "once": lambda n: {"datasets": n, "shares": n, "stale": 0},
+}
+METRICS = ("wall_sec", "requests", "bytes_in", "bytes_out", "peak_rss_mb")
+
+
+def control(host: str, method: str, path: str, data: dict = None) -> dict:
+    conn = http.client.HTTPSConnection(host, context=ssl._create_unverified_context())
+    try:
+        conn.request(method, path, json.dumps(data) if data is not None else None)
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+
+def run_cycle(host: str, options: dict) -> dict:
+    """
+    One reconcile cycle with a fresh client, in its own process
+    """
+    from src.TrueNAS import TrueNAS, NfsParent, NfsShareAdd
+    truenas = TrueNAS(
+        host=host,
+        api_key="bench",
+        verify_ssl=False,
+        apply_concurrency=options["concurrency"],
+        stream_listings=options["stream"],
+        bulk_size=options["bulk_size"],
+        compression=options["compression"],
+        page_size=options["page_size"],
+    )
+    parent = NfsParent(dataset_id=PARENT, common_config=NfsShareAdd(networks=NETWORKS))
+    start = time.perf_counter()
+    with truenas:
+        nfs_modify = truenas.update_nfs_shares([parent])[PARENT]
+    wall_sec = time.perf_counter() - start
+    return {
+        "wall_sec": round(wall_sec, 4),
+        "updated": len([path for path in nfs_modify.update if path not in nfs_modify.errors]),
+        "added": len(nfs_modify.add) - len([path for path in nfs_modify.errors if path in nfs_modify.add]),
+        "removed": len(nfs_modify.remove) - len([path for path in nfs_modify.errors if path in nfs_modify.remove]),
+        "failed": len(nfs_modify.errors),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def run_app_once(host: str, options: dict) -> dict:
+    """
+    One cycle of `app.py --once` in a new interpreter, timed from its start to its exit
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        config_file = os.path.join(directory, "config.json")
+        with open(config_file, "w") as f:
+            json.dump({
+                "host": host,
+                "api_key": "bench",
+                "ssl_verify": False,
+                "parent_dataset_id": PARENT,
+                "nfs_common_networks": NETWORKS,
+                "apply_concurrency": options["concurrency"],
+                "stream_listings": options["stream"],
+                "bulk_size": options["bulk_size"],
+                "compression": options["compression"],
+                "page_size": options["page_size"],
+                "log_level": "WARNING",
+            }, f)
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, os.path.join(ROOT, "app.py"), "--once", "-c", config_file],
+                                 capture_output=True)
+        wall_sec = time.perf_counter() - start
+    if process.returncode not in (0, 2):
+        sys.stderr.write(process.stderr.decode(errors="replace"))
+    return {
+        "wall_sec": round(wall_sec, 4),
+        "exit_code": process.returncode,
+        "updated": 0,
+        "added": 0,
+        "removed": 0,
+        "failed": 0,
+        # The only child of this worker process
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+
+
+def run(mock: MockTrueNAS, scenario: str, size: int, args: argparse.Namespace) -> dict:
+    state = SCENARIOS[scenario](size)
+    control(mock.host, "POST", "/_mock/reset", dict(state, latency=args.latency, error_rate=args.error_rate,
+                                                      capacity=args.capacity, seed=0))
+    options = {"concurrency": args.concurrency, "stream": args.stream, "bulk_size": args.bulk_size,
+               "compression": not args.no_compression, "page_size": args.page_size}
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        result = executor.submit(run_app_once if scenario == "once" else run_cycle, mock.host, options).result()
+    stats = control(mock.host, "GET", "/_mock/stats")
+    return dict(
+        scenario=scenario,
+        datasets=size,
+        requests=stats["requests"],
+        throttled=stats["throttled"],
+        bytes_in=stats["bytes_in"],
+        bytes_out=stats["bytes_out"],
+        **result
+    )
+
+
+def revision() -> str:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_results(results: list[dict], previous: dict = None):
+    print(f"{'scenario':<10} {'datasets':>8} {'wall ms':>10} {'requests':>9} {'bytes in':>12} {'bytes out':>12} "
+          f"{'peak MB':>8} {'added':>7} {'removed':>7} {'updated':>7} {'failed':>6} {'429s':>6} {'exit':>4}")
+    for result in results:
+        print(f"{result['scenario']:<10} {result['datasets']:>8} {result['wall_sec'] * 1000:>10.1f} "
+              f"{result['requests']:>9} {result['bytes_in']:>12} {result['bytes_out']:>12} "
+              f"{result['peak_rss_mb']:>8.1f} {result['added']:>7} {result['removed']:>7} {result['updated']:>7} "
+              f"{result['failed']:>6} {result.get('throttled', 0):>6} {result.get('exit_code', ''):>4}")
+        old = (previous or {}).get((result["scenario"], result["datasets"]))
+        if old is not None:
+            deltas = []
+            for metric in METRICS:
+                if old.get(metric):
+                    deltas.append(f"{metric} {(result[metric] - old[metric]) / old[metric] * 100:+.1f}%")
+            print(f"{'':<10} {'':>8} vs previous: {', '.join(deltas)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconcile benchmark against a mock TrueNAS API")
+    parser.add_argument("--sizes", default="100,10000,100000", help="Comma-separated dataset counts")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS.keys()))
+    parser.add_argument("--latency", type=float, default=0, help="Delay of every API request, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of API requests failing with a 500")
+    parser.add_argument("--capacity", type=float, default=0,
+                        help="Requests per second the mock serves before answering 429")
+    parser.add_argument("--concurrency", type=int, default=4, help="apply_concurrency of the client")
+    parser.add_argument("--stream", action="store_true", help="Use streaming listings")
+    parser.add_argument("--no-compression", action="store_true", help="Don't ask for gzip responses")
+    parser.add_argument("--bulk-size", type=int, default=0, help="Apply through core.bulk jobs of this many items")
+    parser.add_argument("--page-size", type=int, default=0, help="Reconcile through the paged pipeline, N items per page")
+    parser.add_argument("--output", help="Save the results to this JSON file")
+    parser.add_argument("--compare", help="Compare with the results saved in this JSON file")
+    args = parser.parse_args()
+
+    previous = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            saved = json.load(f)
+        previous = {(result["scenario"], result["datasets"]): result for result in saved["results"]}
+        print(f"Comparing with {args.compare} ({saved['meta']['revision']})")
+
+    mock = MockTrueNAS().start()
+    results = []
+    try:
+        for size in [int(size) for size in args.sizes.split(",")]:
+            for scenario in args.scenarios.split(","):
+                results.append(run(mock, scenario, size, args))
+    finally:
+        mock.stop()
+    print_results(results, previous)
+
+    if args.output:
+        meta = {
+            "revision": revision(),
+            "python": platform.python_version(),
+            "latency": args.latency,
+            "error_rate": args.error_rate,
+            "capacity": args.capacity,
+            "concurrency": args.concurrency,
+            "stream": args.stream,
+            "bulk_size": args.bulk_size,
+            "compression": not args.no_compression,
+            "page_size": args.page_size,
+        }
+        with open(args.output, "w") as f:
+            # One result per line, so two runs diff line by line
+            f.write('{"meta": ' + json.dumps(meta, sort_keys=True) + ',\n "results": [\n')
+            f.write(",\n".join("  " + json.dumps(result, sort_keys=True) for result in results))
+            f.write("\n]}\n")
+        print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
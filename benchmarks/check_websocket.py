@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Checks of the WebSocket transport against the local stand-in (mock_websocket.py):
+
+    multiplexing   concurrent calls on one connection, answered out of order, each get
+                   their own result
+    errors         a JSON-RPC error is raised as ErrRpc, with its code, and leaves the
+                   connection usable
+    reconnect      a dropped connection fails the calls in flight with ErrWebSocketClosed,
+                   and the next TrueNAS.call logs in again on a new one
+    concurrent     after a drop, parallel callers reconnect once and all their calls succeed
+    reconcile      a full reconcile cycle over the websocket transport
+
+    python benchmarks/check_websocket.py
+"""
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mock_truenas import PARENT, NETWORKS  # noqa: E402
+from mock_websocket import MockWebSocketTrueNAS  # noqa: E402
+from src.TrueNAS import TrueNAS, NfsParent, NfsShareAdd, TRANSPORT_WEBSOCKET  # noqa: E402
+from src.WebSocket import JsonRpcClient, ErrRpc, ErrWebSocketClosed  # noqa: E402
+
+
+def check(name: str, condition: bool, detail: str = ""):
+    print(f"{'ok' if condition else 'FAILED':<7} {name} {detail}")
+    if not condition:
+        raise SystemExit(1)
+
+
+def check_multiplexing(mock: MockWebSocketTrueNAS):
+    with JsonRpcClient(mock.host, verify_ssl=False) as rpc:
+        answered = len(mock.server.answered)
+        # Later calls sleep less, so they are answered first
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            futures = [executor.submit(rpc.call, "test.sleep", (32 - i) * 0.005, i) for i in range(32)]
+            results = [future.result() for future in futures]
+        order = mock.server.answered[answered:]
+        check("multiplexing", results == list(range(32)), "every call got its own result")
+        check("out of order", order != sorted(order), f"answer order {order[:8]}...")
+        check("one connection", rpc.handshakes == 1 and mock.server.connections == 1)
+
+
+def check_errors(mock: MockWebSocketTrueNAS):
+    with JsonRpcClient(mock.host, verify_ssl=False) as rpc:
+        try:
+            rpc.call("no.such.method")
+            check("ErrRpc", False, "no error raised")
+        except ErrRpc as e:
+            check("ErrRpc", e.code == -32601, f"code {e.code}")
+        try:
+            rpc.call("sharing.nfs.get_instance", 999999)
+            check("ErrRpc data", False, "no error raised")
+        except ErrRpc as e:
+            check("ErrRpc data", e.code == -32001 and "999999" in e.data["reason"], f"data {e.data}")
+        check("usable after an error", rpc.call("test.sleep", 0, "pong") == "pong")
+
+
+def check_reconnect(mock: MockWebSocketTrueNAS):
+    truenas = TrueNAS(host=mock.host, api_key="check", verify_ssl=False, transport=TRANSPORT_WEBSOCKET)
+    with truenas:
+        rpc = truenas.rpc
+        pending = rpc.call_async("test.sleep", 1, "late")
+        try:
+            rpc.call("test.drop", timeout=5)
+            check("drop fails the caller", False, "no error raised")
+        except ErrWebSocketClosed:
+            check("drop fails the caller", True)
+        try:
+            pending.result(timeout=5)
+            check("drop fails the calls in flight", False, "no error raised")
+        except ErrWebSocketClosed:
+            check("drop fails the calls in flight", True)
+        check("reconnect", truenas.call("test.sleep", 0, "again") == "again",
+              f"handshakes {truenas.rpc.handshakes}")
+        check("logged in again", truenas.rpc.handshakes == 2)
+
+
+def check_concurrent_reconnect(mock: MockWebSocketTrueNAS, trials: int = 5):
+    truenas = TrueNAS(host=mock.host, api_key="check", verify_ssl=False, transport=TRANSPORT_WEBSOCKET,
+                      apply_concurrency=8)
+    with truenas:
+        for trial in range(trials):
+            rpc = truenas.rpc
+            handshakes = rpc.handshakes
+            rpc.call_async("test.drop")
+            deadline = time.monotonic() + 5
+            while not rpc.closed and time.monotonic() < deadline:
+                time.sleep(0.01)
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                futures = [executor.submit(truenas.call, "test.sleep", 0.01, i) for i in range(16)]
+                errors = []
+                for future in futures:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        errors.append(repr(e))
+            check(f"concurrent reconnect {trial + 1}", not errors and rpc.handshakes == handshakes + 1,
+                  f"{rpc.handshakes - handshakes} handshakes, {len(errors)} failed {errors[:2]}")
+        check("no throttling", truenas.limiter.throttled == 0, f"throttled {truenas.limiter.throttled}")
+
+
+def check_reconcile(mock: MockWebSocketTrueNAS):
+    mock.state.reset(datasets=200, shares=100, stale=20, drifted=10)
+    parent = NfsParent(dataset_id=PARENT, common_config=NfsShareAdd(networks=NETWORKS))
+    for page_size in (0, 50):
+        truenas = TrueNAS(host=mock.host, api_key="check", verify_ssl=False, transport=TRANSPORT_WEBSOCKET,
+                          page_size=page_size)
+        with truenas:
+            nfs_modify = truenas.update_nfs_shares([parent])[PARENT]
+            converged = truenas.update_nfs_shares([parent])[PARENT]
+        check(f"reconcile, page_size {page_size}",
+              not nfs_modify.failed and converged.applied == 0 and len(mock.state.shares) == 200,
+              f"{len(nfs_modify.add)} added, {len(nfs_modify.remove)} removed, {len(nfs_modify.update)} updated")
+        mock.state.reset(datasets=200, shares=100, stale=20, drifted=10)
+
+
+def main():
+    mock = MockWebSocketTrueNAS().start()
+    try:
+        check_multiplexing(mock)
+        check_errors(mock)
+        check_reconnect(mock)
+        check_concurrent_reconnect(mock)
+        check_reconcile(mock)
+    finally:
+        mock.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+"""
+A local mock of the TrueNAS REST API, enough of it to run the reconcile loop:
+
+    GET    /api/v2.0/pool/dataset                 query-filters / query-options
+    GET    /api/v2.0/pool/dataset/id/{id}         the dataset and its children
+    GET    /api/v2.0/sharing/nfs                  query-filters / query-options
+    POST   /api/v2.0/sharing/nfs
+    GET    /api/v2.0/sharing/nfs/id/{id}
+    PUT    /api/v2.0/sharing/nfs/id/{id}
+    DELETE /api/v2.0/sharing/nfs/id/{id}
+    POST   /api/v2.0/core/bulk                    runs sharing.nfs.create/update/delete as a job
+    GET    /api/v2.0/core/get_jobs                query-filters
+
+The state is N datasets under data/home, the first M of them shared with NETWORKS (the first
+D of them with other networks instead, as if edited by hand), plus K stale shares without a dataset. Every request can be delayed and can fail with a 500 at a given rate,
+and every item of a core.bulk job can fail at the same rate. With a capacity, requests beyond
+that many per second are answered with a 429, like an overloaded middleware. Responses are
+gzip-compressed (level 1, to keep the mock off the critical path) when the client accepts it.
+Two control endpoints, outside of the API, drive the benchmarks:
+
+    POST   /_mock/reset   {"datasets", "shares", "stale", "drifted", "latency", "error_rate", "capacity", "seed"}
+    GET    /_mock/stats   request count and bytes since the last reset
+
+    python benchmarks/mock_truenas.py [--port 8443] [--datasets 1000] [--shares 500]
+"""
+from __future__ import annotations
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import gzip
+import json
+import os
+import random
+import re
+import ssl
+import threading
+import time
+import urllib.parse
+
+
+CERT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_cert.pem")
+PARENT = "data/home"
+PREFIX = "/api/v2.0"
+NETWORKS = ["10.0.0.0/8"]
+
+
+def _field_test(name: str, op: str, value):
+    if op == "=":
+        return lambda item: item.get(name) == value
+    if op == "!=":
+        return lambda item: item.get(name) != value
+    if op in (">", ">=", "<", "<="):
+        compare = {">": lambda a, b: a > b, ">=": lambda a, b: a >= b,
+                   "<": lambda a, b: a < b, "<=": lambda a, b: a <= b}[op]
+        return lambda item: item.get(name) is not None and compare(item.get(name), value)
+    if op == "^":
+        return lambda item: str(item.get(name, "")).startswith(value)
+    if op == "$":
+        return lambda item: str(item.get(name, "")).endswith(value)
+    if op == "~":
+        pattern = re.compile(value)
+        return lambda item: pattern.search(str(item.get(name, ""))) is not None
+    if op in ("in", "nin"):
+        values = set(value)
+        if op == "in":
+            return lambda item: item.get(name) in values
+        return lambda item: item.get(name) not in values
+    raise ValueError(f"Unsupported query operator {op}")
+
+
+def compile_filters(filters: list) -> callable:
+    """
+    The predicate of a list of query-filters, ANDed, with ["OR", [...]] groups
+    """
+    tests = []
+    for query_filter in filters:
+        if query_filter[0] == "OR":
+            branches = [compile_filters(branch if isinstance(branch[0], list) else [branch])
+                        for branch in query_filter[1]]
+            tests.append(lambda item, branches=branches: any(branch(item) for branch in branches))
+        else:
+            tests.append(_field_test(*query_filter))
+    return lambda item: all(test(item) for test in tests)
+
+
+def query(items, body: dict):
+    filters = body.get("query-filters") or []
+    options = body.get("query-options") or {}
+    if filters:
+        predicate = compile_filters(filters)
+        items = [item for item in items if predicate(item)]
+    else:
+        items = list(items)
+    for key in reversed(options.get("order_by") or []):
+        reverse = key.startswith("-")
+        items.sort(key=lambda item: item.get(key.lstrip("-")), reverse=reverse)
+    if options.get("count"):
+        return len(items)
+    offset = options.get("offset") or 0
+    limit = options.get("limit") or 0
+    if offset or limit:
+        items = items[offset:offset + limit if limit else None]
+    if options.get("select"):
+        select = options["select"]
+        items = [{key: item[key] for key in select if key in item} for item in items]
+    if options.get("get"):
+        return items[0] if items else None
+    return items
+
+
+class MockState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, datasets: int = 0, shares: int = 0, stale: int = 0, drifted: int = 0, latency: float = 0,
+              error_rate: float = 0, capacity: float = 0, seed: int = 0, **_):
+        with self.lock:
+            self.latency = latency
+            self.error_rate = error_rate
+            self.capacity = capacity
+            self.served: deque[float] = deque()
+            self.random = random.Random(seed)
+            self.datasets: dict[str, dict] = {}
+            for i in range(datasets):
+                dataset_id = f"{PARENT}/user{i}"
+                self.datasets[dataset_id] = {"id": dataset_id, "name": dataset_id, "pool": "data",
+                                             "type": "FILESYSTEM", "children": []}
+            self.shares: dict[int, dict] = {}
+            self.jobs: dict[int, dict] = {}
+            self.next_id = 1
+            for i in range(min(shares, datasets)):
+                networks = ["192.168.0.0/16"] if i < drifted else NETWORKS
+                self.add_share({"path": f"/mnt/{PARENT}/user{i}", "networks": networks, "hosts": []})
+            for i in range(stale):
+                self.add_share({"path": f"/mnt/{PARENT}/stale{i}", "networks": NETWORKS, "hosts": []})
+            self.requests = 0
+            self.errors = 0
+            self.throttled = 0
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.methods: dict[str, int] = {}
+
+    def add_share(self, data: dict) -> dict:
+        share = {"id": self.next_id, "aliases": [], "comment": "", "networks": [], "hosts": [], "ro": False,
+                 "maproot_user": None, "maproot_group": None, "mapall_user": None, "mapall_group": None,
+                 "security": [], "enabled": True, "locked": False}
+        share.update(data)
+        share["id"] = self.next_id
+        self.shares[self.next_id] = share
+        self.next_id += 1
+        return share
+
+    def call(self, method: str, params: list):
+        """
+        One middleware call of a core.bulk job, with the lock held
+        """
+        if self.error_rate > 0 and self.random.random() < self.error_rate:
+            raise ValueError("Injected error")
+        if method == "sharing.nfs.create":
+            return self.add_share(params[0])
+        share = self.shares.get(params[0])
+        if share is None:
+            raise ValueError(f"Share {params[0]} not found")
+        if method == "sharing.nfs.update":
+            share.update({key: value for key, value in params[1].items() if key != "id"})
+            return share
+        if method == "sharing.nfs.delete":
+            del self.shares[params[0]]
+            return True
+        raise ValueError(f"Unsupported method {method}")
+
+    def run_job(self, job: dict, method: str, params_list: list):
+        results = []
+        for params in params_list:
+            with self.lock:
+                try:
+                    results.append({"result": self.call(method, params), "error": None})
+                except (ValueError, KeyError, TypeError, IndexError) as e:
+                    results.append({"result": None, "error": str(e)})
+        job["result"] = results
+        job["state"] = "SUCCESS"
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "throttled": self.throttled,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "methods": self.methods,
+            "datasets": len(self.datasets),
+            "shares": len(self.shares),
+        }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, don't let Nagle hold the body back
+    disable_nagle_algorithm = True
+    state: MockState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send(self, status: int, obj, count: bool = True):
+        data = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if len(data) > 1024 and "gzip" in (self.headers.get("Accept-Encoding") or ""):
+            data = gzip.compress(data, compresslevel=1)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        if count:
+            with self.state.lock:
+                self.state.bytes_out += len(data)
+
+    def _handle(self, method: str):
+        raw = self._body()
+        path = self.path
+        if path.startswith("/_mock/"):
+            return self._control(method, path, raw)
+        state = self.state
+        with state.lock:
+            state.requests += 1
+            state.bytes_in += len(raw)
+            state.methods[method] = state.methods.get(method, 0) + 1
+            fail = state.error_rate > 0 and state.random.random() < state.error_rate
+            if fail:
+                state.errors += 1
+            busy = False
+            if state.capacity > 0:
+                now = time.monotonic()
+                while state.served and state.served[0] <= now - 1:
+                    state.served.popleft()
+                busy = len(state.served) >= state.capacity
+                if busy:
+                    state.throttled += 1
+                else:
+                    state.served.append(now)
+        if busy:
+            return self._send(429, {"message": "Too many requests"})
+        if state.latency:
+            time.sleep(state.latency)
+        if fail:
+            return self._send(500, {"message": "Injected error"})
+        body = json.loads(raw) if raw else {}
+        if not path.startswith(PREFIX):
+            return self._send(404, {"message": f"Not found {path}"})
+        route = path[len(PREFIX):].split("?", 1)[0]
+        try:
+            status, result = self._route(method, route, body)
+        except (ValueError, KeyError, TypeError) as e:
+            status, result = 422, {"message": str(e)}
+        self._send(status, result)
+
+    def _route(self, method: str, route: str, body) -> tuple[int, object]:
+        state = self.state
+        if route == "/pool/dataset" and method == "GET":
+            with state.lock:
+                items = list(state.datasets.values())
+            return 200, query(items, body)
+        if route.startswith("/pool/dataset/id/") and method == "GET":
+            dataset_id = urllib.parse.unquote(route[len("/pool/dataset/id/"):])
+            with state.lock:
+                if dataset_id == PARENT:
+                    children = list(state.datasets.values())
+                    return 200, {"id": PARENT, "name": PARENT, "pool": "data", "type": "FILESYSTEM",
+                                 "children": children}
+                dataset = state.datasets.get(dataset_id)
+            return (200, dataset) if dataset else (404, {"message": f"Dataset {dataset_id} not found"})
+        if route == "/core/bulk" and method == "POST":
+            with state.lock:
+                job = {"id": len(state.jobs) + 1, "method": "core.bulk", "state": "RUNNING", "result": None,
+                       "error": None}
+                state.jobs[job["id"]] = job
+            threading.Thread(target=state.run_job, args=(job, body["method"], body["params"]), daemon=True).start()
+            return 200, job["id"]
+        if route == "/core/get_jobs" and method == "GET":
+            with state.lock:
+                items = list(state.jobs.values())
+            return 200, query(items, body)
+        if route == "/sharing/nfs":
+            with state.lock:
+                if method == "POST":
+                    return 200, state.add_share(body)
+                items = list(state.shares.values())
+            if method == "GET":
+                return 200, query(items, body)
+        if route.startswith("/sharing/nfs/id/"):
+            share_id = int(route[len("/sharing/nfs/id/"):])
+            with state.lock:
+                share = state.shares.get(share_id)
+                if share is None:
+                    return 404, {"message": f"Share {share_id} not found"}
+                if method == "GET":
+                    return 200, share
+                if method == "PUT":
+                    share.update({key: value for key, value in body.items() if key != "id"})
+                    return 200, share
+                if method == "DELETE":
+                    del state.shares[share_id]
+                    return 200, True
+        return 405, {"message": f"{method} {route} not supported"}
+
+    def _control(self, method: str, path: str, raw: bytes):
+        if path == "/_mock/reset" and method == "POST":
+            self.state.reset(**(json.loads(raw) if raw else {}))
+            return self._send(200, self.state.stats, count=False)
+        if path == "/_mock/stats" and method == "GET":
+            with self.state.lock:
+                stats = self.state.stats
+            return self._send(200, stats, count=False)
+        self._send(404, {"message": f"Not found {path}"}, count=False)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+class MockTrueNAS:
+    """
+    The mock server, serving HTTPS on 127.0.0.1 from a background thread
+    """
+
+    def __init__(self, port: int = 0, cert_file: str = CERT_FILE):
+        self.state = MockState()
+        handler = type("BoundHandler", (Handler,), {"state": self.state})
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+        self.server.daemon_threads = True
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert_file)
+        self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+        self.__thread: threading.Thread = None
+
+    @property
+    def host(self) -> str:
+        return f"127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self) -> MockTrueNAS:
+        self.__thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock TrueNAS API")
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--datasets", type=int, default=1000)
+    parser.add_argument("--shares", type=int, default=500)
+    parser.add_argument("--stale", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0, help="Delay of every request, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of requests failing with a 500")
+    parser.add_argument("--capacity", type=float, default=0, help="Requests per second served before 429s")
+    args = parser.parse_args()
+    mock = MockTrueNAS(port=args.port)
+    mock.state.reset(datasets=args.datasets, shares=args.shares, stale=args.stale,
+                     latency=args.latency, error_rate=args.error_rate, capacity=args.capacity)
+    print(f"Mock TrueNAS on https://{mock.host}{PREFIX}, parent dataset {PARENT}")
+    mock.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+A local stand-in for the TrueNAS JSON-RPC 2.0 WebSocket API (/api/current), over TLS with the
+self-signed mock_cert.pem, sharing the state of the REST mock (mock_truenas.MockState):
+
+    auth.login_with_api_key            true for any key
+    pool.dataset.query                 query-filters / query-options
+    sharing.nfs.query                  query-filters / query-options
+    sharing.nfs.get_instance
+    sharing.nfs.create / update / delete
+    core.subscribe                     accepted, no events are sent
+
+Every call is answered from its own thread, after a random delay of up to `jitter` seconds, so
+the answers of concurrent calls come back out of order. Two test methods drive the edge cases:
+
+    test.sleep [seconds, value]        answers value after seconds
+    test.drop                          closes the connection without answering
+
+An unknown method is answered with a JSON-RPC error, as is a call the state rejects.
+
+    python benchmarks/mock_websocket.py [--port 8444] [--datasets 1000] [--shares 500]
+"""
+from __future__ import annotations
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import socket
+import socketserver
+import ssl
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mock_truenas import CERT_FILE, PARENT, MockState, query  # noqa: E402
+
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WS_PATH = "/api/current"
+
+
+class ErrMethod(Exception):
+    pass
+
+
+def _frame(opcode: int, payload: bytes) -> bytes:
+    """
+    A server frame, unmasked
+    """
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < (1 << 16):
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+
+class Handler(socketserver.StreamRequestHandler):
+    server: Server
+
+    def setup(self):
+        super().setup()
+        self.send_lock = threading.Lock()
+        self.closed = False
+
+    def send(self, opcode: int, payload: bytes):
+        with self.send_lock:
+            if self.closed:
+                return
+            try:
+                self.wfile.write(_frame(opcode, payload))
+                self.wfile.flush()
+            except OSError:
+                self.closed = True
+
+    def drop(self):
+        with self.send_lock:
+            self.closed = True
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def handshake(self) -> bool:
+        request_line = self.rfile.readline().decode(errors="replace")
+        headers = {}
+        while True:
+            line = self.rfile.readline().decode(errors="replace").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        parts = request_line.split()
+        if len(parts) < 2 or parts[1] != WS_PATH or headers.get("upgrade", "").lower() != "websocket":
+            self.wfile.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+            return False
+        accept = base64.b64encode(hashlib.sha1((headers["sec-websocket-key"] + WS_GUID).encode()).digest()).decode()
+        self.wfile.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                          f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+        self.wfile.flush()
+        return True
+
+    def read_frame(self) -> tuple[bool, int, bytes] | None:
+        header = self.rfile.read(2)
+        if len(header) < 2:
+            return None
+        fin, opcode = bool(header[0] & 0x80), header[0] & 0x0F
+        length = header[1] & 0x7F
+        if length == 126:
+            length = struct.unpack("!H", self.rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", self.rfile.read(8))[0]
+        key = self.rfile.read(4) if header[1] & 0x80 else b"\0\0\0\0"
+        payload = bytearray(self.rfile.read(length))
+        for i in range(len(payload)):
+            payload[i] ^= key[i % 4]
+        return fin, opcode, bytes(payload)
+
+    def handle(self):
+        if not self.handshake():
+            return
+        with self.server.lock:
+            self.server.connections += 1
+        fragments: list[bytes] = []
+        while not self.closed:
+            try:
+                frame = self.read_frame()
+            except OSError:
+                return
+            if frame is None:
+                return
+            fin, opcode, payload = frame
+            if opcode == 0x8:
+                self.send(0x8, payload[:2])
+                return
+            if opcode == 0x9:
+                self.send(0xA, payload)
+                continue
+            if opcode not in (0x0, 0x1):
+                continue
+            fragments.append(payload)
+            if fin:
+                message = json.loads(b"".join(fragments))
+                fragments = []
+                threading.Thread(target=self.answer, args=(message,), daemon=True).start()
+
+    def answer(self, message: dict):
+        server = self.server
+        if server.jitter:
+            time.sleep(random.random() * server.jitter)
+        method, params = message.get("method"), message.get("params") or []
+        if method == "test.drop":
+            self.drop()
+            return
+        response = {"jsonrpc": "2.0", "id": message.get("id")}
+        try:
+            response["result"] = server.call(method, params)
+        except ErrMethod as e:
+            response["error"] = {"code": -32601, "message": str(e)}
+        except (ValueError, KeyError, TypeError, IndexError) as e:
+            response["error"] = {"code": -32001, "message": "Method call error", "data": {"reason": str(e)}}
+        with server.lock:
+            server.answered.append(message.get("id"))
+        self.send(0x1, json.dumps(response).encode())
+
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, state: MockState, jitter: float, cert_file: str):
+        super().__init__(address, Handler)
+        self.state = state
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.connections = 0
+        # Ids of the calls in the order they were answered, over all connections
+        self.answered: list[int] = []
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.load_cert_chain(cert_file)
+
+    def get_request(self):
+        sock, address = super().get_request()
+        return self.context.wrap_socket(sock, server_side=True), address
+
+    def call(self, method: str, params: list):
+        state = self.state
+        if method == "auth.login_with_api_key" or method == "core.subscribe":
+            return True
+        if method == "test.sleep":
+            time.sleep(params[0])
+            return params[1]
+        if method in ("pool.dataset.query", "sharing.nfs.query"):
+            with state.lock:
+                state.requests += 1
+                items = list((state.datasets if method == "pool.dataset.query" else state.shares).values())
+            return query(items, {"query-filters": params[0] if params else [],
+                                 "query-options": params[1] if len(params) > 1 else {}})
+        if method == "sharing.nfs.get_instance":
+            with state.lock:
+                share = state.shares.get(params[0])
+            if share is None:
+                raise ValueError(f"Share {params[0]} not found")
+            return share
+        if method in ("sharing.nfs.create", "sharing.nfs.update", "sharing.nfs.delete"):
+            with state.lock:
+                state.requests += 1
+                return state.call(method, params)
+        raise ErrMethod(f"Method {method} not found")
+
+
+class MockWebSocketTrueNAS:
+    """
+    The stand-in server, serving WSS on 127.0.0.1 from a background thread
+    """
+
+    def __init__(self, port: int = 0, state: MockState = None, jitter: float = 0.02, cert_file: str = CERT_FILE):
+        self.state = state if state is not None else MockState()
+        self.server = Server(("127.0.0.1", port), self.state, jitter, cert_file)
+        self.__thread: threading.Thread = None
+
+    @property
+    def host(self) -> str:
+        return f"127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self) -> MockWebSocketTrueNAS:
+        self.__thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock TrueNAS WebSocket API")
+    parser.add_argument("--port", type=int, default=8444)
+    parser.add_argument("--datasets", type=int, default=1000)
+    parser.add_argument("--shares", type=int, default=500)
+    parser.add_argument("--jitter", type=float, default=0.02, help="Largest random delay of an answer, in seconds")
+    args = parser.parse_args()
+    mock = MockWebSocketTrueNAS(port=args.port, jitter=args.jitter)
+    mock.state.reset(datasets=args.datasets, shares=args.shares)
+    print(f"Mock TrueNAS on wss://{mock.host}{WS_PATH}, parent dataset {PARENT}")
+    mock.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+from __future__ import annotations
+from typing import Iterable
+import hashlib
+import threading
+
+
+def fingerprint(keys: Iterable[str]) -> str:
+    """
+    Order-independent fingerprint of a set of strings: the item count plus the sum of
+    the 64-bit BLAKE2b digest of each item. Linear in the number of items (no sort)
+    and stable across processes, so it can be stored.
+    Args:
+        keys: The strings to fingerprint, each counted once
+    Returns:
+        str
+    """
+    count = 0
+    total = 0
+    for key in keys:
+        total += int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+        count += 1
+    return f"{count}:{total & 0xFFFFFFFFFFFFFFFF:016x}"
+
+
+class ReconcileCache:
+    """
+    Remembers the fingerprints of the dataset and share sets observed at the last
+    converged reconcile of each parent. When the next cycle observes the same
+    fingerprints the diff and apply stages can be skipped.
+    """
+
+    def __init__(self):
+        self.__data: dict[str, tuple[str, ...]] = {}
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.__data)
+
+    @property
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.__data)}
+
+    def matches(self, key: str, fingerprints: tuple[str, ...]) -> bool:
+        with self.__lock:
+            hit = self.__data.get(key) == fingerprints
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return hit
+
+    def store(self, key: str, fingerprints: tuple[str, ...]):
+        with self.__lock:
+            self.__data[key] = fingerprints
+
+    def invalidate(self, key: str = None):
+        with self.__lock:
+            if key is None:
+                self.__data.clear()
+            else:
+                self.__data.pop(key, None)
+
+    def dump(self) -> dict[str, list[str]]:
+        """
+        The cached fingerprints, as plain data for the state file
+        """
+        with self.__lock:
+            return {key: list(fingerprints) for key, fingerprints in self.__data.items()}
+
+    def load(self, data: dict[str, list[str]]):
+        with self.__lock:
+            self.__data.update({key: tuple(fingerprints) for key, fingerprints in data.items()})
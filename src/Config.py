@@ -1,10 +1,13 @@
 
 from __future__ import annotations
-from dataclasses import dataclass, field
-from .TrueNAS import NfsShareAdd
+from dataclasses import dataclass, field, fields, replace
+from .TrueNAS import NfsShareAdd, NfsParent
+from .Filter import FilterEngine
+from .Scheduler import Scheduler
 import os
 import logging
 import json
+import re
 
 
 def get_env(env_name: str, default: str = "") -> str:
@@ -61,6 +64,31 @@ def get_env_int(env_name: str, default: int = 0) -> int:
         return default
 
 
+def get_env_float(env_name: str, default: float = 0) -> float:
+    """
+    Get the environment variable as a float.
+    Args:
+        env_name: The name of the environment variable.
+        default: Default value if the environment variable is not found.
+    Returns:
+        The float value of the environment variable or the default value.
+    """
+    env_value = os.environ.get(env_name, "")
+    try:
+        return float(env_value) if env_value else default
+    except ValueError:
+        return default
+
+
+# Settings a config reload applies by building a new TrueNAS client
+CLIENT_FIELDS = ("host", "api_key", "ssl_verify", "dry_run", "apply_concurrency", "bulk_size", "rate_limit",
+                 "latency_target_sec", "compression", "transport", "stream_listings", "page_size")
+# Settings only read at startup, a reload keeps their old value
+RESTART_FIELDS = ("watch", "full_resync_sec", "fleet", "fleet_concurrency", "host_timeout_sec", "metrics_port",
+                  "metrics_addr", "state_file", "config_reload", "config_poll_sec", "trace_file", "profile_file")
+SCHEDULER_FIELDS = ("check_period_sec", "check_period_min_sec", "check_period_max_sec")
+
+
 @dataclass
 class Config:
     host: str = ""
@@ -72,19 +100,158 @@ class Config:
     filter_path_mode: str = "end_with"
     filter_path_reversed: bool = True
     check_period_sec: int = 600
+    check_period_min_sec: int = 60
+    check_period_max_sec: int = 3600
     dry_run: bool = False
     log_level: int = logging.INFO
     nfs_common_networks: list[str] = field(default_factory=list)
     nfs_common_hosts: list[str] = field(default_factory=list)
     nfs_auto_remove: bool = True
+    nfs_fix_drift: bool = True
+    apply_concurrency: int = 4
+    bulk_size: int = 0
+    rate_limit: float = 0
+    latency_target_sec: float = 2
+    compression: bool = True
+    transport: str = "rest"
+    watch: bool = False
+    full_resync_sec: int = 3600
+    stream_listings: bool = False
+    page_size: int = 0
+    filter_rules: list[dict] = field(default_factory=list)
+    parents: list[dict] = field(default_factory=list)
+    fleet: list[dict] = field(default_factory=list)
+    fleet_concurrency: int = 4
+    host_timeout_sec: int = 300
+    metrics_port: int = 0
+    metrics_addr: str = "0.0.0.0"
+    state_file: str = ""
+    config_reload: bool = True
+    config_poll_sec: int = 5
+    trace_file: str = ""
+    profile_file: str = ""
 
     @property
     def nfs_common(self) -> NfsShareAdd:
         return NfsShareAdd(networks=self.nfs_common_networks,hosts=self.nfs_common_hosts)
 
+    @property
+    def scheduler(self) -> Scheduler:
+        return Scheduler(
+            period_sec=self.check_period_sec,
+            min_sec=self.check_period_min_sec,
+            max_sec=self.check_period_max_sec
+        )
+
+    @property
+    def filter_engine(self) -> FilterEngine:
+        """
+        The compiled path filter: filter_rules if set, otherwise the single filter_path_* rule
+        """
+        if self.filter_rules:
+            return FilterEngine(self.filter_rules)
+        return FilterEngine.new_from_legacy(
+            pattern=self.filter_path_pattern,
+            mode=self.filter_path_mode,
+            reversed=self.filter_path_reversed
+        )
+
+    @property
+    def nfs_parents(self) -> list[NfsParent]:
+        """
+        The parent datasets to reconcile: every entry of parents, falling back to the global
+        settings for the keys it doesn't set, or the single parent_dataset_id if parents is empty
+        """
+        entries = self.parents or [{"parent_dataset_id": self.parent_dataset_id}]
+        nfs_parents = []
+        for entry in entries:
+            filter_rules = entry.get("filter_rules")
+            networks = entry.get("nfs_common_networks", self.nfs_common_networks)
+            hosts = entry.get("nfs_common_hosts", self.nfs_common_hosts)
+            nfs_parents.append(NfsParent(
+                dataset_id=entry["parent_dataset_id"],
+                real_path=entry.get("parent_real_path", self.parent_real_path),
+                common_config=NfsShareAdd(networks=networks, hosts=hosts),
+                filter_rules=FilterEngine(filter_rules) if filter_rules else self.filter_engine,
+                remove=entry.get("nfs_auto_remove", self.nfs_auto_remove),
+                fix_drift=entry.get("nfs_fix_drift", self.nfs_fix_drift)
+            ))
+        return nfs_parents
+
+    @property
+    def fleet_configs(self) -> list[Config]:
+        """
+        One Config per host of the fleet: every entry overrides the settings it sets, the
+        others come from this Config. An entry may give api_key_file instead of api_key.
+        Without its own state_file, each host gets one next to the global state_file.
+        """
+        names = set(f.name for f in fields(self)) - {"fleet"}
+        configs = []
+        for entry in self.fleet:
+            entry = dict(entry)
+            api_key_file = entry.pop("api_key_file", None)
+            if api_key_file:
+                with open(api_key_file, "r") as f:
+                    entry["api_key"] = f.read().strip()
+            unknown = set(entry.keys()) - names
+            if unknown:
+                raise ValueError(f"Unknown fleet settings {sorted(unknown)} for host {entry.get('host')}")
+            config = replace(self, fleet=[], **entry)
+            if self.state_file and "state_file" not in entry:
+                root, ext = os.path.splitext(self.state_file)
+                config.state_file = f"{root}.{config.host.replace(':', '_')}{ext}"
+            if not config.host or not config.api_key:
+                raise ValueError(f"Fleet entry {entry.get('host')} needs a host and an api_key")
+            if any(config.host == other.host for other in configs):
+                raise ValueError(f"Host {config.host} is listed twice in the fleet")
+            configs.append(config)
+        return configs
+
+    def validate(self) -> Config:
+        """
+        Check the settings a reconcile depends on, building everything derived from them once
+        Raises:
+            ValueError: The first invalid setting found
+        """
+        if not self.fleet:
+            if not self.host:
+                raise ValueError("host is not set")
+            if not self.api_key:
+                raise ValueError("api_key is not set")
+            if not self.parent_dataset_id and not self.parents:
+                raise ValueError("parent_dataset_id is not set")
+        if self.transport not in ("rest", "websocket"):
+            raise ValueError(f"Invalid transport {self.transport}, expected 'rest' or 'websocket'")
+        if not isinstance(self.log_level, int) and not isinstance(logging.getLevelName(str(self.log_level).upper()), int):
+            raise ValueError(f"Invalid log_level {self.log_level}")
+        for name in SCHEDULER_FIELDS + ("apply_concurrency", "bulk_size", "rate_limit", "latency_target_sec",
+                                        "page_size"):
+            value = getattr(self, name)
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                raise ValueError(f"Invalid {name} {value!r}, expected a positive number")
+        try:
+            parents = self.nfs_parents
+            self.fleet_configs
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError(f"Invalid parents or fleet entry: {e!r}") from e
+        except re.error as e:
+            raise ValueError(f"Invalid filter rule: {e}") from e
+        dataset_ids = [parent.dataset_id for parent in parents]
+        if len(set(dataset_ids)) != len(dataset_ids):
+            raise ValueError("A parent dataset is listed twice")
+        return self
+
+    def changed_fields(self, other: Config) -> set[str]:
+        """
+        The names of the settings other has a different value for
+        """
+        return set(f.name for f in fields(self) if getattr(self, f.name) != getattr(other, f.name))
+
     def read_from_json_file(self, file_path: str) -> Config:
         with open(file_path, "r") as f:
             data = json.load(f)
+            if not isinstance(data, dict):
+                raise ValueError(f"Expected a JSON object in {file_path}, got {type(data).__name__}")
             for key in self.__dict__.keys():
                 if key in data:
                     self.__dict__[key] = data[key]
@@ -99,17 +266,20 @@ class Config:
         TRUENAS_HOST = get_env("TRUENAS_HOST", "")
         TRUENAS_API_KEY_FILE = get_env("TRUENAS_API_KEY_FILE")
         TRUENAS_PARENT_DATASET_ID = get_env("TRUENAS_PARENT_DATASET_ID", "")
+        fleet = get_env("TRUENAS_FLEET", "")
 
         if TRUENAS_API_KEY_FILE and os.path.exists(TRUENAS_API_KEY_FILE):
             with open(TRUENAS_API_KEY_FILE, "r") as f:
                 TRUENAS_API_KEY = f.read().strip()
         else:
             TRUENAS_API_KEY = get_env("TRUENAS_API_KEY", "")
-        if not TRUENAS_HOST:
+        # In fleet mode the host and the API key come from the fleet entries
+        if not TRUENAS_HOST and not fleet:
             raise ValueError("TRUENAS_HOST is not set")
-        if not TRUENAS_API_KEY:
+        if not TRUENAS_API_KEY and not fleet:
             raise ValueError("TRUENAS_API_KEY is not set")
-        if not TRUENAS_PARENT_DATASET_ID:
+        parents = get_env("TRUENAS_PARENTS", "")
+        if not TRUENAS_PARENT_DATASET_ID and not parents and not fleet:
             raise ValueError("TRUENAS_PARENT_DATASET_ID is not set")
 
         self.host = TRUENAS_HOST
@@ -121,12 +291,38 @@ class Config:
         self.filter_path_pattern = get_env("TRUENAS_FILTER_PATH_PATTERN", "_")
         self.filter_path_reversed = get_env_bool("TRUENAS_FILTER_PATH_REVERSED", True)
         self.check_period_sec = get_env_int("TRUENAS_CHECK_PERIOD_SEC", 600)
+        self.check_period_min_sec = get_env_int("TRUENAS_CHECK_PERIOD_MIN_SEC", 60)
+        self.check_period_max_sec = get_env_int("TRUENAS_CHECK_PERIOD_MAX_SEC", 3600)
         self.dry_run = get_env_bool("TRUENAS_DRY_RUN", False)
         self.nfs_common_networks = get_env_list("TRUENAS_NFS_COMMON_NETWORKS", [])
         self.nfs_common_hosts = get_env_list("TRUENAS_NFS_COMMON_HOSTS", [])
         log_level = get_env("TRUENAS_LOG_LEVEL", "INFO").upper()
         self.log_level = getattr(logging, log_level, logging.INFO)
         self.nfs_auto_remove = get_env_bool("TRUENAS_NFS_AUTO_REMOVE", True)
+        self.nfs_fix_drift = get_env_bool("TRUENAS_NFS_FIX_DRIFT", True)
+        self.apply_concurrency = get_env_int("TRUENAS_APPLY_CONCURRENCY", 4)
+        self.bulk_size = get_env_int("TRUENAS_BULK_SIZE", 0)
+        self.rate_limit = get_env_float("TRUENAS_RATE_LIMIT", 0)
+        self.latency_target_sec = get_env_float("TRUENAS_LATENCY_TARGET_SEC", 2)
+        self.compression = get_env_bool("TRUENAS_COMPRESSION", True)
+        self.transport = get_env("TRUENAS_TRANSPORT", "rest").lower()
+        self.watch = get_env_bool("TRUENAS_WATCH", False)
+        self.full_resync_sec = get_env_int("TRUENAS_FULL_RESYNC_SEC", 3600)
+        self.stream_listings = get_env_bool("TRUENAS_STREAM_LISTINGS", False)
+        self.page_size = get_env_int("TRUENAS_PAGE_SIZE", 0)
+        filter_rules = get_env("TRUENAS_FILTER_RULES", "")
+        self.filter_rules = json.loads(filter_rules) if filter_rules else []
+        self.parents = json.loads(parents) if parents else []
+        self.fleet = json.loads(fleet) if fleet else []
+        self.fleet_concurrency = get_env_int("TRUENAS_FLEET_CONCURRENCY", 4)
+        self.host_timeout_sec = get_env_int("TRUENAS_HOST_TIMEOUT_SEC", 300)
+        self.metrics_port = get_env_int("TRUENAS_METRICS_PORT", 0)
+        self.metrics_addr = get_env("TRUENAS_METRICS_ADDR", "0.0.0.0")
+        self.state_file = get_env("TRUENAS_STATE_FILE", "")
+        self.config_reload = get_env_bool("TRUENAS_CONFIG_RELOAD", True)
+        self.config_poll_sec = get_env_int("TRUENAS_CONFIG_POLL_SEC", 5)
+        self.trace_file = get_env("TRUENAS_TRACE_FILE", "")
+        self.profile_file = get_env("TRUENAS_PROFILE_FILE", "")
         return self
 
     @classmethod
@@ -0,0 +1,161 @@
+from __future__ import annotations
+from .Config import Config
+import ctypes
+import ctypes.util
+import hashlib
+import logging
+import os
+import select
+import threading
+
+
+# inotify(7) event masks
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+def _inotify_fd(directory: str) -> int | None:
+    """
+    An inotify descriptor watching directory, None where inotify isn't available
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(directory), WATCH_MASK) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class ConfigWatcher:
+    """
+    Watches the JSON config file and hands over every valid new version of it. The directory
+    is watched rather than the file, so editors that save by renaming and Kubernetes ConfigMap
+    symlink swaps are seen too. Without inotify the file is polled every poll_sec; with it,
+    the poll is kept as a safety net. A version that doesn't parse or validate is logged and
+    skipped, the running config stays in place.
+    """
+
+    def __init__(self,
+                 file_path: str,
+                 poll_sec: float = 5,
+                 settle_sec: float = 0.2,
+                 logger: logging.Logger = None
+                 ):
+        """
+        Args:
+            file_path: The config file
+            poll_sec: Period of the polling check
+            settle_sec: Time to let a write finish after an event before reading the file
+        """
+        self.file_path = os.path.abspath(file_path)
+        self.poll_sec = max(0.1, poll_sec)
+        self.settle_sec = settle_sec
+        if logger is not None and isinstance(logger, logging.Logger):
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+        self.__digest = self._digest()
+        self.__pending: Config = None
+        self.__lock = threading.Lock()
+        self.__changed = threading.Event()
+        self.__stop = threading.Event()
+        self.__fd: int | None = None
+        self.__thread: threading.Thread = None
+
+    @property
+    def uses_inotify(self) -> bool:
+        return self.__fd is not None
+
+    def _digest(self) -> bytes | None:
+        try:
+            with open(self.file_path, "rb") as f:
+                return hashlib.blake2b(f.read(), digest_size=16).digest()
+        except OSError:
+            return None
+
+    def check(self) -> Config | None:
+        """
+        Load the file if its content changed since the last check
+        Returns:
+            The new config if it is valid, None otherwise
+        """
+        digest = self._digest()
+        if digest is None or digest == self.__digest:
+            return None
+        self.__digest = digest
+        try:
+            config = Config().read_from_json_file(self.file_path).validate()
+        except (OSError, ValueError) as e:
+            self.logger.error(f"Ignoring the new version of {self.file_path}: {e}")
+            return None
+        self.logger.info(f"Loaded the new version of {self.file_path}")
+        with self.__lock:
+            self.__pending = config
+            self.__changed.set()
+        return config
+
+    def _run(self):
+        while not self.__stop.is_set():
+            if self.__fd is None:
+                self.__stop.wait(self.poll_sec)
+            else:
+                readable, _, _ = select.select([self.__fd], [], [], self.poll_sec)
+                if readable:
+                    self._drain()
+                    self.__stop.wait(self.settle_sec)
+            if not self.__stop.is_set():
+                try:
+                    self.check()
+                except Exception as e:
+                    # The thread must outlive any bad version, or reloads would silently stop
+                    self.logger.error(f"Failed to check {self.file_path} for changes: {e!r}")
+
+    def _drain(self):
+        """
+        Read the pending inotify events, their names don't matter: the content hash decides
+        """
+        try:
+            while os.read(self.__fd, 4096):
+                pass
+        except BlockingIOError:
+            return
+
+    def start(self) -> ConfigWatcher:
+        self.__fd = _inotify_fd(os.path.dirname(self.file_path))
+        if self.__fd is None:
+            self.logger.info(f"Polling {self.file_path} for changes every {self.poll_sec} seconds")
+        else:
+            self.logger.info(f"Watching {self.file_path} for changes")
+        self.__thread = threading.Thread(target=self._run, name="config-watcher", daemon=True)
+        self.__thread.start()
+        return self
+
+    def wait(self, timeout: float) -> Config | None:
+        """
+        Sleep until timeout or a new config, whichever comes first
+        Returns:
+            The new config, None on timeout
+        """
+        self.__changed.wait(timeout)
+        with self.__lock:
+            config, self.__pending = self.__pending, None
+            self.__changed.clear()
+        return config
+
+    def stop(self):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join(timeout=self.poll_sec + 1)
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
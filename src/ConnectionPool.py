@@ -0,0 +1,267 @@
+from __future__ import annotations
+from contextlib import contextmanager
+from typing import Callable, Iterator
+import http.client
+import logging
+import queue
+import select
+import ssl
+import threading
+import zlib
+
+
+# Errors raised by http.client when the server silently dropped a kept-alive socket.
+STALE_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.CannotSendRequest,
+    http.client.ResponseNotReady,
+    http.client.BadStatusLine,
+    ConnectionResetError,
+    ConnectionAbortedError,
+    BrokenPipeError,
+)
+
+# Methods that can be sent twice without applying twice, retried even if the first one may have been processed.
+IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "OPTIONS", "PUT", "DELETE"))
+
+
+class ErrPoolClosed(Exception):
+    def __init__(self, msg: str = "Connection pool is closed"):
+        super().__init__(msg)
+
+
+class ConnectionPool:
+    """
+    A pool of keep-alive HTTPS connections to one TrueNAS host.
+
+    Connections survive across reconcile cycles, are checked for a dropped socket
+    before being reused and are transparently re-established on the first stale request.
+    Up to `size` connections can be handed out at once for parallel calls.
+    gzip-encoded responses are inflated as they are read; bytes_wire and bytes_decoded count
+    the response bodies before and after.
+    """
+
+    def __init__(self,
+                 host: str,
+                 verify_ssl: bool = True,
+                 size: int = 4,
+                 timeout: float = 30,
+                 on_body: Callable[[int, int], None] = None,
+                 logger: logging.Logger = None
+                 ):
+        """
+        Args:
+            on_body: Called with the wire and decoded sizes of every response body
+        """
+        self.host = host
+        self.verify_ssl = verify_ssl
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.on_body = on_body
+        if logger is not None and isinstance(logger, logging.Logger):
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+        self.__idle: queue.LifoQueue[http.client.HTTPSConnection] = queue.LifoQueue()
+        self.__slots = threading.BoundedSemaphore(self.size)
+        self.__lock = threading.Lock()
+        self.__closed = False
+        self.handshakes = 0
+        self.reuses = 0
+        self.reconnects = 0
+        self.bytes_wire = 0
+        self.bytes_decoded = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def closed(self) -> bool:
+        return self.__closed
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "handshakes": self.handshakes,
+            "reuses": self.reuses,
+            "reconnects": self.reconnects,
+            "bytes_wire": self.bytes_wire,
+            "bytes_decoded": self.bytes_decoded,
+            "idle": self.__idle.qsize(),
+        }
+
+    def _new_connection(self) -> http.client.HTTPSConnection:
+        if not self.verify_ssl:
+            context = ssl._create_unverified_context()
+        else:
+            context = ssl.create_default_context()
+        return http.client.HTTPSConnection(self.host, timeout=self.timeout, context=context)
+
+    def _open(self, conn: http.client.HTTPSConnection):
+        self.logger.debug(f"Opening connection to https://{self.host}")
+        conn.connect()
+        with self.__lock:
+            self.handshakes += 1
+
+    @staticmethod
+    def _is_dropped(conn: http.client.HTTPSConnection) -> bool:
+        """
+        An idle keep-alive socket must not be readable: if it is, the server either
+        closed it (EOF) or sent something unexpected, and it can't be reused.
+        """
+        if conn.sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return len(readable) > 0
+
+    def acquire(self) -> http.client.HTTPSConnection:
+        if self.__closed:
+            raise ErrPoolClosed()
+        self.__slots.acquire()
+        try:
+            conn = self.__idle.get_nowait()
+        except queue.Empty:
+            conn = self._new_connection()
+        try:
+            if self._is_dropped(conn):
+                conn.close()
+                self._open(conn)
+            else:
+                with self.__lock:
+                    self.reuses += 1
+        except BaseException:
+            self.__slots.release()
+            raise
+        return conn
+
+    def release(self, conn: http.client.HTTPSConnection, discard: bool = False):
+        if discard or self.__closed:
+            conn.close()
+        else:
+            self.__idle.put(conn)
+        self.__slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        discard = False
+        try:
+            yield conn
+        except BaseException:
+            discard = True
+            raise
+        finally:
+            self.release(conn, discard=discard)
+
+    def _reopen(self, conn: http.client.HTTPSConnection, error: Exception):
+        self.logger.debug(f"Stale connection to {self.host} ({error!r}), reconnecting")
+        conn.close()
+        self._open(conn)
+        with self.__lock:
+            self.reconnects += 1
+
+    def _send(self, conn: http.client.HTTPSConnection, method: str, path: str, body: str = None,
+              headers: dict = None) -> http.client.HTTPResponse:
+        """
+        Send a request and return its response, retried once on a fresh connection if the socket
+        was stale. A request that failed after being sent may have been processed: only an
+        idempotent one is retried then, the error of a write goes to the caller.
+        """
+        try:
+            conn.request(method, path, body, headers=headers or {})
+        except STALE_ERRORS as e:
+            self._reopen(conn, e)
+            conn.request(method, path, body, headers=headers or {})
+            return conn.getresponse()
+        try:
+            return conn.getresponse()
+        except STALE_ERRORS as e:
+            if method.upper() not in IDEMPOTENT_METHODS:
+                raise
+            self._reopen(conn, e)
+            conn.request(method, path, body, headers=headers or {})
+            return conn.getresponse()
+
+    @contextmanager
+    def response(self, method: str, path: str, body: str = None, headers: dict = None):
+        """
+        Send a request and yield the unread response, for streaming large bodies.
+        The connection goes back to the pool only if the body was read to the end.
+        """
+        conn = self.acquire()
+        discard = True
+        try:
+            res = self._send(conn, method, path, body, headers)
+            yield res
+            discard = res.will_close or not res.isclosed()
+        finally:
+            self.release(conn, discard=discard)
+
+    def iter_body(self, res: http.client.HTTPResponse, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+        """
+        Read a response body to the end in chunks, inflating it on the fly if it is gzip-encoded,
+        so neither the compressed nor the decoded body is held in memory at once
+        """
+        encoding = (res.getheader("Content-Encoding") or "identity").strip().lower()
+        if encoding not in ("identity", "gzip", "x-gzip"):
+            raise http.client.HTTPException(f"Unsupported Content-Encoding {encoding}")
+        inflate = zlib.decompressobj(16 + zlib.MAX_WBITS) if encoding != "identity" else None
+        wire = 0
+        decoded = 0
+        try:
+            while True:
+                chunk = res.read(chunk_size)
+                if not chunk:
+                    break
+                wire += len(chunk)
+                if inflate is not None:
+                    chunk = inflate.decompress(chunk)
+                decoded += len(chunk)
+                if chunk:
+                    yield chunk
+            if inflate is not None:
+                chunk = inflate.flush()
+                if not inflate.eof:
+                    raise http.client.IncompleteRead(chunk)
+                decoded += len(chunk)
+                if chunk:
+                    yield chunk
+        finally:
+            with self.__lock:
+                self.bytes_wire += wire
+                self.bytes_decoded += decoded
+            if self.on_body is not None:
+                self.on_body(wire, decoded)
+
+    def request(self, method: str, path: str, body: str = None, headers: dict = None) -> tuple[int, str]:
+        """
+        Send a request on a pooled connection and read the whole response.
+        Returns:
+            (status, body)
+        """
+        conn = self.acquire()
+        try:
+            res = self._send(conn, method, path, body, headers)
+            data = b"".join(self.iter_body(res)).decode()
+            if res.will_close:
+                conn.close()
+        except BaseException:
+            self.release(conn, discard=True)
+            raise
+        self.release(conn)
+        return res.status, data
+
+    def close(self):
+        self.__closed = True
+        while True:
+            try:
+                conn = self.__idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
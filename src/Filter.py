@@ -0,0 +1,158 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from itertools import filterfalse
+from operator import methodcaller
+from typing import Callable, Iterable
+import re
+
+
+MODE_START_WITH = "start_with"
+MODE_END_WITH = "end_with"
+MODE_CONTAINS = "contains"
+MODE_REGEX = "regex"
+MODES = (MODE_START_WITH, MODE_END_WITH, MODE_CONTAINS, MODE_REGEX)
+
+ACTION_INCLUDE = "include"
+ACTION_EXCLUDE = "exclude"
+
+# Numbered or named backreferences break once the pattern is combined with others
+_BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P=")
+
+
+@dataclass
+class FilterRule:
+    """
+    Represents one include/exclude rule of a path filter
+    """
+    pattern: str = field(default="")
+    mode: str = field(default=MODE_START_WITH)
+    action: str = field(default=ACTION_INCLUDE)
+
+    def __post_init__(self):
+        if self.action not in (ACTION_INCLUDE, ACTION_EXCLUDE):
+            raise ValueError(f"Invalid filter action {self.action}, expected '{ACTION_INCLUDE}' or '{ACTION_EXCLUDE}'")
+        if self.mode == MODE_REGEX:
+            re.compile(self.pattern)
+
+    def matches(self, string: str) -> bool:
+        if self.mode == MODE_START_WITH:
+            return string.startswith(self.pattern)
+        elif self.mode == MODE_END_WITH:
+            return string.endswith(self.pattern)
+        elif self.mode == MODE_CONTAINS:
+            return self.pattern in string
+        elif self.mode == MODE_REGEX:
+            return re.search(self.pattern, string) is not None
+        return True
+
+    @classmethod
+    def new_from_dict(cls, dict_data: dict) -> FilterRule:
+        return cls(
+            pattern=dict_data.get("pattern", ""),
+            mode=dict_data.get("mode", MODE_START_WITH),
+            action=dict_data.get("action", ACTION_INCLUDE)
+        )
+
+
+def _merge(rules: list[FilterRule]) -> list[Callable[[str], bool]]:
+    """
+    Merge rules sharing an action into as few C-level tests as possible:
+    one prefix tuple, one suffix tuple and one regex for the substrings and patterns.
+    """
+    tests: list[Callable[[str], bool]] = []
+    prefixes = tuple(rule.pattern for rule in rules if rule.mode == MODE_START_WITH)
+    suffixes = tuple(rule.pattern for rule in rules if rule.mode == MODE_END_WITH)
+    patterns = [re.escape(rule.pattern) for rule in rules if rule.mode == MODE_CONTAINS]
+    patterns += [rule.pattern for rule in rules if rule.mode == MODE_REGEX]
+    if any(rule.mode not in MODES for rule in rules):
+        # An unknown mode matches everything, like filter_str
+        return [lambda string: True]
+    if prefixes:
+        tests.append(methodcaller("startswith", prefixes))
+    if suffixes:
+        tests.append(methodcaller("endswith", suffixes))
+    if len(patterns) == 1:
+        tests.append(re.compile(patterns[0]).search)
+    elif patterns:
+        try:
+            if any(_BACKREFERENCE.search(pattern) for pattern in patterns):
+                raise re.error("backreference")
+            tests.append(re.compile("|".join(f"(?:{pattern})" for pattern in patterns)).search)
+        except re.error:
+            # Backreferences or inline global flags can't be combined, keep one regex each
+            tests.extend(re.compile(pattern).search for pattern in patterns)
+    return tests
+
+
+def _build_predicate(groups: list[tuple[list[Callable[[str], bool]], bool]], default: bool) -> Callable[[str], bool]:
+    """
+    Generate one flat function testing the groups in order, so a path costs a single
+    Python frame whatever the number of rules:
+        def predicate(string):
+            if t0_0(string) or t0_1(string): return False
+            ...
+            return default
+    """
+    namespace: dict[str, Callable[[str], bool]] = {}
+    lines = ["def predicate(string):"]
+    for i, (tests, keep) in enumerate(groups):
+        names = []
+        for j, test in enumerate(tests):
+            namespace[f"t{i}_{j}"] = test
+            names.append(f"t{i}_{j}(string)")
+        lines.append(f"    if {' or '.join(names)}: return {keep}")
+    lines.append(f"    return {default}")
+    exec("\n".join(lines), namespace)
+    return namespace["predicate"]
+
+
+class FilterEngine:
+    """
+    An ordered list of include/exclude rules compiled once into a single predicate.
+    The first matching rule decides; a path no rule matches is kept only if there is
+    no include rule. Consecutive rules with the same action can't change each other's
+    outcome, so each run of them is merged into a few C-level tests (see _merge), and
+    the runs are chained into one generated function (see _build_predicate).
+    """
+
+    def __init__(self, rules: Iterable[FilterRule | dict] = ()):
+        self.rules: list[FilterRule] = [
+            rule if isinstance(rule, FilterRule) else FilterRule.new_from_dict(rule) for rule in rules
+        ]
+        self.default = not any(rule.action == ACTION_INCLUDE for rule in self.rules)
+        self.__groups: list[tuple[list[Callable[[str], bool]], bool]] = []
+        for rule in self.rules:
+            keep = rule.action == ACTION_INCLUDE
+            if self.__groups and self.__groups[-1][1] == keep:
+                self.__groups[-1][0].append(rule)
+            else:
+                self.__groups.append(([rule], keep))
+        self.__groups = [(_merge(group), keep) for group, keep in self.__groups]
+        self.__predicate = _build_predicate(self.__groups, self.default)
+
+    def __repr__(self) -> str:
+        return f"FilterEngine({self.rules!r})"
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, FilterEngine) and self.rules == other.rules
+
+    def __call__(self, string: str) -> bool:
+        """
+        Returns:
+            True if the string is kept
+        """
+        return self.__predicate(string)
+
+    def filter(self, strings: Iterable[str]) -> list[str]:
+        if len(self.__groups) == 1 and len(self.__groups[0][0]) == 1:
+            # A single test: let filter/filterfalse call it without a Python frame per string
+            (test,), keep = self.__groups[0]
+            return list(filter(test, strings)) if keep else list(filterfalse(test, strings))
+        return list(filter(self.__predicate, strings))
+
+    @classmethod
+    def new_from_legacy(cls, pattern: str, mode: str = MODE_START_WITH, reversed: bool = False) -> FilterEngine:
+        """
+        The engine equivalent to filter_str(string, pattern, mode, reversed)
+        """
+        return cls([FilterRule(pattern=pattern, mode=mode, action=ACTION_EXCLUDE if reversed else ACTION_INCLUDE)])
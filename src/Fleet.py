@@ -0,0 +1,164 @@
+from __future__ import annotations
+from .TrueNAS import TrueNAS
+from .Config import Config
+from .Metrics import Metrics
+from .State import load_state, save_state
+import asyncio
+import logging
+
+
+class Fleet:
+    """
+    Reconciles many TrueNAS hosts concurrently from one process. Every host keeps its own
+    client, parents, rules and check period; an asyncio scheduler runs one loop per host
+    and the blocking reconcile calls in worker threads.
+
+    At most `concurrency` hosts reconcile at the same time, and a host whose cycle takes more
+    than `host_timeout_sec` once it has its slot is reported as failed without holding up the
+    others; the time spent queued for a slot doesn't count. A worker thread
+    can't be interrupted: a timed-out cycle keeps its slot until the client's socket timeout ends
+    it, and its host skips its next cycles until then.
+    """
+
+    def __init__(self,
+                 configs: list[Config],
+                 concurrency: int = 4,
+                 host_timeout_sec: float = 300,
+                 metrics: Metrics = None,
+                 logger: logging.Logger = None
+                 ):
+        """
+        Args:
+            configs: One Config per host
+            concurrency: Maximum number of hosts reconciled at the same time
+            host_timeout_sec: Time after which a host's cycle is reported as failed
+            metrics: The metrics shared by all the hosts
+        """
+        self.configs = configs
+        self.concurrency = max(1, concurrency)
+        self.host_timeout_sec = host_timeout_sec
+        if logger is not None and isinstance(logger, logging.Logger):
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.clients: dict[str, TrueNAS] = {
+            config.host: TrueNAS.new_from_config(config, logger=self.logger.getChild(config.host), metrics=self.metrics)
+            for config in configs
+        }
+        self.__running: dict[str, asyncio.Task] = {}
+        self.__slots: asyncio.Semaphore = None
+
+    async def _reconcile(self, config: Config) -> dict[str, TrueNAS.NfsModify]:
+        """
+        The cycle of a host holding a slot, released when the cycle really ends
+        """
+        truenas = self.clients[config.host]
+        try:
+            if not truenas.is_connected:
+                await asyncio.to_thread(truenas.connect)
+            return await asyncio.to_thread(truenas.update_nfs_shares, config.nfs_parents)
+        finally:
+            self.__slots.release()
+
+    async def reconcile_host(self, config: Config) -> dict[str, TrueNAS.NfsModify] | None:
+        """
+        Run one cycle for a host
+        Returns:
+            dict of parent dataset id -> NfsModify, None if the cycle failed or timed out
+        """
+        logger = self.clients[config.host].logger
+        running = self.__running.get(config.host)
+        if running is not None and not running.done():
+            logger.warning("Previous cycle is still running, skipping")
+            return None
+        # The timeout starts with the slot, a host queued behind the others isn't late
+        await self.__slots.acquire()
+        task = asyncio.ensure_future(self._reconcile(config))
+        self.__running[config.host] = task
+        try:
+            # shield: on timeout stop waiting, but let the cycle release its slot when it really ends
+            results = await asyncio.wait_for(asyncio.shield(task), timeout=self.host_timeout_sec)
+        except asyncio.TimeoutError:
+            logger.error(f"Cycle timed out after {self.host_timeout_sec} seconds")
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            return None
+        except Exception as e:
+            logger.error(f"Error updating NFS share: {e}")
+            return None
+        for parent_dataset_id, nfs_modify in results.items():
+            if nfs_modify.failed:
+                logger.warning(f"NFS share updated for {parent_dataset_id} with {len(nfs_modify.errors)} failures.")
+            else:
+                logger.info(f"NFS share updated successfully for {parent_dataset_id}.")
+        return results
+
+    async def _warm_start(self, config: Config) -> bool:
+        """
+        Load the host's state file and apply its pending changes
+        Returns:
+            True if the host started warm
+        """
+        truenas = self.clients[config.host]
+        try:
+            state = await asyncio.to_thread(load_state, config.state_file)
+            if state is None or not truenas.import_state(state):
+                return False
+            async with self.__slots:
+                if not truenas.is_connected:
+                    await asyncio.to_thread(truenas.connect)
+                await asyncio.wait_for(asyncio.to_thread(truenas.warm_start, config.nfs_parents),
+                                       timeout=self.host_timeout_sec)
+            return True
+        except Exception as e:
+            truenas.logger.error(f"Warm start failed, starting cold: {e}")
+            return False
+
+    async def _save_state(self, config: Config):
+        truenas = self.clients[config.host]
+        if not config.state_file or not truenas.state_changed:
+            return
+        try:
+            await asyncio.to_thread(save_state, config.state_file, truenas.export_state())
+        except OSError as e:
+            truenas.logger.error(f"Failed to save the state to {config.state_file}: {e}")
+
+    async def _host_loop(self, config: Config):
+        scheduler = config.scheduler
+        logger = self.clients[config.host].logger
+        if config.state_file and await self._warm_start(config):
+            await asyncio.sleep(scheduler.min_sec)
+        while True:
+            results = await self.reconcile_host(config)
+            await self._save_state(config)
+            if results is None:
+                delay = scheduler.after_error()
+            else:
+                delay = scheduler.after_cycle(
+                    applied=sum(nfs_modify.applied for nfs_modify in results.values()),
+                    failed=sum(len(nfs_modify.errors) for nfs_modify in results.values())
+                )
+            logger.info(f"Next cycle in {delay:.0f} seconds")
+            await asyncio.sleep(delay)
+
+    async def run_once(self) -> dict[str, dict[str, TrueNAS.NfsModify] | None]:
+        """
+        Run one cycle for every host
+        Returns:
+            dict of host -> result of reconcile_host
+        """
+        self.__slots = self.__slots or asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*(self.reconcile_host(config) for config in self.configs))
+        return {config.host: result for config, result in zip(self.configs, results)}
+
+    async def run(self):
+        """
+        Reconcile every host on its own schedule, forever
+        """
+        self.__slots = self.__slots or asyncio.Semaphore(self.concurrency)
+        self.logger.info(f"Managing {len(self.configs)} hosts, {self.concurrency} at a time")
+        await asyncio.gather(*(self._host_loop(config) for config in self.configs))
+
+    def close(self):
+        for truenas in self.clients.values():
+            truenas.close()
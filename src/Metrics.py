@@ -0,0 +1,214 @@
+from __future__ import annotations
+from bisect import bisect_left
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+
+CYCLE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: dict[tuple, object] = {}
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels.keys()) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {self.labelnames}, got {tuple(labels.keys())}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        with self._lock:
+            samples = self._samples()
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + samples)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> list[str]:
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}" for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = CYCLE_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        # Per bucket counts (not cumulative) plus the +Inf slot, then sum
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def count(self, **labels) -> int:
+        counts = self._values.get(self._key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> list[str]:
+        samples = []
+        for key, counts in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _number(bound)
+                labels = _labels(self.labelnames, key, f'le="{le}"')
+                samples.append(f"{self.name}_bucket{labels} {cumulative}")
+            samples.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(counts[-1])}")
+            samples.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return samples
+
+
+class Metrics:
+    """
+    The reconcile and API metrics of one process, labelled by TrueNAS host so a fleet
+    shares one set. Always recorded in memory; exported only if a MetricsServer is started.
+    """
+
+    def __init__(self):
+        self.cycle_seconds = Histogram(
+            "autonfs_cycle_seconds", "Duration of a reconcile cycle", ("host",))
+        self.phase_seconds = Histogram(
+            "autonfs_cycle_phase_seconds", "Duration of a reconcile cycle phase", ("host", "phase"))
+        self.request_seconds = Histogram(
+            "autonfs_api_request_seconds", "Latency of the TrueNAS API calls", ("host", "method", "endpoint"),
+            buckets=REQUEST_BUCKETS)
+        self.requests = Counter(
+            "autonfs_api_requests_total", "TrueNAS API calls by response status", ("host", "method", "endpoint", "status"))
+        self.response_bytes = Counter(
+            "autonfs_api_response_bytes_total", "Size of the TrueNAS API response bodies, on the wire and decoded",
+            ("host", "encoding"))
+        self.shares = Counter(
+            "autonfs_shares_total", "NFS shares added, removed, updated or failed to apply", ("host", "result"))
+        self.last_success = Gauge(
+            "autonfs_last_success_timestamp_seconds", "Unix time of the last cycle without failures", ("host",))
+        self.rate_limit = Gauge(
+            "autonfs_api_rate_limit", "Requests per second allowed by the adaptive limiter, +Inf if uncapped", ("host",))
+        self.concurrency_limit = Gauge(
+            "autonfs_api_concurrency_limit", "Requests in flight allowed by the adaptive limiter", ("host",))
+        self.throttled = Counter(
+            "autonfs_api_throttled_total", "Times the adaptive limiter backed off", ("host",))
+        self.all: list[_Metric] = [self.cycle_seconds, self.phase_seconds, self.request_seconds, self.requests,
+                                   self.response_bytes, self.shares, self.last_success, self.rate_limit, self.concurrency_limit,
+                                   self.throttled]
+
+    def phase(self, host: str, phase: str):
+        return self.phase_seconds.time(host=host, phase=phase)
+
+    def request(self, host: str, method: str, endpoint: str, status: int | str, seconds: float):
+        self.request_seconds.observe(seconds, host=host, method=method, endpoint=endpoint)
+        self.requests.inc(host=host, method=method, endpoint=endpoint, status=status)
+
+    def limiter(self, host: str, limiter):
+        """
+        Export the current limits of a RateLimiter
+        """
+        self.rate_limit.set(limiter.rate, host=host)
+        self.concurrency_limit.set(limiter.limit, host=host)
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.all) + "\n"
+
+
+class MetricsServer:
+    """
+    Serves the metrics in the Prometheus text format on /metrics, from a daemon thread
+    """
+
+    def __init__(self, metrics: Metrics, port: int = 9100, addr: str = "0.0.0.0", logger: logging.Logger = None):
+        # Imported here, a process without a metrics endpoint doesn't pay for http.server
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        self.metrics = metrics
+        if logger is not None and isinstance(logger, logging.Logger):
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split("?", 1)[0] != "/metrics":
+                    handler.send_error(404)
+                    return
+                body = metrics.render().encode()
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((addr, port), Handler)
+        self.server.daemon_threads = True
+        self.__thread: threading.Thread = None
+
+    def start(self) -> MetricsServer:
+        self.__thread = threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True)
+        self.__thread.start()
+        self.logger.info(f"Serving metrics on http://{self.server.server_address[0]}:{self.server.server_address[1]}/metrics")
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
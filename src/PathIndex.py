@@ -0,0 +1,99 @@
+from __future__ import annotations
+from bisect import bisect_left
+from typing import Iterable, Iterator
+
+
+# The last code point: every string starting with a prefix sorts below prefix + _HIGHEST
+_HIGHEST = "\U0010ffff"
+
+
+class PathIndex:
+    """
+    Sorted-prefix index of slash-separated paths (share paths or dataset ids).
+    Membership is a set lookup; subtree and raw prefix queries are two bisections over
+    the sorted paths plus the matches, never a scan of the whole index. Paths are sorted
+    lazily on the first query after a change, so bulk loading costs one sort.
+    """
+
+    def __init__(self, paths: Iterable[str] = ()):
+        self.__paths: set[str] = set(paths)
+        self.__sorted: list[str] | None = None
+
+    def __len__(self):
+        return len(self.__paths)
+
+    def __contains__(self, path: str) -> bool:
+        return path in self.__paths
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._sorted())
+
+    def add(self, path: str):
+        if path not in self.__paths:
+            self.__paths.add(path)
+            self.__sorted = None
+
+    def discard(self, path: str):
+        if path in self.__paths:
+            self.__paths.discard(path)
+            self.__sorted = None
+
+    def _sorted(self) -> list[str]:
+        if self.__sorted is None:
+            self.__sorted = sorted(self.__paths)
+        return self.__sorted
+
+    def _range(self, low: str, high: str) -> list[str]:
+        paths = self._sorted()
+        return paths[bisect_left(paths, low):bisect_left(paths, high)]
+
+    def startswith(self, prefix: str) -> list[str]:
+        """
+        The paths starting with prefix as a plain string, e.g. "/mnt/a" matches "/mnt/ab"
+        """
+        return self._range(prefix, prefix + _HIGHEST)
+
+    def subtree(self, path: str, include_self: bool = False) -> list[str]:
+        """
+        The paths under path, component-wise: "/mnt/a" matches "/mnt/a/b", not "/mnt/ab"
+        Args:
+            path: The root of the subtree, without trailing slash
+            include_self: Also return path itself if it is in the index
+        """
+        # "/" sorts right below "0": the children of path are the range [path/, path0)
+        under = self._range(path + "/", path + "0")
+        if include_self and path in self.__paths:
+            return [path] + under
+        return under
+
+    def children(self, path: str) -> list[str]:
+        """
+        The paths exactly one level below path
+        """
+        start = len(path) + 1
+        return [child for child in self.subtree(path) if child.find("/", start) == -1]
+
+    def innermost(self, path: str, strict: bool = True) -> str | None:
+        """
+        Nested-parent lookup: the deepest indexed path path is under, walking up its components
+        Args:
+            strict: Don't return path itself
+        Returns:
+            The indexed ancestor, None if there is none
+        """
+        if not strict and path in self.__paths:
+            return path
+        end = path.rfind("/")
+        while end > 0:
+            ancestor = path[:end]
+            if ancestor in self.__paths:
+                return ancestor
+            end = path.rfind("/", 0, end)
+        return None
+
+    def difference(self, other: PathIndex | set[str], path: str = None) -> list[str]:
+        """
+        The paths of this index missing from other, only in the subtree of path if given
+        """
+        paths = self._sorted() if path is None else self.subtree(path)
+        return [p for p in paths if p not in other]
@@ -0,0 +1,173 @@
+from __future__ import annotations
+from collections import deque
+import math
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Client-side limiter of the requests sent to one TrueNAS host, so a bulk sync runs as fast
+    as middlewared can take and no faster:
+    - a token bucket caps the request rate, a counter caps the requests in flight
+    - every healthy response raises the concurrency by 1/limit (about +1 per round trip of the
+      whole window) and the rate by rate_step per second of healthy traffic (additive increase)
+    - a 429 halves both (multiplicative decrease); so do 5xx responses, transport errors and
+      writes slower than latency_target_sec, once error_threshold of them happen in a row within
+      error_window_sec: failures scattered among successes are noise, not overload. At most one decrease per
+      cooldown, so one burst of failures counts once
+    An uncapped rate (max_rate 0) is turned into a cap from the measured throughput at the first
+    sign of overload, and is lifted again once it grows past max_rate_seen.
+    """
+
+    def __init__(self,
+                 max_rate: float = 0,
+                 max_concurrency: int = 4,
+                 min_rate: float = 1,
+                 latency_target_sec: float = 2,
+                 rate_step: float = 0,
+                 decrease: float = 0.5,
+                 error_threshold: int = 3,
+                 error_window_sec: float = 10,
+                 clock=time.monotonic
+                 ):
+        """
+        Args:
+            max_rate: Highest request rate, in requests per second; 0 for no cap
+            max_concurrency: Highest number of requests in flight
+            min_rate: Lowest request rate the decreases stop at
+            latency_target_sec: A write slower than this counts as overload; 0 to ignore latency
+            rate_step: Requests per second the rate grows by for every second without overload;
+                       0 for 5% of the highest throughput seen
+            decrease: Factor the rate and the concurrency shrink by on overload
+            error_threshold: Number of errors or slow writes in a row, within error_window_sec,
+                             that count as overload
+        """
+        self.max_rate = max_rate if max_rate > 0 else math.inf
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_rate = max(min_rate, 0.1)
+        self.latency_target_sec = latency_target_sec
+        self.rate_step = rate_step
+        self.decrease = min(max(decrease, 0.1), 0.9)
+        self.error_threshold = max(1, error_threshold)
+        self.error_window_sec = error_window_sec
+        self.clock = clock
+        self.rate = self.max_rate
+        self.concurrency = float(self.max_concurrency)
+        self.in_flight = 0
+        self.throttled = 0
+        self.max_rate_seen = 0.0
+        self.__tokens = 1.0
+        self.__refilled = clock()
+        self.__adjusted = clock()
+        self.__cooldown_until = 0.0
+        self.__completed: deque[float] = deque()
+        self.__errors: deque[float] = deque()
+        self.__cond = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        return max(1, int(self.concurrency))
+
+    @property
+    def throughput(self) -> float:
+        """
+        Requests completed over the last second
+        """
+        return float(len(self.__completed))
+
+    def _refill(self, now: float):
+        if math.isinf(self.rate):
+            self.__tokens = 1.0
+        else:
+            # Bursts no bigger than the concurrency limit, the rate is spread evenly
+            self.__tokens = min(float(self.limit), self.__tokens + (now - self.__refilled) * self.rate)
+        self.__refilled = now
+
+    def acquire(self):
+        """
+        Wait for a concurrency slot and a token
+        """
+        with self.__cond:
+            while True:
+                now = self.clock()
+                self._refill(now)
+                if self.in_flight >= self.limit:
+                    self.__cond.wait()
+                elif self.__tokens < 1:
+                    self.__cond.wait((1 - self.__tokens) / self.rate)
+                else:
+                    self.__tokens -= 1
+                    self.in_flight += 1
+                    return
+
+    def release(self, seconds: float, overloaded: bool) -> bool:
+        """
+        Give back the slot of a finished request and adapt to its outcome
+        Args:
+            seconds: The latency of the request
+            overloaded: The outcome as judged by is_overloaded
+        Returns:
+            True if the limits were decreased
+        """
+        with self.__cond:
+            now = self.clock()
+            self.in_flight -= 1
+            self.__completed.append(now)
+            while self.__completed and self.__completed[0] <= now - 1:
+                self.__completed.popleft()
+            self.max_rate_seen = max(self.max_rate_seen, self.throughput)
+            decreased = False
+            if overloaded:
+                if now >= self.__cooldown_until:
+                    measured = self.throughput if math.isinf(self.rate) else self.rate
+                    self.rate = max(self.min_rate, measured * self.decrease)
+                    self.concurrency = max(1.0, self.concurrency * self.decrease)
+                    self.__cooldown_until = now + max(seconds, self.latency_target_sec, 1)
+                    self.throttled += 1
+                    decreased = True
+            else:
+                self.concurrency = min(float(self.max_concurrency), self.concurrency + 1 / self.concurrency)
+                if not math.isinf(self.rate):
+                    step = self.rate_step or max(1.0, 0.05 * self.max_rate_seen)
+                    self.rate += step * max(0.0, now - self.__adjusted)
+                    if self.rate >= self.max_rate or (math.isinf(self.max_rate) and self.rate > 2 * self.max_rate_seen):
+                        self.rate = self.max_rate
+            self.__adjusted = now
+            self.__cond.notify_all()
+            return decreased
+
+    def is_overloaded(self, status: int | str, seconds: float, write: bool = False) -> bool:
+        """
+        Judge the outcome of a request. A 429 is overload right away; an error or a slow write is
+        recorded, and is overload once error_threshold of them happened in a row within
+        error_window_sec. Any other outcome ends the series.
+        Args:
+            status: The HTTP status, "error" for a transport error, "ok" for a WebSocket call
+            seconds: The latency of the request
+            write: If the request modifies the NAS; only writes are judged on latency, listings
+                   are slow because they are big
+        """
+        if status == 429:
+            return True
+        failed = status == "error" or (isinstance(status, int) and status >= 500)
+        with self.__cond:
+            if not failed and not (write and 0 < self.latency_target_sec < seconds):
+                self.__errors.clear()
+                return False
+            now = self.clock()
+            self.__errors.append(now)
+            while self.__errors[0] <= now - self.error_window_sec:
+                self.__errors.popleft()
+            if len(self.__errors) < self.error_threshold:
+                return False
+            self.__errors.clear()
+            return True
+
+    def stats(self) -> dict:
+        return {
+            "rate": None if math.isinf(self.rate) else round(self.rate, 1),
+            "concurrency": self.limit,
+            "in_flight": self.in_flight,
+            "throttled": self.throttled,
+        }
@@ -0,0 +1,71 @@
+from __future__ import annotations
+import random
+
+
+class Scheduler:
+    """
+    Picks the delay before the next reconcile cycle from the outcome of the last one:
+    - a cycle that applied changes is followed quickly (min_sec), onboarding comes in bursts
+    - every idle cycle in a row stretches the delay by idle_growth, from period_sec up to max_sec
+    - a failed cycle backs off exponentially from min_sec up to max_sec, with jitter
+    All the delays get a little jitter so the hosts of a fleet don't hit in lockstep.
+    """
+
+    def __init__(self,
+                 period_sec: float = 600,
+                 min_sec: float = 60,
+                 max_sec: float = 3600,
+                 idle_growth: float = 1.5,
+                 jitter: float = 0.1,
+                 rng: random.Random = None
+                 ):
+        """
+        Args:
+            period_sec: Delay after the first idle cycle
+            min_sec: Shortest delay, after a cycle that applied changes and at the start of a backoff
+            max_sec: Longest delay, reached after long idle periods or repeated failures
+            idle_growth: Factor the delay grows by for every idle cycle in a row
+            jitter: Fraction of the delay randomly added or removed
+        """
+        self.min_sec = max(0, min(min_sec, max_sec))
+        self.max_sec = max(self.min_sec, max_sec)
+        self.period_sec = min(max(period_sec, self.min_sec), self.max_sec)
+        self.idle_growth = max(1, idle_growth)
+        self.jitter = min(max(jitter, 0), 1)
+        self.rng = rng or random.Random()
+        self.idle_cycles = 0
+        self.failures = 0
+
+    def _jittered(self, delay: float) -> float:
+        return min(self.max_sec, max(self.min_sec, delay * self.rng.uniform(1 - self.jitter, 1 + self.jitter)))
+
+    def after_cycle(self, applied: int = 0, failed: int = 0) -> float:
+        """
+        Args:
+            applied: Number of shares the cycle added, removed or updated
+            failed: Number of shares the cycle failed to apply
+        Returns:
+            The delay before the next cycle, in seconds
+        """
+        if failed > 0 and applied == 0:
+            return self.after_error()
+        self.failures = 0
+        if applied > 0:
+            self.idle_cycles = 0
+            return self._jittered(self.min_sec)
+        delay = self.period_sec * self.idle_growth ** self.idle_cycles
+        # Stop stretching at max_sec, the power would overflow after a long idle period
+        if delay < self.max_sec:
+            self.idle_cycles += 1
+        return self._jittered(delay)
+
+    def after_error(self) -> float:
+        """
+        Returns:
+            The delay before retrying a failed cycle, in seconds: exponential with equal jitter
+        """
+        self.idle_cycles = 0
+        delay = min(self.max_sec, max(self.min_sec, 1) * 2 ** self.failures)
+        if delay < self.max_sec:
+            self.failures += 1
+        return max(self.min_sec, self.rng.uniform(delay / 2, delay))
@@ -0,0 +1,52 @@
+from __future__ import annotations
+import gzip
+import json
+import os
+import tempfile
+
+
+STATE_VERSION = 1
+
+
+class ErrState(Exception):
+    def __init__(self, msg: str = "Invalid state file"):
+        super().__init__(msg)
+
+
+def save_state(file_path: str, state: dict):
+    """
+    Write the state as gzipped JSON, atomically: a crash mid-write leaves the previous file intact
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".state-", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6, mtime=0) as f:
+                f.write(json.dumps(state, separators=(",", ":")).encode())
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def load_state(file_path: str) -> dict | None:
+    """
+    Returns:
+        The saved state, None if there is no state file
+    """
+    try:
+        with gzip.open(file_path, "rb") as f:
+            state = json.loads(f.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        raise ErrState(f"Invalid state file {file_path}: {e}")
+    if not isinstance(state, dict) or state.get("version") != STATE_VERSION:
+        raise ErrState(f"Unsupported state file {file_path}, expected version {STATE_VERSION}")
+    return state
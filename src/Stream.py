@@ -0,0 +1,88 @@
+from __future__ import annotations
+from typing import Any, Iterable, Iterator
+import codecs
+import json
+
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+_NUMBER_CHARS = "0123456789.eE+-"
+
+
+class ErrStream(Exception):
+    def __init__(self, msg: str = "Invalid JSON array stream"):
+        super().__init__(msg)
+
+
+def iter_json_array(chunks: Iterable[bytes | str]) -> Iterator[Any]:
+    """
+    Incrementally parse a top-level JSON array, yielding its elements one by one.
+    Only the current element and one chunk of input are kept in memory.
+    Args:
+        chunks: The raw body, in chunks of any size
+    Returns:
+        Iterator over the array elements
+    """
+    chunks = iter(chunks)
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    pos = 0
+    eof = False
+
+    def more() -> bool:
+        nonlocal buf, pos, eof
+        if eof:
+            return False
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            buf = buf[pos:] + utf8.decode(b"", final=True)
+        else:
+            buf = buf[pos:] + (utf8.decode(chunk) if isinstance(chunk, bytes) else chunk)
+        pos = 0
+        return True
+
+    def skip_whitespace() -> bool:
+        """Advance to the next significant char, False on end of input"""
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in _WHITESPACE:
+                pos += 1
+            if pos < len(buf):
+                return True
+            if not more():
+                return False
+
+    if not skip_whitespace() or buf[pos] != "[":
+        raise ErrStream("Expected a JSON array")
+    pos += 1
+    first = True
+    while True:
+        if not skip_whitespace():
+            raise ErrStream("Unexpected end of the JSON array")
+        if buf[pos] == "]":
+            return
+        if not first:
+            if buf[pos] != ",":
+                raise ErrStream(f"Expected ',' in the JSON array, got {buf[pos]!r}")
+            pos += 1
+            if not skip_whitespace():
+                raise ErrStream("Unexpected end of the JSON array")
+        first = False
+        while True:
+            try:
+                value, end = _decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # Most likely the element is cut by the end of the chunk
+                if not more():
+                    raise
+                continue
+            # A number is complete only once followed by a char that can't continue it
+            if not eof and isinstance(value, (int, float)) and not isinstance(value, bool) and \
+                    (end == len(buf) or buf[end] in _NUMBER_CHARS):
+                more()
+                continue
+            break
+        pos = end
+        yield value
+
@@ -0,0 +1,119 @@
+from __future__ import annotations
+from contextlib import contextmanager
+from contextvars import ContextVar
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+
+# (trace id, span id) of the span the current thread or task is in
+_current: ContextVar[tuple[str, int] | None] = ContextVar("autonfs_span", default=None)
+_ids = itertools.count(1)
+_ids_lock = threading.Lock()
+
+
+def _next_id() -> int:
+    with _ids_lock:
+        return next(_ids)
+
+
+class Tracer:
+    """
+    Writes timed spans as JSON lines, one object per finished span:
+
+        {"trace": "...", "span": 7, "parent": 3, "name": "fetch_shares", "host": "nas",
+         "start": 1700000000.123, "duration_ms": 812.4, "status": "ok", ...attributes}
+
+    A span opened outside of any other starts a new trace. Spans nest through a context
+    variable, so the workers of an apply pool must run in a copy of the submitting context
+    (contextvars.copy_context) to be attached to its span. A disabled tracer costs one
+    attribute check per span.
+    """
+
+    def __init__(self, host: str = "", logger: logging.Logger = None):
+        """
+        Args:
+            host: Added to every span
+            logger: Where the JSON lines go; None disables the tracer
+        """
+        self.host = host
+        self.logger = logger
+
+    @property
+    def enabled(self) -> bool:
+        return self.logger is not None
+
+    @classmethod
+    def new_to_file(cls, file_path: str, host: str = "") -> Tracer:
+        """
+        A tracer appending its JSON lines to file_path, "-" for stderr
+        """
+        logger = logging.getLogger(f"autonfs.trace.{file_path}")
+        if not logger.handlers:
+            if file_path == "-":
+                handler = logging.StreamHandler()
+            else:
+                if os.path.dirname(file_path):
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                handler = logging.FileHandler(file_path)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+        return cls(host=host, logger=logger)
+
+    def _write(self, name: str, trace: str, span: int, parent: int | None, start: float, seconds: float,
+               status: str, attributes: dict):
+        record = {
+            "trace": trace,
+            "span": span,
+            "parent": parent,
+            "name": name,
+            "host": self.host,
+            "start": round(start, 6),
+            "duration_ms": round(seconds * 1000, 3),
+            "status": status,
+        }
+        record.update(attributes)
+        self.logger.info(json.dumps(record, default=str))
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """
+        Time the enclosed block as a span, a child of the current one
+        """
+        if self.logger is None:
+            yield
+            return
+        current = _current.get()
+        span = _next_id()
+        if current is None:
+            trace, parent = f"{os.getpid():x}-{span:x}-{time.time_ns():x}", None
+        else:
+            trace, parent = current
+        token = _current.set((trace, span))
+        start = time.time()
+        began = time.perf_counter()
+        status = "ok"
+        try:
+            yield
+        except BaseException as e:
+            status = type(e).__name__
+            raise
+        finally:
+            _current.reset(token)
+            self._write(name, trace, span, parent, start, time.perf_counter() - began, status, attributes)
+
+    def record(self, name: str, seconds: float, status: str = "ok", **attributes):
+        """
+        Write a span for an operation that already ended and was timed by the caller
+        """
+        if self.logger is None:
+            return
+        current = _current.get()
+        span = _next_id()
+        trace, parent = current if current is not None else (f"{os.getpid():x}-{span:x}-{time.time_ns():x}", None)
+        self._write(name, trace, span, parent, time.time() - seconds, seconds, status, attributes)
@@ -1,17 +1,43 @@
 from __future__ import annotations
-from dataclasses import dataclass, field
-import json
-import ssl
+from dataclasses import dataclass, field, fields, replace
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from contextvars import copy_context
+from typing import Callable, Iterable, Iterator
+from .ConnectionPool import ConnectionPool
+from .WebSocket import JsonRpcClient, ErrRpc
+from .Cache import ReconcileCache, fingerprint
+from .Stream import iter_json_array
+from .Filter import FilterEngine
+from .PathIndex import PathIndex
+from .Metrics import Metrics
+from .RateLimiter import RateLimiter
+from .Tracing import Tracer
+from .State import STATE_VERSION
+from functools import lru_cache
 import http.client
+import ipaddress
+import json
 import urllib.parse
 import logging
 import re
+import threading
+import time
+
+TRANSPORT_REST = "rest"
+TRANSPORT_WEBSOCKET = "websocket"
+
 
 class ErrNotConnected(Exception):
     def __init__(self, msg: str = "Not connected to TrueNAS"):
         super().__init__(msg)
 
 
+class ErrPageOrder(Exception):
+    def __init__(self, msg: str = "Listing pages are not in order"):
+        super().__init__(msg)
+
+
 def filter_str(string: str, pattern: str, mode: str = 'start_with', reversed: bool = False) -> bool:
     """
     Filter the string by pattern
@@ -36,19 +62,40 @@ def filter_str(string: str, pattern: str, mode: str = 'start_with', reversed: bo
     return match if not reversed else not match
 
 
-@dataclass
+# Field names of each model class, looked up once instead of on every record
+_FIELD_NAMES: dict[type | tuple, tuple[str, ...]] = {}
+
+
+@lru_cache(maxsize=32)
+def _legacy_filter(pattern: str, mode: str, reversed: bool) -> FilterEngine:
+    return FilterEngine.new_from_legacy(pattern=pattern, mode=mode, reversed=reversed)
+
+
+# The models are slotted: they are rebuilt for every record of every listing on every cycle.
+# Slotted dataclasses are re-created by the decorator, so they must not use zero-argument super().
+@dataclass(slots=True)
 class _base:
 
+    @classmethod
+    def field_names(cls) -> tuple[str, ...]:
+        names = _FIELD_NAMES.get(cls)
+        if names is None:
+            names = _FIELD_NAMES[cls] = tuple(f.name for f in fields(cls))
+        return names
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.field_names()}
+
     def to_json(self) -> str:
-        return json.dumps(self.__dict__)
+        return json.dumps(self.to_dict())
 
     def from_json(self, json_str: str):
-        self.__dict__ = json.loads(json_str)
+        self.from_dict(json.loads(json_str))
 
     def from_dict(self, dict_data: dict):
-        for key, value in self.__dict__.items():
-            if key in dict_data:
-                self.__dict__[key] = dict_data[key]
+        for name in self.field_names():
+            if name in dict_data:
+                setattr(self, name, dict_data[name])
 
     @classmethod
     def new_from_json(cls, json_str: str) -> _base:
@@ -63,7 +110,7 @@ class _base:
         return obj
 
 
-@dataclass
+@dataclass(slots=True)
 class DataSet(_base):
     """
     Represents a Dataset
@@ -78,12 +125,8 @@ class DataSet(_base):
     children: list = field(default_factory=list)
 
     def from_dict(self, dict_data: dict):
-        super().from_dict(dict_data)
         raise NotImplementedError("Please use new_from_dict")
 
-    def __super_from_dict(self, dict_data: dict):
-        super().from_dict(dict_data)
-
     def from_json(self, json_str: str):
         raise NotImplementedError("Please use new_from_json")
 
@@ -93,19 +136,39 @@ class DataSet(_base):
         return cls.new_from_dict(data_dict)
 
     @classmethod
-    def new_from_dict(cls, dict_data: dict) -> DataSet:
+    def _new_node(cls, dict_data: dict) -> DataSet:
+        names = _FIELD_NAMES.get((cls, "node"))
+        if names is None:
+            names = _FIELD_NAMES[(cls, "node")] = tuple(name for name in cls.field_names() if name != "children")
         obj = cls()
-        obj.__super_from_dict(dict_data)
-        children_list: list[DataSet] = []
-        for child in dict_data["children"]:
-            if isinstance(child, dict):
-                child_obj = DataSet.new_from_dict(child)
-                children_list.append(child_obj)
-            elif isinstance(child, DataSet):
-                children_list.append(child)
-        obj.children = children_list
+        for name in names:
+            if name in dict_data:
+                setattr(obj, name, dict_data[name])
         return obj
 
+    @classmethod
+    def new_from_dict(cls, dict_data: dict) -> DataSet:
+        """
+        Build the Dataset and its whole children tree. The tree is walked with an explicit
+        stack, so deeply nested pools can't hit the recursion limit.
+        """
+        root = cls._new_node(dict_data)
+        if not dict_data.get("children"):
+            return root
+        stack: list[tuple[DataSet, list]] = [(root, dict_data.get("children") or [])]
+        while stack:
+            obj, children = stack.pop()
+            children_list: list[DataSet] = []
+            for child in children:
+                if isinstance(child, dict):
+                    child_obj = cls._new_node(child)
+                    stack.append((child_obj, child.get("children") or []))
+                    children_list.append(child_obj)
+                elif isinstance(child, DataSet):
+                    children_list.append(child)
+            obj.children = children_list
+        return root
+
 
 @dataclass
 class DataSetDict():
@@ -113,6 +176,8 @@ class DataSetDict():
     Represents a list of Datasets
     """
     data: dict = field(default_factory=dict)
+    # Sorted index of the ids, built on the first subtree query
+    _index: PathIndex = field(default=None, repr=False, compare=False)
 
     def __iter__(self):
         return iter(self.data.values())
@@ -127,30 +192,53 @@ class DataSetDict():
         self.update(value)
 
     def add(self, dataset: DataSet | list[DataSet]):
-        if isinstance(dataset, list) and len(dataset) > 0 and isinstance(dataset[0], DataSet):
+        if isinstance(dataset, list) and all(isinstance(ds, DataSet) for ds in dataset):
             for ds in dataset:
                 if ds.id in self.data:
                     print(f"Duplicate ID {ds.id}, skipping")
                     continue
-                self.data[ds.id] = ds
+                self._set(ds)
         elif isinstance(dataset, DataSet):
             id = dataset.id
             if id in self.data:
                 print(f"Duplicate ID {id}, skipping")
                 return
-            self.data[id] = dataset
+            self._set(dataset)
         else:
             raise Exception("Invalid type, expected DataSet or list[DataSet]")
 
     def update(self, dataset: DataSet | list[DataSet]):
-        if isinstance(dataset, list) and len(dataset) > 0 and isinstance(dataset[0], DataSet):
+        if isinstance(dataset, list) and all(isinstance(ds, DataSet) for ds in dataset):
             for ds in dataset:
-                self.data[ds.id] = ds
+                self._set(ds)
         elif isinstance(dataset, DataSet):
-            self.data[dataset.id] = dataset
+            self._set(dataset)
         else:
             raise Exception("Invalid type, expected DataSet or list[DataSet]")
 
+    def _set(self, dataset: DataSet):
+        self.data[dataset.id] = dataset
+        if self._index is not None:
+            self._index.add(dataset.id)
+
+    @property
+    def index(self) -> PathIndex:
+        if self._index is None:
+            self._index = PathIndex(self.data.keys())
+        return self._index
+
+    def subtree(self, id: str) -> list[DataSet]:
+        """
+        The datasets under the dataset id, at any depth
+        """
+        return [self.data[key] for key in self.index.subtree(id)]
+
+    def children(self, id: str) -> list[DataSet]:
+        """
+        The direct children of the dataset id
+        """
+        return [self.data[key] for key in self.index.children(id)]
+
     def get(self, id: int) -> DataSet:
         if id not in self.data:
             raise Exception(f"ID {id} not found")
@@ -162,8 +250,38 @@ class DataSetDict():
     def values(self) -> list[DataSet]:
         return self.data.values()
 
+    @classmethod
+    def new_from_json(cls, json_str: str) -> DataSetDict:
+        return cls.new_from_list(json.loads(json_str))
 
-@dataclass
+    @classmethod
+    def new_from_list(cls, list_data: Iterable[dict]) -> DataSetDict:
+        obj = cls()
+        for ds_dict in list_data:
+            obj.update(DataSet.new_from_dict(ds_dict))
+        return obj
+
+
+# Fields of a managed share kept in line with the common config
+DRIFT_FIELDS = ("networks", "hosts")
+
+
+def _normalized(name: str, values: list) -> set[str]:
+    """
+    The values of a share field as TrueNAS compares them: unordered, networks in canonical form
+    """
+    if name != "networks":
+        return set(values)
+    normalized = set()
+    for value in values:
+        try:
+            normalized.add(str(ipaddress.ip_network(value, strict=False)))
+        except ValueError:
+            normalized.add(value)
+    return normalized
+
+
+@dataclass(slots=True)
 class NfsShareAdd(_base):
     """
     Represents a NFS Share to be added
@@ -173,8 +291,25 @@ class NfsShareAdd(_base):
     networks: list = field(default_factory=list)
     hosts: list = field(default_factory=list)
 
-
-@dataclass
+    def drift(self, desired: NfsShareAdd) -> dict:
+        """
+        The DRIFT_FIELDS of this share differing from the desired config. An empty desired list
+        never replaces a non-empty one: that would open an export restricted by hand to everyone.
+        Returns:
+            dict of field -> desired value, empty if the share is in line
+        """
+        changes = {}
+        for name in DRIFT_FIELDS:
+            current = getattr(self, name) or []
+            wanted = getattr(desired, name) or []
+            if len(wanted) == 0:
+                continue
+            if current != wanted and _normalized(name, current) != _normalized(name, wanted):
+                changes[name] = wanted
+        return changes
+
+
+@dataclass(slots=True)
 class NfsShare(NfsShareAdd):
     """
     Represents a NFS Share
@@ -194,17 +329,17 @@ class NfsShare(NfsShareAdd):
     # networks: list = field(default_factory=list)
     locked: bool = field(default=False)
 
-    @classmethod
-    def new_from_json(cls, json_str) -> NfsShare:
-        return super().new_from_json(json_str)
 
-
-@dataclass
+@dataclass(slots=True)
 class NfsShareDict(_base):
     """
-    Represents a list of NFS Shares
+    Represents a list of NFS Shares, indexed by path and by id
     """
     data: dict[str, NfsShare] = field(default_factory=dict)
+    # id -> path, kept in step with data
+    paths: dict[int, str] = field(default_factory=dict, repr=False)
+    # Sorted index of the paths, built on the first subtree query
+    _index: PathIndex = field(default=None, repr=False, compare=False)
 
     def __iter__(self):
         return iter(self.data.values())
@@ -222,12 +357,70 @@ class NfsShareDict(_base):
         id = nfs_share.path
         if id in self.data:
             raise Exception(f"Duplicate ID {id}")
-        self.data[id] = nfs_share
+        self.update(nfs_share)
 
     def update(self, nfs_share: NfsShare):
         if not isinstance(nfs_share, NfsShare):
             raise Exception("Invalid type")
+        previous = self.data.get(nfs_share.path)
+        if previous is not None and previous.id != nfs_share.id:
+            self.paths.pop(previous.id, None)
         self.data[nfs_share.path] = nfs_share
+        if nfs_share.id is not None:
+            self.paths[nfs_share.id] = nfs_share.path
+        if self._index is not None:
+            self._index.add(nfs_share.path)
+
+    def pop(self, path: str) -> NfsShare | None:
+        nfs_share = self.data.pop(path, None)
+        if nfs_share is not None:
+            self.paths.pop(nfs_share.id, None)
+            if self._index is not None:
+                self._index.discard(path)
+        return nfs_share
+
+    @property
+    def index(self) -> PathIndex:
+        if self._index is None:
+            self._index = PathIndex(self.data.keys())
+        return self._index
+
+    def subtree(self, path: str) -> NfsShareDict:
+        """
+        The NFS Shares under path, component-wise
+        """
+        new_dict = NfsShareDict()
+        for key in self.index.subtree(path):
+            new_dict.update(self.data[key])
+        return new_dict
+
+    def missing_from(self, paths: PathIndex | set[str], path: str = None) -> list[str]:
+        """
+        The share paths not in paths, only under path if given
+        """
+        return self.index.difference(paths, path)
+
+    def id_of(self, path: str) -> int | None:
+        """
+        The id of the NFS Share at path, None if there is none
+        """
+        nfs_share = self.data.get(path)
+        return None if nfs_share is None else nfs_share.id
+
+    def path_of(self, id: int) -> str | None:
+        """
+        The path of the NFS Share with this id, None if there is none
+        """
+        return self.paths.get(int(id))
+
+    def ids(self, paths: Iterable[str]) -> dict[str, int]:
+        """
+        Args:
+            paths: Share paths, those without a share are skipped
+        Returns:
+            dict of path -> id
+        """
+        return {path: self.data[path].id for path in paths if path in self.data}
 
     def get(self, path: str | list[str]) -> NfsShare | list[NfsShare]:
         """
@@ -246,8 +439,12 @@ class NfsShareDict(_base):
             raise Exception(f"ID {path} not found")
         return self.data[path]
 
-    def filter_by_path(self, path: str, mode: str = 'start_with') -> NfsShare:
+    def filter_by_path(self, path: str, mode: str = 'start_with') -> NfsShareDict:
         new_dict = NfsShareDict()
+        if mode == 'start_with':
+            for key in self.index.startswith(path):
+                new_dict.update(self.data[key])
+            return new_dict
         for nfs_share in self.data.values():
             if filter_str(nfs_share.path, path, mode):
                 new_dict.update(nfs_share)
@@ -259,22 +456,97 @@ class NfsShareDict(_base):
     def values(self) -> list[NfsShare]:
         return self.data.values()
 
+    def drifted(self, desired: NfsShareAdd, paths: Iterable[str] = None) -> dict[str, dict]:
+        """
+        The shares whose DRIFT_FIELDS differ from the desired config
+        Args:
+            desired: The desired config
+            paths: Only check these paths, default is all the shares
+        Returns:
+            dict of path -> fields to change
+        """
+        drifted = {}
+        for path in (self.data.keys() if paths is None else paths):
+            nfs_share = self.data.get(path)
+            if nfs_share is None:
+                continue
+            changes = nfs_share.drift(desired)
+            if changes:
+                drifted[path] = changes
+        return drifted
+
     @classmethod
     def new_from_json(cls, json_str: str) -> NfsShareDict:
-        dictData = json.loads(json_str)
+        return cls.new_from_list(json.loads(json_str))
+
+    @classmethod
+    def new_from_list(cls, list_data: Iterable[dict]) -> NfsShareDict:
         obj = cls()
-        for nfs_dict in dictData:
+        for nfs_dict in list_data:
             nfs_share = NfsShare.new_from_dict(nfs_dict)
             obj.update(nfs_share)
         return obj
 
 
+@dataclass
+class NfsParent:
+    """
+    Represents a parent dataset whose direct children are each shared over NFS
+    """
+    dataset_id: str = field(default=None)
+    real_path: str = field(default="/mnt")
+    common_config: NfsShareAdd = field(default=None)
+    filter_rules: FilterEngine = field(default=None)
+    remove: bool = field(default=True)
+    # Whether existing shares drifting from common_config are put back in line
+    fix_drift: bool = field(default=True)
+
+    def __post_init__(self):
+        if self.filter_rules is None:
+            self.filter_rules = _legacy_filter("_", "end_with", True)
+
+    @property
+    def share_prefix(self) -> str:
+        return f"{self.real_path}/{self.dataset_id}"
+
+    @property
+    def desired(self) -> NfsShareAdd:
+        """
+        The config every managed share should have
+        """
+        return self.common_config if isinstance(self.common_config, NfsShareAdd) else NfsShareAdd()
+
+    @property
+    def cache_key(self) -> str:
+        # Everything the outcome depends on is part of the key, a config change always misses
+        return json.dumps([self.dataset_id, self.real_path, repr(self.filter_rules), self.remove, self.fix_drift,
+                           repr(self.common_config)])
+
+    def is_child_path(self, path: str) -> bool:
+        """
+        Whether path is the share path of a direct child dataset
+        """
+        prefix = f"{self.share_prefix}/"
+        return path.startswith(prefix) and "/" not in path[len(prefix):] and len(path) > len(prefix)
+
+
 class TrueNAS:
 
     @dataclass
     class NfsModify:
         add: list = field(default_factory=list)
         remove: list = field(default_factory=list)
+        errors: dict = field(default_factory=dict)
+        # path -> fields to change, for the existing shares drifting from the common config
+        update: dict = field(default_factory=dict)
+        # path -> id of the existing shares referred to
+        share_ids: dict = field(default_factory=dict)
+        # Number of adds, removes and updates applied successfully
+        applied: int = 0
+
+        @property
+        def failed(self) -> bool:
+            return len(self.errors) > 0
 
         def filter(self, pattern: str, mode: str = 'start_with', reversed: bool = False):
             """
@@ -285,8 +557,18 @@ class TrueNAS:
             Returns:
                 list
             """
-            self.add = [item for item in self.add if filter_str(string=item, pattern=pattern, mode=mode, reversed=reversed)]
-            self.remove = [item for item in self.remove if filter_str(string=item, pattern=pattern, mode=mode, reversed=reversed)]
+            self.filter_rules(_legacy_filter(pattern, mode, reversed))
+
+        def filter_rules(self, engine: FilterEngine):
+            """
+            Filter the list with compiled include/exclude rules
+            Args:
+                engine: The compiled rules
+            """
+            self.add = engine.filter(self.add)
+            self.remove = engine.filter(self.remove)
+            if self.update:
+                self.update = {path: self.update[path] for path in engine.filter(self.update.keys())}
 
     def __init__(self,
                  host: str,
@@ -294,19 +576,86 @@ class TrueNAS:
                  prefix: str = "/api/v2.0",
                  verify_ssl: bool = True,
                  dry_run: bool = False,
+                 pool_size: int = 4,
+                 timeout: float = 30,
+                 apply_concurrency: int = 4,
+                 transport: str = TRANSPORT_REST,
+                 websocket_path: str = "/api/current",
+                 stream_listings: bool = False,
+                 stream_chunk_size: int = 64 * 1024,
+                 page_size: int = 0,
+                 bulk_size: int = 0,
+                 bulk_timeout: float = 600,
+                 rate_limit: float = 0,
+                 latency_target_sec: float = 2,
+                 compression: bool = True,
+                 metrics: Metrics = None,
+                 tracer: Tracer = None,
                  logger: logging.Logger = None
                  ):
-        self.__conn: http.client.HTTPSConnection = None
+        self.__pool: ConnectionPool = None
+        self.__rpc: JsonRpcClient = None
+        self.__events: JsonRpcClient = None
+        # One reconnect at a time, the other callers wait for it and use the new connection
+        self.__reconnect_lock = threading.Lock()
+        # After the connection attributes, which __del__ reads even when __init__ raises
+        if transport not in (TRANSPORT_REST, TRANSPORT_WEBSOCKET):
+            raise ValueError(f"Invalid transport {transport}, expected '{TRANSPORT_REST}' or '{TRANSPORT_WEBSOCKET}'")
+        self.__subscriptions: dict[str, Callable] = {}
+        self.cache = ReconcileCache()
+        # parent dataset id -> (dataset share paths, share path -> id) as left by the last cycle
+        self.observed: dict[str, tuple[set[str], dict[str, int]]] = {}
+        self.state_changed = False
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.tracer = tracer if tracer is not None else Tracer(host=host)
+        self.transport = transport
+        self.websocket_path = websocket_path
+        self.stream_listings = stream_listings
+        self.stream_chunk_size = stream_chunk_size
+        self.page_size = page_size
+        self.compression = compression
         self.host = host
         self.api_key = api_key
         self.prefix = prefix
         self.verify_ssl = verify_ssl
         self.dry_run = dry_run
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.apply_concurrency = max(1, apply_concurrency)
+        self.bulk_size = bulk_size
+        self.bulk_timeout = bulk_timeout
+        # Every request waits for the limiter; writes past apply_concurrency would only queue anyway
+        self.retries_429 = 3
+        self.limiter = RateLimiter(max_rate=rate_limit, max_concurrency=self.apply_concurrency,
+                                   latency_target_sec=latency_target_sec)
         if logger is not None and isinstance(logger, logging.Logger):
             self.logger = logger
         else:
             self.logger = logging.getLogger(__name__)
 
+    @classmethod
+    def new_from_config(cls, config, logger: logging.Logger = None, metrics: Metrics = None) -> TrueNAS:
+        """
+        Build the client for the host of a Config
+        """
+        return cls(
+            host=config.host,
+            api_key=config.api_key,
+            verify_ssl=config.ssl_verify,
+            dry_run=config.dry_run,
+            apply_concurrency=config.apply_concurrency,
+            transport=config.transport,
+            stream_listings=config.stream_listings,
+            page_size=config.page_size,
+            bulk_size=config.bulk_size,
+            rate_limit=config.rate_limit,
+            latency_target_sec=config.latency_target_sec,
+            compression=config.compression,
+            metrics=metrics,
+            tracer=Tracer.new_to_file(config.trace_file, host=config.host) if config.trace_file else None,
+            logger=logger
+        )
+
     def __enter__(self):
         self.connect()
         return self
@@ -319,12 +668,20 @@ class TrueNAS:
             self.close()
 
     @property
-    def conn(self) -> http.client.HTTPSConnection:
-        return self.__conn
+    def pool(self) -> ConnectionPool:
+        return self.__pool
+
+    @property
+    def rpc(self) -> JsonRpcClient:
+        return self.__rpc
+
+    @property
+    def is_websocket(self) -> bool:
+        return self.transport == TRANSPORT_WEBSOCKET
 
     @property
     def is_connected(self) -> bool:
-        return self.__conn is not None
+        return self.__pool is not None or self.__rpc is not None
 
     @property
     def headers(self) -> dict:
@@ -332,29 +689,150 @@ class TrueNAS:
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
             # "Accept": "application/json"
-            "Accept": "*/*"
+            "Accept": "*/*",
+            "Accept-Encoding": "gzip" if self.compression else "identity",
         }
 
-    def connect(self) -> http.client.HTTPSConnection:
+    def connect(self) -> ConnectionPool | JsonRpcClient:
+        """
+        Open the connection pool, or the WebSocket for the websocket transport. Connections are kept
+        alive until close() is called, so a long-running process should connect once and reuse them.
+        """
         if self.is_connected:
-            self.logger.info("Already connected")
-            return self.__conn
+            self.logger.debug("Already connected")
+            return self.__rpc if self.is_websocket else self.__pool
+        scheme = "wss" if self.is_websocket else "https"
         if not self.verify_ssl:
-            self.logger.info(f"Connecting to https://{self.host} without SSL verification")
-            context = ssl._create_unverified_context()
-            self.__conn = http.client.HTTPSConnection(self.host, context=context)
+            self.logger.info(f"Connecting to {scheme}://{self.host} without SSL verification")
         else:
-            self.logger.info(f"Connecting to https://{self.host}")
-            self.__conn = http.client.HTTPSConnection(self.host)
-        return self.__conn
+            self.logger.info(f"Connecting to {scheme}://{self.host}")
+        if self.is_websocket:
+            self.__rpc = JsonRpcClient(
+                host=self.host,
+                path=self.websocket_path,
+                verify_ssl=self.verify_ssl,
+                timeout=self.timeout,
+                logger=self.logger
+            )
+            self._login()
+            return self.__rpc
+        self.__pool = ConnectionPool(
+            host=self.host,
+            verify_ssl=self.verify_ssl,
+            size=max(self.pool_size, self.apply_concurrency),
+            timeout=self.timeout,
+            on_body=self._count_body,
+            logger=self.logger
+        )
+        return self.__pool
+
+    def _count_body(self, wire: int, decoded: int):
+        self.metrics.response_bytes.inc(wire, host=self.host, encoding="wire")
+        self.metrics.response_bytes.inc(decoded, host=self.host, encoding="decoded")
+
+    def _login(self, rpc: JsonRpcClient = None):
+        rpc = rpc or self.__rpc
+        rpc.connect()
+        if not rpc.call("auth.login_with_api_key", self.api_key):
+            rpc.close()
+            raise Exception("WebSocket authentication with the API key failed")
 
     def close(self):
         if not self.is_connected:
             self.logger.info("Already disconnected")
             return
-        self.logger.info("Closing connection")
-        self.__conn.close()
-        self.__conn = None
+        self.logger.info(f"Closing connection ({self.connection_stats})")
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool = None
+        if self.__rpc is not None:
+            self.__rpc.close()
+            self.__rpc = None
+        if self.__events is not None:
+            self.__events.close()
+            self.__events = None
+
+    @property
+    def connection_stats(self) -> dict:
+        """
+        Handshake and reuse counters of the connection pool, or of the WebSocket.
+        """
+        if self.__rpc is not None:
+            return {"handshakes": self.__rpc.handshakes, "calls": self.__rpc.calls, "limiter": self.limiter.stats()}
+        if self.__pool is not None:
+            return dict(self.__pool.stats, limiter=self.limiter.stats())
+        return {}
+
+    def subscribe(self, collection: str, handler: Callable[[dict], None]) -> JsonRpcClient:
+        """
+        Subscribe to the middleware events of a collection, e.g. "pool.dataset.query".
+        Events always come over a WebSocket, a dedicated one is opened for the rest transport.
+        Args:
+            collection: The event collection name
+            handler: Called with the event params ({"msg": "added", "id": ..., "fields": {...}})
+        Returns:
+            The JsonRpcClient carrying the events, check its `closed` to detect a lost subscription
+        """
+        self._validate_connection()
+        if self.is_websocket:
+            rpc = self.__rpc
+        else:
+            with self.__reconnect_lock:
+                if self.__events is None or self.__events.closed:
+                    self.__events = JsonRpcClient(
+                        host=self.host,
+                        path=self.websocket_path,
+                        verify_ssl=self.verify_ssl,
+                        timeout=self.timeout,
+                        logger=self.logger
+                    )
+                    self._login(self.__events)
+                rpc = self.__events
+
+        def on_event(method: str, params: dict):
+            if method == "collection_update" and isinstance(params, dict) and params.get("collection") == collection:
+                handler(params)
+
+        # Resubscribing after a reconnect replaces the previous handler of the collection
+        if collection in self.__subscriptions:
+            rpc.remove_notification(self.__subscriptions[collection])
+        self.__subscriptions[collection] = on_event
+        rpc.on_notification(on_event)
+        rpc.call("core.subscribe", collection)
+        return rpc
+
+    def call(self, method: str, *params, write: bool = False):
+        """
+        Call a middleware method over the WebSocket transport
+        Args:
+            method: The middleware method, e.g. "sharing.nfs.query"
+            params: The positional parameters of the method
+            write: If True, the call modifies the NAS and is skipped in dry_run
+        Returns:
+            The decoded result
+        """
+        self._validate_connection()
+        if write and self.dry_run:
+            self.logger.info(f"dry_run: {method} - {json.dumps(params)}")
+            return None
+        if self.__rpc.closed:
+            with self.__reconnect_lock:
+                if self.__rpc.closed:
+                    self.logger.info(f"WebSocket to {self.host} dropped, reconnecting")
+                    self._login()
+        self.limiter.acquire()
+        start = time.perf_counter()
+        status = "error"
+        try:
+            result = self.__rpc.call(method, *params)
+            status = "ok"
+            return result
+        except ErrRpc:
+            # Answered by the middleware, not a sign of overload
+            status = "rpc_error"
+            raise
+        finally:
+            self._request_done("CALL", method, status, time.perf_counter() - start, write=write)
 
     def format_request_path(self, path: str) -> str:
         """
@@ -371,24 +849,151 @@ class TrueNAS:
         if not self.is_connected:
             raise ErrNotConnected()
 
-    def _validate_response(self, res: http.client.HTTPResponse):
-        if res.status != 200:
-            raise Exception(f"Request failed with status {res.status}")
+    def _validate_response(self, status: int):
+        if status != 200:
+            raise Exception(f"Request failed with status {status}")
 
-    def get(self, path: str, params: dict = None) -> str:
+    def endpoint(self, path: str) -> str:
         """
-        Request a GET to the TrueNAS API
+        The endpoint of a request path for the metrics: without the prefix, the query string and the ids
+        """
+        path = path.split("?", 1)[0]
+        if path.startswith(self.prefix):
+            path = path[len(self.prefix):]
+        head, sep, _ = path.partition("/id/")
+        return f"{head}/id/{{id}}" if sep else path
+
+    def _request_done(self, method: str, endpoint: str, status: int | str, seconds: float, write: bool):
         """
+        Record a finished request and feed its outcome back to the limiter
+        """
+        self.metrics.request(self.host, method, endpoint, status, seconds)
+        self.tracer.record("api", seconds, status="ok" if status == "ok" or (isinstance(status, int) and status < 400) else "error", method=method,
+                           endpoint=endpoint, http_status=status)
+        if self.limiter.release(seconds, self.limiter.is_overloaded(status, seconds, write=write)):
+            self.metrics.throttled.inc(host=self.host)
+            stats = self.limiter.stats()
+            self.logger.warning(f"TrueNAS looks overloaded ({method} {endpoint}: {status} in {seconds:.2f}s), "
+                                f"limiting to {stats['rate']} requests/s and {stats['concurrency']} in flight")
+        self.metrics.limiter(self.host, self.limiter)
+
+    @contextmanager
+    def phase(self, name: str, **attributes):
+        """
+        Time a phase of the cycle into the metrics and as a tracing span
+        """
+        with self.metrics.phase(self.host, name), self.tracer.span(name, **attributes):
+            yield
+
+    def _request(self, method: str, path: str, data: str = None) -> str:
         self._validate_connection()
+        # A 429 was refused before being processed: retry it, the limiter has backed off meanwhile
+        for attempt in range(self.retries_429 + 1):
+            self.limiter.acquire()
+            start = time.perf_counter()
+            status = "error"
+            try:
+                status, body = self.pool.request(method, path, data, headers=self.headers)
+            finally:
+                self._request_done(method, self.endpoint(path), status, time.perf_counter() - start,
+                                   write=method != "GET")
+            if status != 429 or attempt == self.retries_429:
+                break
+            time.sleep(0.25 * 2 ** attempt)
+        self._validate_response(status)
+        return body
+
+    @staticmethod
+    def query_body(filters: list = None, options: dict = None) -> str | None:
+        """
+        Build the body of a TrueNAS query request
+        Args:
+            filters: query-filters, e.g. [["path", "^", "/mnt/data"]]
+            options: query-options, e.g. {"select": ["id", "path"]}
+        Returns:
+            The JSON body, or None if there is nothing to send
+        """
+        body = {}
+        if filters:
+            body["query-filters"] = filters
+        if options:
+            body["query-options"] = options
+        return json.dumps(body) if body else None
+
+    def get(self, path: str, params: dict = None, data: str = None) -> str:
+        """
+        Request a GET to the TrueNAS API, data is sent as the body (query-filters/query-options)
+        """
         path = self.format_request_path(path)
         if params:
             query_string = urllib.parse.urlencode(params)
             path = f"{path}?{query_string}"
-        self.conn.request("GET", path, headers=self.headers)
-        res = self.conn.getresponse()
-        self._validate_response(res)
-        data = res.read().decode()
-        return data
+        return self._request("GET", path, data)
+
+    def iter_query(self, path: str, filters: list = None, options: dict = None) -> Iterator[dict]:
+        """
+        Request a GET listing to the TrueNAS API and parse the response as it arrives,
+        yielding one item at a time instead of materialising the whole body
+        """
+        self._validate_connection()
+        path = self.format_request_path(path)
+        self.limiter.acquire()
+        start = time.perf_counter()
+        status = "error"
+        try:
+            with self.pool.response("GET", path, self.query_body(filters, options), headers=self.headers) as res:
+                status = res.status
+                self._validate_response(res.status)
+                body = self.pool.iter_body(res, self.stream_chunk_size)
+                yield from iter_json_array(body)
+                # Drain trailing whitespace so the connection can be reused
+                for _ in body:
+                    pass
+        finally:
+            self._request_done("GET", self.endpoint(path), status, time.perf_counter() - start, write=False)
+
+    def iter_pages(self, path: str, method: str, filters: list = None, options: dict = None,
+                   page_size: int = 1000, seek: str = None) -> Iterator[list[dict]]:
+        """
+        Fetch a listing one page at a time with the limit/offset query-options, requesting
+        the next page only once the previous one has been consumed.
+        With seek, a unique field the listing is ordered on, each page after the first asks for
+        the items past the last one seen (offset 0) instead of skipping an offset: adding or
+        removing items behind the cursor between two pages then shifts nothing.
+        Args:
+            path: The REST path of the listing, e.g. /sharing/nfs
+            method: The JSON-RPC query method of the listing, e.g. sharing.nfs.query
+            filters: query-filters
+            options: query-options, without limit and offset
+            page_size: Number of items per request
+            seek: Field to seek on, added to order_by and select
+        Returns:
+            Iterator over the pages, lists of items
+        """
+        options = dict(options or {})
+        if seek is not None:
+            options["order_by"] = [seek]
+            if options.get("select") and seek not in options["select"]:
+                options["select"] = [*options["select"], seek]
+        offset = 0
+        last = None
+        while True:
+            page_filters = list(filters or [])
+            if last is not None:
+                page_filters.append([seek, ">", last])
+            page_options = dict(options, limit=page_size, offset=0 if seek is not None else offset)
+            with self.tracer.span("fetch_page", path=path, offset=offset):
+                if self.is_websocket:
+                    page = self.call(method, page_filters, page_options)
+                else:
+                    page = json.loads(self.get(path, data=self.query_body(page_filters, page_options)))
+            if len(page) > 0:
+                yield page
+            if len(page) < page_size:
+                return
+            offset += len(page)
+            if seek is not None:
+                last = page[-1][seek]
 
     def post(self, path: str, data: str) -> str:
         """
@@ -399,11 +1004,18 @@ class TrueNAS:
         if self.dry_run:
             self.logger.info(f"dry_run: POST - {path} - {data}")
             return ""
-        self.conn.request("POST", path, data, headers=self.headers)
-        res = self.conn.getresponse()
-        self._validate_response(res)
-        data = res.read().decode()
-        return data
+        return self._request("POST", path, data)
+
+    def put(self, path: str, data: str) -> str:
+        """
+        Request a PUT to the TrueNAS API
+        """
+        self._validate_connection()
+        path = self.format_request_path(path)
+        if self.dry_run:
+            self.logger.info(f"dry_run: PUT - {path} - {data}")
+            return ""
+        return self._request("PUT", path, data)
 
     def delete(self, path: str) -> str:
         """
@@ -413,11 +1025,8 @@ class TrueNAS:
         path = self.format_request_path(path)
         if self.dry_run:
             self.logger.info(f"dry_run: DELETE - {path}")
-        self.conn.request("DELETE", path, headers=self.headers)
-        res = self.conn.getresponse()
-        self._validate_response(res)
-        data = res.read().decode()
-        return data
+            return ""
+        return self._request("DELETE", path)
 
     def add_nfs_share(self, nfs_share: NfsShareAdd) -> NfsShare:
         """
@@ -429,9 +1038,29 @@ class TrueNAS:
         """
         data = nfs_share.to_json()
         self.logger.debug(f"Adding NFS Share: {data}")
-        data = self.post("/sharing/nfs", data)
-        self.logger.debug(f"Post return: {data}")
-        return NfsShare.new_from_json(data)
+        if self.is_websocket:
+            result = self.call("sharing.nfs.create", json.loads(data), write=True)
+            self.logger.debug(f"Create return: {result}")
+            return NfsShare.new_from_dict(result if result else json.loads(data))
+        result = self.post("/sharing/nfs", data)
+        self.logger.debug(f"Post return: {result}")
+        # dry_run returns an empty body
+        return NfsShare.new_from_json(result if result else data)
+
+    def modify_nfs_share(self, id: int, changes: dict) -> dict:
+        """
+        Update some fields of a NFS Share
+        Args:
+            id: The ID of the NFS Share to update
+            changes: The fields to change and their new values
+        Returns:
+            The updated share as returned by TrueNAS, the changes in dry_run
+        """
+        self.logger.debug(f"Updating NFS Share {id}: {changes}")
+        if self.is_websocket:
+            return self.call("sharing.nfs.update", int(id), changes, write=True) or changes
+        result = self.put(f"/sharing/nfs/id/{int(id)}", json.dumps(changes))
+        return json.loads(result) if result else changes
 
     def delete_nfs_share(self, id: str | int) -> str:
         """
@@ -441,120 +1070,728 @@ class TrueNAS:
         Returns:
             str
         """
-        if isinstance(id, int):
-            id = str(id)
-        elif not isinstance(id, str):
-            id = str(int(id))
-        else:
-            raise Exception("Invalid ID, it must be a string or an integer")
+        if isinstance(id, bool) or not isinstance(id, (str, int)) or not str(id).isdigit():
+            raise Exception(f"Invalid ID {id!r}, it must be an integer or a string of digits")
+        id = str(int(id))
+        if self.is_websocket:
+            return json.dumps(self.call("sharing.nfs.delete", int(id), write=True))
         return self.delete(f"/sharing/nfs/id/{id}")
 
-    def get_nfs_share(self, id: str = None) -> NfsShare | NfsShareDict:
+    def get_nfs_share(self, id: str = None, filters: list = None, options: dict = None) -> NfsShare | NfsShareDict:
         """
         Get a NFS Share configuration
         Args:
             id: The ID of the NFS Share to get; if None, all NFS Shares will be returned
+            filters: query-filters applied by TrueNAS when listing all NFS Shares
+            options: query-options (e.g. select) applied by TrueNAS when listing all NFS Shares
         Returns:
             NfsShare | NfsShareDict
         """
+        if self.is_websocket:
+            if id is not None and id != "":
+                return NfsShare.new_from_dict(self.call("sharing.nfs.get_instance", int(id)))
+            return NfsShareDict.new_from_list(self.call("sharing.nfs.query", filters or [], options or {}))
         all = False
+        body = None
         if id is not None and id != "":
-            path = f"/sharing/nfs/{id}"
+            path = f"/sharing/nfs/id/{id}"
+        elif self.stream_listings:
+            return NfsShareDict.new_from_list(self.iter_query("/sharing/nfs", filters, options))
         else:
             path = "/sharing/nfs"
             all = True
-        data = self.get(path)
-        if all:
-            return NfsShareDict.new_from_json(data)
-        else:
+            body = self.query_body(filters, options)
+        data = self.get(path, data=body)
+        with self.tracer.span("decode", model="NfsShareDict" if all else "NfsShare", bytes=len(data)):
+            if all:
+                return NfsShareDict.new_from_json(data)
             return NfsShare.new_from_json(data)
 
-    def get_nfs_share_id_by_path(self, path: str | list[str]) -> str | list[str]:
+    def get_nfs_share_id_by_path(self, path: str | list[str]) -> int | list[int]:
         """
-        Get the NFS Share ID by path
+        Get the NFS Share ID by path, with one filtered listing of only these paths.
+        Prefer NfsShareDict.id_of / NfsModify.share_ids when a listing is already at hand.
         Args:
+            path: The share path, or a list of share paths
+        Returns:
+            int | list[int]: The id, or the ids of the paths that have a share
         """
-        nfs_shares: NfsShareDict = self.get_nfs_share()
-        print(nfs_shares)
-        nfs_share_list = nfs_shares.get(path)
-        print(nfs_share_list)
+        paths = path if isinstance(path, list) else [path]
+        nfs_shares: NfsShareDict = self.get_nfs_share(
+            filters=[["path", "in", paths]],
+            options={"select": ["id", "path"]}
+        )
         if isinstance(path, list):
-            return [nfs_share.id for nfs_share in nfs_share_list if nfs_share is not None]
-        return nfs_share_list.id
+            return [nfs_share.id for nfs_share in nfs_shares.get(path) if nfs_share is not None]
+        return nfs_shares.get(path).id
 
-    def get_dataset(self, id: str = None, params: dict = None) -> DataSet:
+    def get_dataset(self, id: str = None, params: dict = None, filters: list = None, options: dict = None) -> DataSet | DataSetDict:
         """
         Get a Dataset configuration
         Args:
             id: The ID of the Dataset to get, if None, all Datasets will be returned
+            params: URL query parameters
+            filters: query-filters applied by TrueNAS when listing all Datasets
+            options: query-options (e.g. select, extra.properties) applied by TrueNAS when listing all Datasets
         Returns:
-            DataSet
+            DataSet | DataSetDict
         """
+        if self.is_websocket:
+            if id is not None and id != "":
+                return DataSet.new_from_dict(self.call(
+                    "pool.dataset.query", [["id", "=", id]], {"get": True, "extra": {"retrieve_children": True}}))
+            return DataSetDict.new_from_list(self.call("pool.dataset.query", filters or [], options or {}))
+        all = False
+        body = None
         if id is not None and id != "":
             id_encoded = urllib.parse.quote(id, safe="")
             path = f"/pool/dataset/id/{id_encoded}"
+        elif self.stream_listings and params is None:
+            return DataSetDict.new_from_list(self.iter_query("/pool/dataset", filters, options))
         else:
             path = "/pool/dataset"
+            all = True
+            body = self.query_body(filters, options)
         if params is not None:
             params["extra.retrieve_children"] = "true"
-        data = self.get(path=path, params=params)
-        return DataSet.new_from_json(data)
+        data = self.get(path=path, params=params, data=body)
+        with self.tracer.span("decode", model="DataSetDict" if all else "DataSet", bytes=len(data)):
+            if all:
+                return DataSetDict.new_from_json(data)
+            return DataSet.new_from_json(data)
+
+    @staticmethod
+    def prefix_filters(name: str, prefixes: list[str]) -> list:
+        """
+        query-filters matching the items whose field starts with any of the prefixes
+        """
+        if len(prefixes) == 1:
+            return [[name, "^", prefixes[0]]]
+        return [["OR", [[name, "^", prefix] for prefix in prefixes]]]
 
-    def compare_nfs_with_personal_dataset(self, parent_dataset_id: str, parent_real_path: str = "/mnt") -> TrueNAS.NfsModify:
+    def get_child_datasets(self, parent_dataset_id: str | list[str]) -> DataSetDict:
         """
-        compare the NFS shares with the personal dataset
+        Get the direct children of one or more Datasets, with only their id and name
+        Args:
+            parent_dataset_id: The parent dataset id, or a list of them fetched in one request
+        Returns:
+            DataSetDict
+        """
+        parent_ids = [parent_dataset_id] if isinstance(parent_dataset_id, str) else list(parent_dataset_id)
+        datasets = self.get_dataset(
+            filters=self.prefix_filters("id", [f"{parent_id}/" for parent_id in parent_ids]),
+            options={
+                "select": ["id", "name"],
+                "extra": {"flat": True, "retrieve_children": False, "properties": []}
+            }
+        )
+        # The prefix filter also matches grandchildren, keep only the direct children
+        parents = set(parent_ids)
+        dataset_dict = DataSetDict()
+        dataset_dict.update([ds for ds in datasets if ds.id.rpartition("/")[0] in parents])
+        return dataset_dict
+
+    def fetch_nfs_states(self, parents: list[NfsParent]) -> dict[str, tuple[set[str], NfsShareDict]]:
+        """
+        Fetch, for every parent, the share paths its personal datasets should have and the NFS shares
+        under it. The datasets and the shares of all parents are each fetched in one request.
+        Args:
+            parents: The parent datasets
+        Returns:
+            dict of parent dataset id -> (dataset share paths, NFS shares)
+        """
+        by_dataset = {parent.dataset_id: parent for parent in parents}
+        states = {parent.dataset_id: (set(), NfsShareDict()) for parent in parents}
+        with self.phase("fetch_datasets"):
+            datasets = self.get_child_datasets(list(by_dataset.keys()))
+        for dataset_id in datasets.keys():
+            parent = by_dataset[dataset_id.rpartition("/")[0]]
+            states[parent.dataset_id][0].add(f"{parent.real_path}/{dataset_id}")
+        with self.phase("fetch_shares"):
+            nfs_shares: NfsShareDict = self.get_nfs_share(
+                filters=self.prefix_filters("path", [f"{parent.share_prefix}/" for parent in parents]),
+                options={"select": ["id", "path", *DRIFT_FIELDS]}
+            )
+        # A share under nested parents belongs to the innermost one. Shares under no parent, the
+        # parents' own shares among them, are dropped, which keeps the result right if the filters
+        # are ignored.
+        by_prefix = {parent.share_prefix: parent for parent in parents}
+        prefixes = PathIndex(by_prefix.keys())
+        for nfs_share in nfs_shares:
+            owner = by_prefix.get(prefixes.innermost(nfs_share.path))
+            if owner is not None:
+                states[owner.dataset_id][1].update(nfs_share)
+        return states
+
+    def fetch_nfs_state(self, parent_dataset_id: str, parent_real_path: str = "/mnt") -> tuple[set[str], NfsShareDict]:
+        """
+        Fetch the share paths the personal datasets should have and the NFS shares under the parent
         Args:
             parent_dataset_id: The parent dataset id
             parent_real_path: The parent real path, default is "/mnt"
+        Returns:
+            (dataset share paths, NFS shares)
+        """
+        return self.fetch_nfs_states([NfsParent(dataset_id=parent_dataset_id, real_path=parent_real_path)])[parent_dataset_id]
+
+    @staticmethod
+    def diff_nfs_state(dataset_keys: set[str], nfs_shares: NfsShareDict, drifted: dict[str, dict] = None,
+                       parent: NfsParent = None) -> TrueNAS.NfsModify:
+        """
+        Args:
+            dataset_keys: The share paths the datasets should have
+            nfs_shares: The existing shares
+            drifted: The shares drifting from the common config, see NfsShareDict.drifted
+            parent: If given, only the shares of its direct children are removed; the parent's own
+                share, siblings sharing its name as a prefix and shares deeper down are left alone
         """
-        datasets = self.get_dataset(parent_dataset_id)
-        dataset_dict = DataSetDict()
-        dataset_dict.update(datasets.children)
-        nfs_shares: NfsShareDict = self.get_nfs_share()
-        nfs_shares = nfs_shares.filter_by_path(f"{parent_real_path}/{parent_dataset_id}", mode='start_with')
         nfs_shares_keys = nfs_shares.keys()
-        dataset_keys = dataset_dict.keys()
-        dataset_keys = set([f"{parent_real_path}/{key}" for key in dataset_keys])
         not_in_nfs = list(dataset_keys - nfs_shares_keys)
-        not_in_dataset = list(nfs_shares_keys - dataset_keys)
+        not_in_dataset = [path for path in nfs_shares_keys - dataset_keys if parent is None or parent.is_child_path(path)]
         nfs_modify = TrueNAS.NfsModify(add=not_in_nfs, remove=not_in_dataset)
+        if isinstance(nfs_shares, NfsShareDict):
+            nfs_modify.share_ids = nfs_shares.ids(not_in_dataset)
+        else:
+            nfs_modify.share_ids = {path: nfs_shares[path] for path in not_in_dataset}
+        if drifted:
+            nfs_modify.update = drifted
+            nfs_modify.share_ids.update(nfs_shares.ids(drifted.keys()))
         return nfs_modify
 
+    def compare_nfs_with_personal_dataset(self, parent_dataset_id: str, parent_real_path: str = "/mnt") -> TrueNAS.NfsModify:
+        """
+        compare the NFS shares with the personal dataset
+        Args:
+            parent_dataset_id: The parent dataset id
+            parent_real_path: The parent real path, default is "/mnt"
+        """
+        dataset_keys, nfs_shares = self.fetch_nfs_state(parent_dataset_id, parent_real_path)
+        return self.diff_nfs_state(dataset_keys, nfs_shares,
+                                   parent=NfsParent(dataset_id=parent_dataset_id, real_path=parent_real_path))
+
+    def compare_nfs_paths(self, parent_dataset_id: str, paths: list[str], parent_real_path: str = "/mnt",
+                          desired: NfsShareAdd = None) -> TrueNAS.NfsModify:
+        """
+        compare the NFS shares with the personal dataset, only for the given share paths
+        Args:
+            parent_dataset_id: The parent dataset id
+            paths: The share paths to check, direct children of the parent real path
+            parent_real_path: The parent real path, default is "/mnt"
+            desired: If given, the existing shares drifting from it are updated
+        """
+        parent = NfsParent(dataset_id=parent_dataset_id, real_path=parent_real_path)
+        paths = set(path for path in paths if parent.is_child_path(path))
+        if len(paths) == 0:
+            return TrueNAS.NfsModify()
+        dataset_ids = [path[len(parent_real_path) + 1:] for path in paths]
+        datasets = self.get_dataset(
+            filters=[["id", "in", dataset_ids]],
+            options={
+                "select": ["id", "name"],
+                "extra": {"flat": True, "retrieve_children": False, "properties": []}
+            }
+        )
+        nfs_shares: NfsShareDict = self.get_nfs_share(
+            filters=[["path", "in", list(paths)]],
+            options={"select": ["id", "path", *DRIFT_FIELDS]}
+        )
+        nfs_shares_keys = nfs_shares.keys() & paths
+        dataset_keys = set([f"{parent_real_path}/{key}" for key in datasets.keys()]) & paths
+        nfs_modify = TrueNAS.NfsModify(add=list(dataset_keys - nfs_shares_keys), remove=list(nfs_shares_keys - dataset_keys))
+        nfs_modify.share_ids = nfs_shares.ids(nfs_modify.remove)
+        if desired is not None:
+            nfs_modify.update = nfs_shares.drifted(desired, nfs_shares_keys & dataset_keys)
+            nfs_modify.share_ids.update(nfs_shares.ids(nfs_modify.update.keys()))
+        return nfs_modify
+
+    def iter_share_pages(self, parent: NfsParent, page_size: int) -> Iterator[list[NfsShare]]:
+        """
+        The NFS shares under the parent, page by page in path order
+        """
+        pages = self.iter_pages(
+            "/sharing/nfs", "sharing.nfs.query",
+            filters=self.prefix_filters("path", [f"{parent.share_prefix}/"]),
+            options={"select": ["id", "path", *DRIFT_FIELDS]},
+            page_size=page_size, seek="path")
+        for page in pages:
+            with self.tracer.span("decode", model="NfsShare", items=len(page)):
+                nfs_shares = [NfsShare.new_from_dict(item) for item in page]
+            yield nfs_shares
+
+    def iter_dataset_paths(self, parent: NfsParent, page_size: int) -> Iterator[str]:
+        """
+        The share paths of the direct children of the parent, in path order
+        """
+        pages = self.iter_pages(
+            "/pool/dataset", "pool.dataset.query",
+            filters=self.prefix_filters("id", [f"{parent.dataset_id}/"]),
+            options={"select": ["id"], "extra": {"flat": True, "retrieve_children": False, "properties": []}},
+            page_size=page_size, seek="id")
+        for page in pages:
+            for item in page:
+                # The prefix filter also matches grandchildren
+                if item["id"].rpartition("/")[0] == parent.dataset_id:
+                    yield f"{parent.real_path}/{item['id']}"
+
+    @staticmethod
+    def diff_sorted(dataset_paths: Iterable[str], nfs_shares: Iterable[NfsShare],
+                    parent: NfsParent) -> Iterator[tuple[str, str, int | None, dict | None]]:
+        """
+        Merge two listings sorted by path into the changes that bring the shares in line,
+        holding one item of each
+        Args:
+            dataset_paths: The share paths the datasets should have, sorted
+            nfs_shares: The existing shares, sorted by path
+            parent: The parent dataset: its desired config, and only the shares of its direct
+                children are removed
+        Returns:
+            Iterator over (action, path, share id, fields to change), action being add, remove or update
+        Raises:
+            ErrPageOrder: A listing is not sorted, e.g. order_by was ignored
+        """
+        dataset_paths = iter(dataset_paths)
+        nfs_shares = iter(nfs_shares)
+        dataset_path = next(dataset_paths, None)
+        nfs_share = next(nfs_shares, None)
+        last_dataset_path, last_share_path = "", ""
+        while dataset_path is not None or nfs_share is not None:
+            if dataset_path is not None and dataset_path < last_dataset_path:
+                raise ErrPageOrder(f"Dataset {dataset_path} listed after {last_dataset_path}")
+            if nfs_share is not None and nfs_share.path < last_share_path:
+                raise ErrPageOrder(f"NFS share {nfs_share.path} listed after {last_share_path}")
+            if nfs_share is None or (dataset_path is not None and dataset_path < nfs_share.path):
+                yield "add", dataset_path, None, None
+                last_dataset_path, dataset_path = dataset_path, next(dataset_paths, None)
+            elif dataset_path is None or nfs_share.path < dataset_path:
+                if parent.is_child_path(nfs_share.path):
+                    yield "remove", nfs_share.path, nfs_share.id, None
+                last_share_path, nfs_share = nfs_share.path, next(nfs_shares, None)
+            else:
+                changes = nfs_share.drift(parent.desired) if parent.fix_drift else None
+                if changes:
+                    yield "update", nfs_share.path, nfs_share.id, changes
+                last_dataset_path, dataset_path = dataset_path, next(dataset_paths, None)
+                last_share_path, nfs_share = nfs_share.path, next(nfs_shares, None)
+
+    def reconcile_paged(self, parent: NfsParent, page_size: int, owners: PathIndex = None) -> TrueNAS.NfsModify:
+        """
+        Reconcile the NFS shares of the parent as a pipeline of generators: fetch page -> decode ->
+        filter -> diff -> apply. Changes are applied in batches of page_size as the diff finds them,
+        while the next pages are still to be fetched, so memory holds a page of each listing and a
+        batch of changes whatever the number of shares. The reconcile cache and the observed state
+        are not kept, both are as large as the listings.
+        Args:
+            parent: The parent dataset
+            page_size: Number of items per listing request and per apply batch
+            owners: The share prefixes of all the parents reconciled, shares under a nested parent
+                are left to it
+        Returns:
+            The changes applied, with their failures
+        """
+        def owned(nfs_share_pages: Iterator[list[NfsShare]]) -> Iterator[NfsShare]:
+            for nfs_shares in nfs_share_pages:
+                for nfs_share in nfs_shares:
+                    if owners is not None and owners.innermost(nfs_share.path) != parent.share_prefix:
+                        continue
+                    if parent.filter_rules(nfs_share.path):
+                        yield nfs_share
+
+        dataset_paths = (path for path in self.iter_dataset_paths(parent, page_size) if parent.filter_rules(path))
+        nfs_shares = owned(self.iter_share_pages(parent, page_size))
+        changes = self.diff_sorted(dataset_paths, nfs_shares, parent)
+        total = TrueNAS.NfsModify()
+        batch = TrueNAS.NfsModify()
+        for action, path, share_id, fields_to_change in changes:
+            if action == "add":
+                batch.add.append(path)
+            elif action == "remove":
+                batch.remove.append(path)
+                batch.share_ids[path] = share_id
+            else:
+                batch.update[path] = fields_to_change
+                batch.share_ids[path] = share_id
+            if len(batch.add) + len(batch.remove) + len(batch.update) >= page_size:
+                self._apply_batch(parent, batch, total)
+                batch = TrueNAS.NfsModify()
+        self._apply_batch(parent, batch, total)
+        return total
+
+    def _apply_batch(self, parent: NfsParent, batch: TrueNAS.NfsModify, total: TrueNAS.NfsModify):
+        """
+        Apply a batch of reconcile_paged and add its outcome to total
+        """
+        if len(batch.add) == 0 and len(batch.update) == 0 and (len(batch.remove) == 0 or not parent.remove):
+            total.remove.extend(batch.remove)
+            return
+        with self.phase("apply", dataset=parent.dataset_id, add=len(batch.add), remove=len(batch.remove),
+                        update=len(batch.update)):
+            self.apply_nfs_modify(batch, common_config=parent.common_config, remove=parent.remove)
+        total.add.extend(batch.add)
+        total.remove.extend(batch.remove)
+        total.update.update(batch.update)
+        total.errors.update(batch.errors)
+        total.applied += batch.applied
+
     def update_nfs_share(self, parent_dataset_id: str,
                          parent_real_path: str = "/mnt",
                          common_config: NfsShareAdd = None,
                          filter_path_pattern: str = "_",
                          filter_path_mode: str = "end_with",
                          filter_path_reversed: bool = True,
-                         remove: bool = True) -> TrueNAS.NfsModify:
-        self.logger.debug(f"Updating NFS Share for {parent_dataset_id}")
-        self.logger.debug(f"Parent Real Path: {parent_real_path}")
-        self.logger.debug(f"Common Config: {common_config}")
-        self.logger.debug(f"Filter Path Pattern: {filter_path_pattern}")
-        self.logger.debug(f"Filter Path Mode: {filter_path_mode}")
-        self.logger.debug(f"Filter Path Reversed: {filter_path_reversed}")
-        self.logger.debug(f"NFS Auto Remove: {remove}")
-        nfs_modify = self.compare_nfs_with_personal_dataset(parent_dataset_id=parent_dataset_id, parent_real_path=parent_real_path)
-        nfs_modify.filter(pattern=filter_path_pattern, mode=filter_path_mode, reversed=filter_path_reversed)
+                         remove: bool = True,
+                         paths: list[str] = None,
+                         filter_rules: FilterEngine = None) -> TrueNAS.NfsModify:
+        """
+        Reconcile the NFS shares of the parent dataset
+        Args:
+            paths: If given, only these share paths are checked instead of the whole parent
+            filter_rules: Compiled include/exclude rules, replacing the filter_path_* arguments
+        """
+        if filter_rules is None:
+            filter_rules = _legacy_filter(filter_path_pattern, filter_path_mode, filter_path_reversed)
+        parent = NfsParent(
+            dataset_id=parent_dataset_id,
+            real_path=parent_real_path,
+            common_config=common_config,
+            filter_rules=filter_rules,
+            remove=remove
+        )
+        return self.update_nfs_shares([parent], paths=paths).get(parent_dataset_id, TrueNAS.NfsModify())
+
+    def update_nfs_shares(self, parents: list[NfsParent], paths: list[str] = None) -> dict[str, TrueNAS.NfsModify]:
+        """
+        Reconcile the NFS shares of several parent datasets from one dataset and one share listing
+        Args:
+            parents: The parent datasets, each with its own filter and common config
+            paths: If given, only these share paths are checked instead of the whole parents
+        Returns:
+            dict of parent dataset id -> NfsModify
+        """
+        with self.tracer.span("cycle", parents=len(parents), targeted=paths is not None):
+            return self._update_nfs_shares(parents, paths)
+
+    def _update_nfs_shares(self, parents: list[NfsParent], paths: list[str] = None) -> dict[str, TrueNAS.NfsModify]:
+        results: dict[str, TrueNAS.NfsModify] = {}
+        if paths is not None:
+            for parent in parents:
+                parent_paths = [path for path in paths if parent.is_child_path(path)]
+                if len(parent_paths) == 0:
+                    continue
+                nfs_modify = self.compare_nfs_paths(parent_dataset_id=parent.dataset_id, paths=parent_paths,
+                                                    parent_real_path=parent.real_path,
+                                                    desired=parent.desired if parent.fix_drift else None)
+                nfs_modify.filter_rules(parent.filter_rules)
+                results[parent.dataset_id] = self.apply_nfs_modify(nfs_modify, common_config=parent.common_config,
+                                                                   remove=parent.remove)
+                self._observe(parent.dataset_id, nfs_modify, parent.remove)
+            return results
+        if self.page_size > 0:
+            owners = PathIndex(parent.share_prefix for parent in parents)
+            with self.metrics.cycle_seconds.time(host=self.host):
+                for parent in parents:
+                    with self.tracer.span("reconcile_paged", dataset=parent.dataset_id, page_size=self.page_size):
+                        results[parent.dataset_id] = self.reconcile_paged(parent, self.page_size, owners)
+                    # The observed state of this parent is out of date now, and too large to be kept
+                    if self.observed.pop(parent.dataset_id, None) is not None:
+                        self.state_changed = True
+            if not any(nfs_modify.failed for nfs_modify in results.values()):
+                self.metrics.last_success.set(time.time(), host=self.host)
+            return results
+        with self.metrics.cycle_seconds.time(host=self.host):
+            states = self.fetch_nfs_states(parents)
+            for parent in parents:
+                self.logger.debug(f"Updating NFS Share for {parent}")
+                with self.phase("diff", dataset=parent.dataset_id):
+                    dataset_keys, nfs_shares = states[parent.dataset_id]
+                    # Only the shares backed by a dataset are kept in line, the others are removed
+                    drifted = nfs_shares.drifted(parent.desired, nfs_shares.keys() & dataset_keys) \
+                        if parent.fix_drift else {}
+                    fingerprints = (fingerprint(dataset_keys), fingerprint(nfs_shares.keys()), fingerprint(drifted.keys()))
+                    if self.cache.matches(parent.cache_key, fingerprints):
+                        self.logger.debug(f"Nothing changed for {parent.dataset_id} since the last reconcile, skipping")
+                        results[parent.dataset_id] = TrueNAS.NfsModify()
+                        continue
+                    nfs_modify = self.diff_nfs_state(dataset_keys, nfs_shares, drifted, parent=parent)
+                    nfs_modify.filter_rules(parent.filter_rules)
+                    if len(nfs_modify.add) == 0 and len(nfs_modify.update) == 0 and \
+                            (len(nfs_modify.remove) == 0 or not parent.remove):
+                        # Only a converged state is cached, pending changes are retried by the next cycle
+                        self.cache.store(parent.cache_key, fingerprints)
+                with self.phase("apply", dataset=parent.dataset_id, add=len(nfs_modify.add),
+                                remove=len(nfs_modify.remove), update=len(nfs_modify.update)):
+                    results[parent.dataset_id] = self.apply_nfs_modify(nfs_modify, common_config=parent.common_config,
+                                                                       remove=parent.remove)
+                self.observed[parent.dataset_id] = (dataset_keys, {nfs_share.path: nfs_share.id for nfs_share in nfs_shares})
+                self._observe(parent.dataset_id, nfs_modify, parent.remove)
+        if not any(nfs_modify.failed for nfs_modify in results.values()):
+            self.metrics.last_success.set(time.time(), host=self.host)
+        return results
+
+    def _observe(self, parent_dataset_id: str, nfs_modify: TrueNAS.NfsModify, remove: bool):
+        """
+        Carry the changes applied by nfs_modify into the observed state of the parent
+        """
+        observed = self.observed.get(parent_dataset_id)
+        if observed is None:
+            return
+        dataset_keys, share_ids = observed
+        if remove:
+            for path in nfs_modify.remove:
+                if path not in nfs_modify.errors:
+                    dataset_keys.discard(path)
+                    share_ids.pop(path, None)
+        for path in nfs_modify.add:
+            if path not in nfs_modify.errors:
+                dataset_keys.add(path)
+                share_ids[path] = nfs_modify.share_ids.get(path)
+        self.state_changed = True
+
+    def warm_start(self, parents: list[NfsParent]) -> dict[str, TrueNAS.NfsModify]:
+        """
+        Act on the observed state loaded by import_state without listing the pool: the provisional
+        diff of every parent is confirmed by a targeted check of only its paths, then applied.
+        The provisional diff compares the saved datasets with the saved shares, so it only finds what
+        the last run left pending; changes made on the pool since then need a full cycle. Parents
+        without an observed state are left to the next full cycle.
+        Returns:
+            dict of parent dataset id -> NfsModify
+        """
+        paths = []
+        for parent in parents:
+            observed = self.observed.get(parent.dataset_id)
+            if observed is None:
+                continue
+            dataset_keys, share_ids = observed
+            nfs_modify = self.diff_nfs_state(dataset_keys, share_ids, parent=parent)
+            nfs_modify.filter_rules(parent.filter_rules)
+            paths += nfs_modify.add
+            if parent.remove:
+                paths += nfs_modify.remove
+        self.logger.info(f"Warm start: {len(paths)} pending changes in the saved state")
+        if len(paths) == 0:
+            return {}
+        return self.update_nfs_shares(parents, paths=paths)
+
+    def export_state(self) -> dict:
+        """
+        The observed state and the reconcile cache, as plain data for the state file
+        """
+        self.state_changed = False
+        return {
+            "version": STATE_VERSION,
+            "host": self.host,
+            "parents": {
+                parent_dataset_id: {"datasets": list(dataset_keys), "shares": share_ids}
+                for parent_dataset_id, (dataset_keys, share_ids) in self.observed.items()
+            },
+            "cache": self.cache.dump(),
+        }
+
+    def import_state(self, state: dict) -> bool:
+        """
+        Restore a state saved by export_state
+        Returns:
+            False if the state is for another host
+        """
+        if state.get("host") != self.host:
+            return False
+        self.observed = {
+            parent_dataset_id: (set(parent_state["datasets"]), dict(parent_state["shares"]))
+            for parent_dataset_id, parent_state in state.get("parents", {}).items()
+        }
+        self.cache.load(state.get("cache", {}))
+        return True
+
+    def apply_nfs_modify(self, nfs_modify: TrueNAS.NfsModify, common_config: NfsShareAdd = None, remove: bool = True) -> TrueNAS.NfsModify:
+        """
+        Apply the NFS Share removes, updates and adds, collecting the failures into nfs_modify.errors
+        """
         if remove and len(nfs_modify.remove) > 0:
             self.logger.info("Removing NFS Shares")
-            for path in nfs_modify.remove:
-                try:
-                    self.delete_nfs_share(path)
-                    self.logger.info(f"Removed {path}")
-                except Exception as e:
-                    self.logger.info(f"Failed to remove {path}: {e}")
+            self.resolve_share_ids(nfs_modify, nfs_modify.remove)
+            errors = self.apply_items(
+                lambda path: self.delete_nfs_share(nfs_modify.share_ids[path]),
+                nfs_modify.remove, done="Removed", action="remove",
+                bulk_method="sharing.nfs.delete", bulk_params=lambda path: [nfs_modify.share_ids[path]])
+            nfs_modify.errors.update(errors)
+            nfs_modify.applied += len(nfs_modify.remove) - len(errors)
+            self.metrics.shares.inc(len(nfs_modify.remove) - len(errors), host=self.host, result="removed")
+            self.metrics.shares.inc(len(errors), host=self.host, result="failed")
+        if len(nfs_modify.update) > 0:
+            self.logger.info("Updating NFS Shares")
+            errors = self.apply_items(
+                lambda path: self.modify_nfs_share(nfs_modify.share_ids[path], nfs_modify.update[path]),
+                list(nfs_modify.update.keys()), done="Updated", action="update",
+                bulk_method="sharing.nfs.update",
+                bulk_params=lambda path: [nfs_modify.share_ids[path], nfs_modify.update[path]])
+            nfs_modify.errors.update(errors)
+            nfs_modify.applied += len(nfs_modify.update) - len(errors)
+            self.metrics.shares.inc(len(nfs_modify.update) - len(errors), host=self.host, result="updated")
+            self.metrics.shares.inc(len(errors), host=self.host, result="failed")
         if len(nfs_modify.add) == 0:
-            return
+            return nfs_modify
         self.logger.info("Adding NFS Shares")
         nfs_share = common_config
         if nfs_share is None or not isinstance(nfs_share, NfsShareAdd):
             self.logger.debug("Does not have common config, using default")
             nfs_share = NfsShareAdd()
-        for path in nfs_modify.add:
+        # Each worker gets its own copy, the common config must not be shared between threads.
+        added: dict[str, NfsShare] = {}
+        errors = self.apply_items(
+            lambda path: self.add_nfs_share(replace(nfs_share, path=path)),
+            nfs_modify.add, done="Added", action="add", results=added,
+            bulk_method="sharing.nfs.create", bulk_params=lambda path: [replace(nfs_share, path=path).to_dict()],
+            bulk_result=NfsShare.new_from_dict)
+        nfs_modify.share_ids.update({path: share.id for path, share in added.items()})
+        nfs_modify.errors.update(errors)
+        nfs_modify.applied += len(nfs_modify.add) - len(errors)
+        self.metrics.shares.inc(len(nfs_modify.add) - len(errors), host=self.host, result="added")
+        self.metrics.shares.inc(len(errors), host=self.host, result="failed")
+        return nfs_modify
+
+    def resolve_share_ids(self, nfs_modify: TrueNAS.NfsModify, paths: list[str]):
+        """
+        Fill in the ids of the paths missing from nfs_modify.share_ids, e.g. for an NfsModify built
+        by hand, with one listing of only those paths. Nothing is fetched when the diff provided them.
+        """
+        missing = [path for path in paths if nfs_modify.share_ids.get(path) is None]
+        if len(missing) == 0:
+            return
+        self.logger.debug(f"Looking up the ids of {len(missing)} NFS Shares")
+        nfs_shares: NfsShareDict = self.get_nfs_share(
+            filters=[["path", "in", missing]],
+            options={"select": ["id", "path"]}
+        )
+        nfs_modify.share_ids.update(nfs_shares.ids(missing))
+
+    def apply_items(self, func: Callable, items: list, done: str = "Applied", action: str = "apply",
+                    results: dict = None, bulk_method: str = None, bulk_params: Callable = None,
+                    bulk_result: Callable = None) -> dict:
+        """
+        Apply the items as core.bulk jobs of bulk_size items if enabled, one call each otherwise
+        Args:
+            func: The function to call with each item, in per-call mode
+            bulk_method: The middleware method called for each item by the job
+            bulk_params: Returns the parameters of bulk_method for an item
+            bulk_result: Converts the result of bulk_method for an item, like func returns it
+            See apply_parallel for the others
+        Returns:
+            dict of item -> error message, for the items that failed
+        """
+        if self.bulk_size <= 0 or bulk_method is None or self.dry_run:
+            return self.apply_parallel(func, items, done=done, action=action, results=results)
+        errors = {}
+        for start in range(0, len(items), self.bulk_size):
+            batch = []
+            params = []
+            for item in items[start:start + self.bulk_size]:
+                try:
+                    params.append(bulk_params(item))
+                    batch.append(item)
+                except KeyError as e:
+                    errors[item] = f"Unknown share {e}"
+                    self.logger.info(f"Failed to {action} {item}: {errors[item]}")
+            if len(batch) == 0:
+                continue
             try:
-                nfs_share.path = path
-                self.add_nfs_share(nfs_share)
-                self.logger.info(f"Added {path}")
+                job_id = self.submit_bulk(bulk_method, params)
+            except (OSError, http.client.HTTPException) as e:
+                # The connection failed, the job may have been submitted anyway: don't apply it twice
+                for item in batch:
+                    errors[item] = f"core.bulk: {e}"
+                self.logger.info(f"Failed to {action} {len(batch)} items: core.bulk: {e}")
+                continue
             except Exception as e:
-                self.logger.info(f"Failed to add {path}: {e}")
+                # Refused by the NAS, nothing was submitted, so nothing can be applied twice
+                self.logger.warning(f"core.bulk failed ({e}), applying {len(batch)} items one call each")
+                errors.update(self.apply_parallel(func, batch, done=done, action=action, results=results))
+                continue
+            try:
+                outcomes = self.wait_job(job_id)
+            except Exception as e:
+                # The job may have applied part of the batch, the next cycle sorts it out
+                for item in batch:
+                    errors[item] = f"core.bulk job {job_id}: {e}"
+                self.logger.info(f"Failed to {action} {len(batch)} items: core.bulk job {job_id}: {e}")
+                continue
+            for i, item in enumerate(batch):
+                outcome = outcomes[i] if i < len(outcomes) and isinstance(outcomes[i], dict) else {}
+                if outcome.get("error") or "result" not in outcome:
+                    errors[item] = str(outcome.get("error") or "No result in the core.bulk job")
+                    self.logger.info(f"Failed to {action} {item}: {errors[item]}")
+                    continue
+                if results is not None:
+                    result = outcome["result"]
+                    results[item] = bulk_result(result) if bulk_result is not None and result else result
+                self.logger.info(f"{done} {item}")
+        return errors
+
+    def submit_bulk(self, method: str, params: list[list]) -> int:
+        """
+        Submit a core.bulk job calling method once for every parameter list
+        Returns:
+            The job id
+        """
+        self.logger.debug(f"Submitting core.bulk {method} for {len(params)} items")
+        if self.is_websocket:
+            return int(self.call("core.bulk", method, params, "autonfs", write=True))
+        return int(json.loads(self.post("/core/bulk", json.dumps(
+            {"method": method, "params": params, "description": "autonfs"}))))
+
+    def wait_job(self, job_id: int) -> list[dict]:
+        """
+        Poll a job until it ends
+        Returns:
+            The result of the job: for core.bulk, one {"result", "error"} per item
+        """
+        deadline = time.monotonic() + self.bulk_timeout
+        interval = 0.1
+        while True:
+            if self.is_websocket:
+                jobs = self.call("core.get_jobs", [["id", "=", job_id]])
+            else:
+                jobs = json.loads(self.get("/core/get_jobs", data=self.query_body([["id", "=", job_id]])))
+            if not jobs:
+                raise Exception(f"Job {job_id} not found")
+            job = jobs[0]
+            state = job.get("state")
+            if state == "SUCCESS":
+                return job.get("result") or []
+            if state in ("FAILED", "ABORTED"):
+                raise Exception(f"Job {job_id} {state.lower()}: {job.get('error')}")
+            if time.monotonic() >= deadline:
+                raise Exception(f"Job {job_id} still {state} after {self.bulk_timeout} seconds")
+            time.sleep(interval)
+            interval = min(interval * 2, 2)
+
+    def apply_parallel(self, func: Callable, items: list, done: str = "Applied", action: str = "apply",
+                       results: dict = None) -> dict:
+        """
+        Call func for every item, at most apply_concurrency at a time
+        Args:
+            func: The function to call with each item
+            items: The items to apply
+            done: Log message prefix for an item that succeeded
+            action: Name of the action in the failure log message
+            results: If given, filled with item -> return value of func for the items that succeeded
+        Returns:
+            dict of item -> error message, for the items that failed
+        """
+        errors = {}
+        if len(items) == 0:
+            return errors
+        workers = min(self.apply_concurrency, len(items))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="truenas-apply") as executor:
+            # Each call runs in a copy of this context, so its API spans belong to the current phase
+            futures = {executor.submit(copy_context().run, func, item): item for item in items}
+            for future in as_completed(futures):
+                item = futures[future]
+                try:
+                    result = future.result()
+                    if results is not None:
+                        results[item] = result
+                    self.logger.info(f"{done} {item}")
+                except Exception as e:
+                    errors[item] = str(e)
+                    self.logger.info(f"Failed to {action} {item}: {e}")
+        return errors
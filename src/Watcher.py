@@ -0,0 +1,149 @@
+from __future__ import annotations
+from .TrueNAS import TrueNAS, NfsParent
+from .WebSocket import JsonRpcClient
+import logging
+import queue
+import threading
+import time
+
+
+DATASET_EVENTS = "pool.dataset.query"
+SHARE_EVENTS = "sharing.nfs.query"
+
+
+class Watcher:
+    """
+    Event-driven reconciliation: subscribes to the dataset and NFS share events of the
+    middleware and reconciles only the affected share paths of the parents as soon as they change.
+    A full resync still runs every `full_resync_sec` as a safety net for missed events.
+    """
+
+    def __init__(self,
+                 truenas: TrueNAS,
+                 parents: list[NfsParent],
+                 full_resync_sec: int = 3600,
+                 debounce_sec: float = 1,
+                 logger: logging.Logger = None
+                 ):
+        """
+        Args:
+            truenas: A connected TrueNAS client
+            parents: The parent datasets to reconcile
+            full_resync_sec: Period of the full resync
+            debounce_sec: Time to wait for more events before reconciling a batch
+        """
+        self.truenas = truenas
+        self.parents = parents
+        self.__by_dataset: dict[str, NfsParent] = {parent.dataset_id: parent for parent in parents}
+        self.full_resync_sec = full_resync_sec
+        self.debounce_sec = debounce_sec
+        if logger is not None and isinstance(logger, logging.Logger):
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+        self.__paths: queue.Queue[str | None] = queue.Queue()
+        self.__share_paths: dict[int, str] = {}
+        self.__rpc: JsonRpcClient = None
+        self.__handshakes = 0
+        self.__stop = threading.Event()
+
+    def stop(self):
+        self.__stop.set()
+        self.__paths.put(None)
+
+    def _share_path(self, dataset_id: str) -> str | None:
+        """
+        The share path of a dataset, None if it is not a direct child of a parent
+        """
+        parent = self.__by_dataset.get(dataset_id.rpartition("/")[0])
+        if parent is None:
+            return None
+        return f"{parent.real_path}/{dataset_id}"
+
+    def _on_dataset_event(self, event: dict):
+        if event.get("msg") not in ("added", "removed"):
+            return
+        path = self._share_path(str(event.get("id", "")))
+        if path is not None:
+            self.logger.debug(f"Dataset event {event.get('msg')} for {path}")
+            self.__paths.put(path)
+
+    def _on_share_event(self, event: dict):
+        fields = event.get("fields") or {}
+        share_id = event.get("id")
+        path = fields.get("path") or self.__share_paths.get(share_id)
+        if event.get("msg") == "removed":
+            self.__share_paths.pop(share_id, None)
+        elif path:
+            self.__share_paths[share_id] = path
+        if path is None:
+            # A removed share we never saw, only a full resync can tell whether it matters
+            self.logger.debug(f"Share event {event.get('msg')} for unknown share {share_id}")
+            self.__paths.put("")
+            return
+        if any(parent.is_child_path(path) for parent in self.parents):
+            self.logger.debug(f"Share event {event.get('msg')} for {path}")
+            self.__paths.put(path)
+
+    def _subscribe(self):
+        self.truenas.subscribe(DATASET_EVENTS, self._on_dataset_event)
+        self.__rpc = self.truenas.subscribe(SHARE_EVENTS, self._on_share_event)
+        self.__handshakes = self.__rpc.handshakes
+        self.logger.info(f"Watching {DATASET_EVENTS} and {SHARE_EVENTS} events")
+
+    @property
+    def _subscription_lost(self) -> bool:
+        return self.__rpc is None or self.__rpc.closed or self.__rpc.handshakes != self.__handshakes
+
+    def full_resync(self) -> dict[str, TrueNAS.NfsModify]:
+        self.logger.info(f"Full resync of {', '.join(self.__by_dataset.keys())}")
+        shares = self.truenas.get_nfs_share(
+            filters=TrueNAS.prefix_filters("path", [parent.share_prefix for parent in self.parents]),
+            options={"select": ["id", "path"]}
+        )
+        self.__share_paths = {share.id: share.path for share in shares}
+        return self.truenas.update_nfs_shares(self.parents)
+
+    def _drain(self, first: str) -> set[str]:
+        """
+        Collect the paths arriving within debounce_sec of the first one
+        """
+        paths = {first}
+        deadline = time.monotonic() + self.debounce_sec
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                paths.add(self.__paths.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return paths
+
+    def run(self):
+        next_resync = 0
+        while not self.__stop.is_set():
+            try:
+                if self._subscription_lost:
+                    # Events may have been missed while the subscription was down
+                    self._subscribe()
+                    next_resync = 0
+                if time.monotonic() >= next_resync:
+                    self.full_resync()
+                    next_resync = time.monotonic() + self.full_resync_sec
+                try:
+                    first = self.__paths.get(timeout=max(0, min(next_resync - time.monotonic(), 5)))
+                except queue.Empty:
+                    continue
+                if first is None:
+                    continue
+                paths = self._drain(first)
+                paths.discard(None)
+                if "" in paths:
+                    next_resync = 0
+                    continue
+                self.logger.info(f"Reconciling {len(paths)} changed paths")
+                self.truenas.update_nfs_shares(self.parents, paths=list(paths))
+            except Exception as e:
+                self.logger.error(f"Error watching NFS shares: {e}")
+                self.__stop.wait(5)
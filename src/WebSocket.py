@@ -0,0 +1,329 @@
+from __future__ import annotations
+from concurrent.futures import Future
+from typing import Callable
+import base64
+import hashlib
+import itertools
+import json
+import logging
+import os
+import socket
+import ssl
+import struct
+import threading
+
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+
+class ErrRpc(Exception):
+    def __init__(self, error: dict):
+        self.code = error.get("code")
+        self.data = error.get("data")
+        super().__init__(f"JSON-RPC error {self.code}: {error.get('message')}")
+
+
+class ErrWebSocketClosed(ConnectionError):
+    def __init__(self, msg: str = "WebSocket connection is closed"):
+        super().__init__(msg)
+
+
+def _mask(key: bytes, data: bytes) -> bytes:
+    n = len(data)
+    if n == 0:
+        return data
+    mask = (key * (n // 4 + 1))[:n]
+    return (int.from_bytes(data, "big") ^ int.from_bytes(mask, "big")).to_bytes(n, "big")
+
+
+class WebSocket:
+    """
+    A minimal RFC 6455 client, enough to talk to the TrueNAS middleware:
+    text messages, fragmentation, ping/pong and close.
+    """
+
+    def __init__(self, host: str, path: str, verify_ssl: bool = True, use_ssl: bool = True, timeout: float = 30):
+        self.host = host
+        self.path = path
+        self.verify_ssl = verify_ssl
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.__sock: socket.socket = None
+        self.__reader = None
+        self.__send_lock = threading.Lock()
+
+    @property
+    def is_connected(self) -> bool:
+        return self.__sock is not None
+
+    def connect(self):
+        host, _, port = self.host.partition(":")
+        port = int(port) if port else (443 if self.use_ssl else 80)
+        sock = socket.create_connection((host, port), timeout=self.timeout)
+        if self.use_ssl:
+            if not self.verify_ssl:
+                context = ssl._create_unverified_context()
+            else:
+                context = ssl.create_default_context()
+            sock = context.wrap_socket(sock, server_hostname=host)
+        key = base64.b64encode(os.urandom(16)).decode()
+        request = (
+            f"GET {self.path} HTTP/1.1\r\n"
+            f"Host: {self.host}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n\r\n"
+        )
+        sock.sendall(request.encode())
+        reader = sock.makefile("rb")
+        status_line = reader.readline().decode(errors="replace")
+        headers = {}
+        while True:
+            line = reader.readline().decode(errors="replace").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if " 101 " not in status_line:
+            sock.close()
+            raise ConnectionError(f"WebSocket handshake failed: {status_line.strip()}")
+        expected = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+        if headers.get("sec-websocket-accept") != expected:
+            sock.close()
+            raise ConnectionError("WebSocket handshake failed: invalid Sec-WebSocket-Accept")
+        # The reader thread blocks on recv(), the timeout only applies to the handshake
+        sock.settimeout(None)
+        self.__sock = sock
+        self.__reader = reader
+
+    def close(self):
+        if self.__sock is None:
+            return
+        try:
+            self._send_frame(OP_CLOSE, struct.pack("!H", 1000))
+        except OSError:
+            pass
+        # Closed from several threads at once, only one of them gets the socket
+        with self.__send_lock:
+            sock, self.__sock = self.__sock, None
+        if sock is None:
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+
+    def _send_frame(self, opcode: int, payload: bytes):
+        header = bytes([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header += bytes([0x80 | length])
+        elif length < (1 << 16):
+            header += bytes([0x80 | 126]) + struct.pack("!H", length)
+        else:
+            header += bytes([0x80 | 127]) + struct.pack("!Q", length)
+        key = os.urandom(4)
+        with self.__send_lock:
+            if self.__sock is None:
+                raise ErrWebSocketClosed()
+            self.__sock.sendall(header + key + _mask(key, payload))
+
+    def send(self, message: str):
+        self._send_frame(OP_TEXT, message.encode())
+
+    def _read_exact(self, n: int) -> bytes:
+        data = self.__reader.read(n)
+        if data is None or len(data) < n:
+            raise ErrWebSocketClosed("WebSocket connection closed by peer")
+        return data
+
+    def _recv_frame(self) -> tuple[bool, int, bytes]:
+        b1, b2 = self._read_exact(2)
+        fin = bool(b1 & 0x80)
+        opcode = b1 & 0x0F
+        length = b2 & 0x7F
+        if length == 126:
+            length = struct.unpack("!H", self._read_exact(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", self._read_exact(8))[0]
+        key = self._read_exact(4) if b2 & 0x80 else None
+        payload = self._read_exact(length) if length else b""
+        if key is not None:
+            payload = _mask(key, payload)
+        return fin, opcode, payload
+
+    def recv(self) -> str:
+        """
+        Receive the next text message, answering pings on the way
+        """
+        if self.__sock is None:
+            raise ErrWebSocketClosed()
+        fragments: list[bytes] = []
+        while True:
+            fin, opcode, payload = self._recv_frame()
+            if opcode == OP_PING:
+                self._send_frame(OP_PONG, payload)
+                continue
+            if opcode == OP_PONG:
+                continue
+            if opcode == OP_CLOSE:
+                raise ErrWebSocketClosed("WebSocket connection closed by peer")
+            fragments.append(payload)
+            if fin:
+                return b"".join(fragments).decode()
+
+
+class JsonRpcClient:
+    """
+    JSON-RPC 2.0 over a WebSocket. Calls are multiplexed by message id, so any number of
+    threads can have calls in flight on the one connection; a reader thread routes every
+    response to the Future of its call and every notification to the subscribers.
+    Every connection gets its own socket, reader and pending calls: a reconnect stops the old
+    reader first, and a reader that stops fails only the calls sent on its connection.
+    """
+
+    def __init__(self,
+                 host: str,
+                 path: str = "/api/current",
+                 verify_ssl: bool = True,
+                 use_ssl: bool = True,
+                 timeout: float = 30,
+                 logger: logging.Logger = None
+                 ):
+        self.timeout = timeout
+        self.__ws_args = dict(host=host, path=path, verify_ssl=verify_ssl, use_ssl=use_ssl, timeout=timeout)
+        self.ws = WebSocket(**self.__ws_args)
+        if logger is not None and isinstance(logger, logging.Logger):
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger(__name__)
+        self.__ids = itertools.count(1)
+        # The calls in flight on the current connection
+        self.__pending: dict[int, Future] = {}
+        self.__lock = threading.Lock()
+        self.__connect_lock = threading.Lock()
+        self.__thread: threading.Thread = None
+        self.__handlers: list[Callable[[str, dict], None]] = []
+        self.calls = 0
+        self.handshakes = 0
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def closed(self) -> bool:
+        return not self.ws.is_connected or self.__thread is None or not self.__thread.is_alive()
+
+    def connect(self):
+        with self.__connect_lock:
+            # Reconnecting after the reader stopped: drop the dead socket and let its reader end
+            self.ws.close()
+            if self.__thread is not None and self.__thread is not threading.current_thread():
+                self.__thread.join(timeout=self.timeout)
+            ws = WebSocket(**self.__ws_args)
+            ws.connect()
+            pending: dict[int, Future] = {}
+            with self.__lock:
+                self.ws, self.__pending = ws, pending
+                self.handshakes += 1
+            self.__thread = threading.Thread(target=self._read_loop, args=(ws, pending), name="truenas-jsonrpc",
+                                             daemon=True)
+            self.__thread.start()
+
+    def close(self):
+        with self.__lock:
+            ws, pending = self.ws, self.__pending
+        ws.close()
+        self._fail_pending(pending, ErrWebSocketClosed())
+
+    def on_notification(self, handler: Callable[[str, dict], None]):
+        """
+        Register a handler called with (method, params) for every server notification
+        """
+        self.__handlers.append(handler)
+
+    def remove_notification(self, handler: Callable[[str, dict], None]):
+        if handler in self.__handlers:
+            self.__handlers.remove(handler)
+
+    def _fail_pending(self, pending: dict[int, Future], error: Exception, ws: WebSocket = None):
+        """
+        Fail the calls in flight on one connection, closing its socket first if given so no
+        call can be sent on it afterwards
+        """
+        with self.__lock:
+            if ws is not None:
+                ws.close()
+            futures = list(pending.values())
+            pending.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+    def _read_loop(self, ws: WebSocket, pending: dict[int, Future]):
+        try:
+            while True:
+                message = json.loads(ws.recv())
+                msg_id = message.get("id")
+                if msg_id is None:
+                    self._dispatch(message.get("method"), message.get("params"))
+                    continue
+                with self.__lock:
+                    future = pending.pop(msg_id, None)
+                if future is None:
+                    self.logger.debug(f"Dropping response for unknown id {msg_id}")
+                elif "error" in message and message["error"] is not None:
+                    future.set_exception(ErrRpc(message["error"]))
+                else:
+                    future.set_result(message.get("result"))
+        except Exception as e:
+            if ws.is_connected:
+                self.logger.debug(f"JSON-RPC reader stopped: {e!r}")
+            self._fail_pending(pending, e if isinstance(e, ConnectionError) else ErrWebSocketClosed(str(e)), ws=ws)
+
+    def _dispatch(self, method: str, params):
+        for handler in self.__handlers:
+            try:
+                handler(method, params)
+            except Exception as e:
+                self.logger.error(f"Notification handler failed for {method}: {e}")
+
+    def call_async(self, method: str, *params) -> Future:
+        """
+        Send a call without waiting for its result
+        """
+        future = Future()
+        msg_id = next(self.__ids)
+        with self.__lock:
+            ws, pending = self.ws, self.__pending
+            if not ws.is_connected:
+                raise ErrWebSocketClosed()
+            pending[msg_id] = future
+            self.calls += 1
+        message = {"jsonrpc": "2.0", "id": msg_id, "method": method, "params": list(params)}
+        try:
+            ws.send(json.dumps(message))
+        except Exception:
+            with self.__lock:
+                pending.pop(msg_id, None)
+            raise
+        return future
+
+    def call(self, method: str, *params, timeout: float = None):
+        """
+        Call a middleware method and wait for its result
+        """
+        return self.call_async(method, *params).result(timeout=timeout or self.timeout)